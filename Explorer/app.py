@@ -22,9 +22,18 @@ from wtforms import StringField, SubmitField
 from wtforms.validators import DataRequired, Length
 import blockchain
 from config import coin_name, rpcpassword, rpcport, rpcuser
-from config import app_key, csrf_key, database_uri, program_name
-from helpers import chain_age, JSONRPC, JSONRPCException
-from models import db, Blocks, CoinbaseTXIn, TXs, TXIn, TxOut, Addresses, AddressSummary
+from config import app_key, csrf_key, database_uri, program_name, redis_url
+from chain_tip import ChainTip
+from helpers import chain_age, format_satoshis, is_hex_hash, JSONRPC, JSONRPCException
+from indexes import missing_indexes
+from metrics import ingest_metrics
+from migrations import pending_migrations
+from models import db, address_summaries, Blocks, CoinbaseTXIn, TXs, TXIn, TxOut, Addresses, AddressIds
+from models import AddressSummary
+from response_cache import ResponseCache
+from search import search
+
+ADDRESS_PAGE_SIZE = 1000
 
 
 class DecimalEncoder(JSONEncoder):
@@ -78,9 +87,12 @@ def create_app(the_csrf):
     prep_application.jinja_env.lstrip_blocks = True
     prep_application.jinja_env.enable_async = True
     prep_application.wsgi_app = ProxyFix(prep_application.wsgi_app, x_proto=1, x_host=1)
-    the_cache = Cache(config={'CACHE_TYPE': 'RedisCache',
-                              'CACHE_KEY_PREFIX': 'cce',
-                              'CACHE_REDIS_URL': 'redis://localhost:6379/0'})
+    if redis_url is not None:
+        the_cache = Cache(config={'CACHE_TYPE': 'RedisCache',
+                                  'CACHE_KEY_PREFIX': 'cce',
+                                  'CACHE_REDIS_URL': redis_url})
+    else:
+        the_cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
     the_cache.init_app(prep_application)
     db.init_app(prep_application)
     the_csrf.init_app(prep_application)
@@ -96,6 +108,38 @@ def create_app(the_csrf):
 csrf = CSRFProtect()
 application, cache, coin_uniques, cryptocurrency = create_app(csrf)
 application.app_context().push()
+# Migrations first, since one that adds an index makes it look missing until it's run.
+if pending_migrations(db.engine):
+    application.logger.error("The database needs migrating. Run first_run.py and pick Continue first.")
+    sys.exit()
+if missing_indexes(db.engine):
+    application.logger.error("Some indexes haven't been built yet. Let first_run.py finish first.")
+    sys.exit()
+chain_tip = ChainTip()
+response_cache = ResponseCache(cache, chain_tip)
+
+
+def address_history_page(address_id, address_count, the_page, before=None, after=None):
+    # Keyset pagination on ix_addresses_history: the page links carry the id either side of the page they point
+    # at, so page 500 is the same short index range as page 1. Only the columns the index has are selected.
+    history = db.session.query(Addresses.id, Addresses.transaction, Addresses.block_hash, Addresses.block_height,
+                               Addresses.the_time, Addresses.amount, Addresses.balance).filter(
+        Addresses.address_id == address_id)
+    if after is not None:
+        rows = history.filter(Addresses.id > after).order_by(Addresses.id).limit(ADDRESS_PAGE_SIZE).all()
+        return rows[::-1]
+    if before is None and the_page > 1:
+        # A plain ?page= link, so find the id just before the page first, from whichever end is nearer
+        newer_rows = (the_page - 1) * ADDRESS_PAGE_SIZE
+        ids = db.session.query(Addresses.id).filter(Addresses.address_id == address_id)
+        if newer_rows <= address_count // 2:
+            ids = ids.order_by(desc(Addresses.id)).offset(newer_rows - 1)
+        else:
+            ids = ids.order_by(Addresses.id).offset(max(address_count - newer_rows, 0))
+        before = ids.limit(1).scalar()
+    if before is not None:
+        history = history.filter(Addresses.id < before)
+    return history.order_by(desc(Addresses.id)).limit(ADDRESS_PAGE_SIZE).all()
 
 
 @application.template_global()
@@ -110,10 +154,7 @@ def format_size(tx_size):
 
 @application.template_global()
 def format_eight_zeroes(the_item):
-    if the_item == 0:
-        return '0.00000000'
-    else:
-        return format(the_item, '.8f')
+    return format_satoshis(the_item)
 
 
 # When first_run is executing, this needs to happen if we want to also view the explorer
@@ -154,11 +195,26 @@ def uri_too_large(e):
 
 @application.route('/robots.txt')
 # Cached for 30 days
-@cache.cached(timeout=2592000)
+@response_cache.cached(2592000, follows_chain=False)
 def robots():
     return send_from_directory(application.static_folder, 'robots.txt')
 
 
+@application.get('/metrics')
+def prometheus_metrics():
+    # The response cache's hits and misses, and whatever first_run.py or cronjob.py last wrote to metrics_file if
+    # they're keeping metrics. Not cached, it's rewritten every commit.
+    metrics_text = response_cache.render()
+    if ingest_metrics.enabled:
+        try:
+            metrics_text += ingest_metrics.path.read_text()
+        except FileNotFoundError:
+            pass
+    return application.response_class(content_type='text/plain; version=0.0.4; charset=utf-8',
+                                      status=200,
+                                      response=metrics_text)
+
+
 class SearchForm(FlaskForm):
     search = StringField('Search',
                          validators=[DataRequired(), Length(min=1, max=64)],
@@ -170,9 +226,26 @@ class SearchForm(FlaskForm):
 @application.post("/")
 # @cache.memoize(300)
 def index():
-    clean_search = ''
     valid_search_characters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789:'
     form = SearchForm(request.form)
+    # Set when a search doesn't find anything, which shows the front page again with a message
+    search_outcome = {}
+    if request.method == 'POST' and form.validate_on_submit():
+        clean_search = ''.join(character for character in form.search.data if character in valid_search_characters)
+        search_results = search(clean_search, coin_uniques)
+        if search_results is None:
+            search_outcome['input_too_short'] = True
+        elif len(search_results) == 1:
+            endpoint, arguments = search_results.only_match()
+            return redirect(url_for(endpoint, **arguments))
+        elif search_results:
+            return render_template('search_results.html',
+                                   searched_addresses=search_results.addresses,
+                                   searched_blocks=search_results.blocks,
+                                   searched_txs=search_results.txs)
+        else:
+            search_outcome['search_validated'] = False
+
     count = request.args.get('count', default=50, type=int)
     try:
         if 1 <= count <= 500:
@@ -182,7 +255,7 @@ def index():
     except ValueError:
         count = 1
 
-    latest_block_height = int(db.session.query(Blocks).order_by(desc('height')).first().height)
+    latest_block_height = chain_tip.get().height
     hi = request.args.get('hi', default=latest_block_height, type=int)
     try:
         if hi in range(0, latest_block_height + 1):
@@ -194,196 +267,16 @@ def index():
 
     front_page_items = db.session.query(Blocks).where(Blocks.height <= hi).order_by(desc('height')).limit(count)
     genesis_timestamp = coin_uniques['genesis']['timestamp']
-
-    if request.method == 'POST':
-        address_prefixes = ('address:', 'a:', 'add:')
-        block_prefixes = ('block:', 'b:', 'bhash:')
-        tx_prefixes = ('transaction:', 't:', 'tx:', 'thash:')
-        if form.validate_on_submit():
-            if 76 >= len(form.search.data) >= 1:
-                for each_character in form.search.data:
-                    if each_character in valid_search_characters:
-                        clean_search += each_character
-                if clean_search.startswith(address_prefixes):
-                    if 72 >= len(clean_search) >= 6:
-                        the_address = ''.join(clean_search.split(':')[1:])
-                        address_lookup = db.session.query(AddressSummary).filter(AddressSummary.address.ilike(f"%{the_address}%")).all()
-                        if address_lookup:
-                            if len(address_lookup) == 1:
-                                return redirect(url_for('address', the_address=address_lookup[0].address))
-                            else:
-                                return render_template('search_results.html',
-                                                       searched_addresses=address_lookup,
-                                                       searched_blocks=[],
-                                                       searched_txs=[])
-                        else:
-                            # TODO - set a variable for being unable to find specifically addresses
-                            return render_template('index.html',
-                                                   search_validated=False,
-                                                   form=form,
-                                                   front_page_blocks=front_page_items,
-                                                   format_time=format_time,
-                                                   count=count,
-                                                   hi=hi,
-                                                   latest_block=latest_block_height,
-                                                   chain_age=chain_age,
-                                                   genesis_time=genesis_timestamp), 200
-                    else:
-                        return render_template('index.html',
-                                               input_too_short=True,
-                                               form=form,
-                                               front_page_blocks=front_page_items,
-                                               format_time=format_time,
-                                               count=count,
-                                               hi=hi,
-                                               latest_block=latest_block_height,
-                                               chain_age=chain_age,
-                                               genesis_time=genesis_timestamp), 200
-                elif clean_search.startswith(block_prefixes):
-                    if 70 >= len(clean_search) >= 1:
-                        the_block = ''.join(clean_search.split(':')[1:])
-                        try:
-                            if int(the_block) in range(0, latest_block_height + 1):
-                                return redirect(url_for('block', block_hash_or_height=the_block))
-                            else:
-                                raise ValueError
-                        except ValueError:
-                            if 70 >= len(clean_search) >= 6:
-                                block_lookup = db.session.query(Blocks).filter(Blocks.hash.like(f"%{the_block}%")).all()
-                                if len(block_lookup) == 1:
-                                    return redirect(url_for('block', block_hash_or_height=block_lookup[0].hash))
-                                elif len(block_lookup) >= 2:
-                                    return render_template('search_results.html',
-                                                           searched_addresses=[],
-                                                           searched_blocks=block_lookup,
-                                                           searched_txs=[])
-                                else:
-                                    # TODO - set a variable for being unable to find specifically blocks
-                                    return render_template('index.html',
-                                                           search_validated=False,
-                                                           form=form,
-                                                           front_page_blocks=front_page_items,
-                                                           format_time=format_time,
-                                                           count=count,
-                                                           hi=hi,
-                                                           latest_block=latest_block_height,
-                                                           chain_age=chain_age,
-                                                           genesis_time=genesis_timestamp), 200
-                elif clean_search.startswith(tx_prefixes):
-                    if 76 >= len(clean_search) >= 6:
-                        the_tx = ''.join(clean_search.split(':')[1:])
-                        tx_lookup = db.session.query(TXs).filter(TXs.txid.like(f"%{the_tx}%")).all()
-                        if tx_lookup:
-                            if len(tx_lookup) == 1:
-                                return redirect(url_for('tx', transaction=tx_lookup[0].txid))
-                            else:
-                                return render_template('search_results.html',
-                                                       searched_addresses=[],
-                                                       searched_blocks=[],
-                                                       searched_txs=tx_lookup)
-                        else:
-                            # TODO - set a variable for being unable to find specifically transactions
-                            return render_template('index.html',
-                                                   search_validated=False,
-                                                   form=form,
-                                                   front_page_blocks=front_page_items,
-                                                   format_time=format_time,
-                                                   count=count,
-                                                   hi=hi,
-                                                   latest_block=latest_block_height,
-                                                   chain_age=chain_age,
-                                                   genesis_time=genesis_timestamp), 200
-                    else:
-                        return render_template('index.html',
-                                               input_too_short=True,
-                                               form=form,
-                                               front_page_blocks=front_page_items,
-                                               format_time=format_time,
-                                               count=count,
-                                               hi=hi,
-                                               latest_block=latest_block_height,
-                                               chain_age=chain_age,
-                                               genesis_time=genesis_timestamp), 200
-                else:
-                    try:
-                        input_data = int(clean_search)
-                    except ValueError:
-                        if 64 >= len(clean_search) >= 6:
-                            address_like = db.session.query(AddressSummary).filter(AddressSummary.address.ilike(f"%{clean_search}%")).all()
-                            address_len = len(address_like)
-                            input_data = clean_search.lower()
-                            tx_like = db.session.query(TXs).filter(TXs.txid.like(f"%{input_data}%")).all()
-                            tx_len = len(tx_like)
-                            block_like = db.session.query(Blocks).filter(Blocks.hash.like(f"%{input_data}%")).all()
-                            block_len = len(block_like)
-                            if address_len + tx_len + block_len >= 2:
-                                 return render_template('search_results.html',
-                                                        searched_addresses=address_like,
-                                                        searched_blocks=block_like,
-                                                        searched_txs=tx_like)
-                            elif address_len + tx_len + block_len == 1:
-                                if address_len:
-                                    return redirect(url_for('address', the_address=address_like[0].address))
-                                elif tx_len:
-                                    return redirect(url_for('tx', transaction=tx_like[0].txid))
-                                elif block_len:
-                                    return redirect(url_for('block', block_hash_or_height=block_like[0].hash))
-                            else:
-                                return render_template('index.html',
-                                                       search_validated=False,
-                                                       form=form,
-                                                       front_page_blocks=front_page_items,
-                                                       format_time=format_time,
-                                                       count=count,
-                                                       hi=hi,
-                                                       latest_block=latest_block_height,
-                                                       chain_age=chain_age,
-                                                       genesis_time=genesis_timestamp), 200
-                    else:
-                        if input_data in range(0, latest_block_height + 1):
-                            return redirect(url_for('block', block_hash_or_height=input_data))
-                        else:
-                            return render_template('index.html',
-                                                   search_validated=False,
-                                                   form=form,
-                                                   front_page_blocks=front_page_items,
-                                                   format_time=format_time,
-                                                   count=count,
-                                                   hi=hi,
-                                                   latest_block=latest_block_height,
-                                                   chain_age=chain_age,
-                                                   genesis_time=genesis_timestamp), 200
-            else:
-                return render_template('index.html',
-                                       input_too_short=True,
-                                       form=form,
-                                       front_page_blocks=front_page_items,
-                                       format_time=format_time,
-                                       count=count,
-                                       hi=hi,
-                                       latest_block=latest_block_height,
-                                       chain_age=chain_age,
-                                       genesis_time=genesis_timestamp), 200
-        else:
-            return render_template('index.html',
-                                   form=form,
-                                   front_page_blocks=front_page_items,
-                                   format_time=format_time,
-                                   count=count,
-                                   hi=hi,
-                                   latest_block=latest_block_height,
-                                   chain_age=chain_age,
-                                   genesis_time=genesis_timestamp), 200
-    elif request.method in ['GET', 'HEAD', 'OPTIONS']:
-        return render_template('index.html',
-                               form=form,
-                               front_page_blocks=front_page_items,
-                               format_time=format_time,
-                               count=count,
-                               hi=hi,
-                               latest_block=latest_block_height,
-                               chain_age=chain_age,
-                               genesis_time=genesis_timestamp), 200
+    return render_template('index.html',
+                           form=form,
+                           front_page_blocks=front_page_items,
+                           format_time=format_time,
+                           count=count,
+                           hi=hi,
+                           latest_block=latest_block_height,
+                           chain_age=chain_age,
+                           genesis_time=genesis_timestamp,
+                           **search_outcome), 200
 
 
 @application.get("/address/")
@@ -395,7 +288,7 @@ def redirect_to_address():
 
 
 @application.get("/address/<the_address>")
-@cache.memoize(300)
+@response_cache.cached(300, query_args=('page', 'before', 'after'))
 def address(the_address):
     # No reason to waste an SQL lookup if we're being redirected from /address/ ^
     if the_address == 'INVALIDADDRESS':
@@ -406,7 +299,7 @@ def address(the_address):
     # This is also done earlier to prevent an SQL lookup.
     if the_page >= 1000000:
         return render_template('404.html', error="Doing something weird?"), 403
-    address_summary = db.session.query(AddressSummary).filter_by(address=the_address).one_or_none()
+    address_summary = address_summaries().filter(AddressIds.address == the_address).one_or_none()
     if address_summary is None:
         if cryptocurrency.validateaddress(the_address)['isvalid']:
             return render_template('404.html', error="Address not seen on the network."), 404
@@ -414,60 +307,49 @@ def address(the_address):
             return render_template('404.html', error="Not a valid address"), 400
     else:
         address_count = address_summary.transactions_in + address_summary.transactions_out
-        total_pages = math.ceil(address_count / 1000)
+        total_pages = max(math.ceil(address_count / ADDRESS_PAGE_SIZE), 1)
         if the_page > total_pages:
             the_page = total_pages
-        if total_pages == 1:
-            address_lookup = db.session.query(Addresses).filter_by(address=the_address).order_by(desc(Addresses.id))
-            return render_template('address.html',
-                                   address_info=address_lookup,
-                                   the_address_summary=address_summary,
-                                   this_address=the_address,
-                                   total_balance=address_summary.balance,
-                                   total_received=address_summary.received,
-                                   total_sent=address_summary.sent,
-                                   total_pages=total_pages,
-                                   which_currency=coin_uniques["shortened"]), 200
-        else:
-            if the_page == 1:
-                the_offset = 0
-            else:
-                the_offset = int((the_page - 1) * 1000)
-            address_limited = db.session.query(Addresses).filter_by(address=the_address).order_by(desc(Addresses.id)).limit(1000).offset(the_offset)
-            return render_template('address.html',
-                                   address_info=address_limited,
-                                   the_address_summary=address_summary,
-                                   this_address=the_address,
-                                   total_balance=address_summary.balance,
-                                   total_received=address_summary.received,
-                                   total_sent=address_summary.sent,
-                                   the_page=the_page,
-                                   total_pages=total_pages,
-                                   which_currency=coin_uniques["shortened"]), 200
+        address_history = address_history_page(address_summary.address_id, address_count, the_page,
+                                                request.args.get('before', type=int),
+                                                request.args.get('after', type=int))
+        return render_template('address.html',
+                               address_info=address_history,
+                               the_address_summary=address_summary,
+                               this_address=the_address,
+                               total_balance=address_summary.balance,
+                               total_received=address_summary.received,
+                               total_sent=address_summary.sent,
+                               the_page=the_page,
+                               total_pages=total_pages,
+                               which_currency=coin_uniques["shortened"]), 200
 
 
 @application.get("/block/")
-@cache.memoize(300)
+@response_cache.cached(300, follows_chain=False)
 def redirect_to_block():
     return redirect(url_for('block', block_hash_or_height="0"))
 
 
 @application.get("/block/<block_hash_or_height>")
-@cache.memoize(300)
+@response_cache.cached(300)
 def block(block_hash_or_height):
     try:
         the_block_height = int(block_hash_or_height)
     except ValueError:
         try:
+            if not is_hex_hash(block_hash_or_height):
+                raise ValueError
             block_lookup = db.session.query(Blocks).filter_by(hash=block_hash_or_height.lower()).first()
             the_block_height = int(block_lookup.height)
         except(AttributeError, ValueError):
             return render_template('404.html', error="Not a valid block height/hash"), 404
 
-    latest_block_height = int(db.session.query(Blocks).order_by(desc('height')).first().height)
+    latest_block_height = chain_tip.get().height
     if the_block_height in range(0, latest_block_height + 1):
         the_block = db.session.query(Blocks).filter_by(height=the_block_height).first()
         if the_block is not None:
+            response_cache.final(the_block_height)
             block_hash = the_block.hash
             if the_block_height != 0:
                 previous_block_hash = the_block.prevhash
@@ -517,14 +399,27 @@ def redirect_to_tx():
 
 
 @application.get("/tx/<transaction>")
-@cache.memoize(300)
+@response_cache.cached(300)
 def tx(transaction):
+    if not is_hex_hash(transaction):
+        return render_template('404.html', error="Not a valid transaction"), 404
     check_transaction = db.session.query(TXs).filter_by(txid=transaction.lower()).first()
     if check_transaction is not None:
         coinbase = db.session.query(CoinbaseTXIn).filter_by(txid=transaction.lower()).one_or_none()
-        txin = db.session.query(TXIn).filter_by(txid=transaction.lower()).all()
-        txout = db.session.query(TxOut).filter_by(txid=transaction.lower()).all()
+        # With the block's height as well, only that block's partition gets looked at
+        txin = db.session.query(TXIn).filter_by(block_height=check_transaction.block_height,
+                                                txid=transaction.lower()).all()
+        txout = db.session.query(TxOut).filter_by(block_height=check_transaction.block_height,
+                                                  txid=transaction.lower()).all()
         if txin is not None and txout is not None:
+            # Unspent outputs get their spending transaction filled in later
+            if all(vout.spent or vout.scriptpubkey.startswith('OP_RETURN') for vout in txout):
+                # The spending transactions are on the page as well, so it's only as final as the newest of them
+                spenders = list({vout.linked_txid for vout in txout if vout.spent})
+                spender_heights = [height for height, in
+                                   db.session.query(TXs.block_height).filter(TXs.txid.in_(spenders))]
+                if len(spender_heights) == len(spenders):
+                    response_cache.final(max(spender_heights, default=check_transaction.block_height))
             block_height_lookup = db.session.query(Blocks).filter_by(height=check_transaction.block_height).first()
             return render_template('transaction.html',
                                    coinbase=coinbase,
@@ -544,13 +439,13 @@ def tx(transaction):
 
 
 @application.get("/api/")
-@cache.memoize(86400)
+@response_cache.cached(86400, follows_chain=False)
 def api_index():
     return render_template('api_index.html'), 200
 
 
 @application.get("/api/addressbalance/")
-@cache.memoize(300)
+@response_cache.cached(300, follows_chain=False)
 def redirect_to_api__address_balance():
     if coin_uniques['burn_address'] is not None:
         return redirect(url_for('api__address_balance', the_address=coin_uniques['burn_address']))
@@ -593,21 +488,21 @@ def redirect_to_api__validate_address():
 
 
 @application.get("/api/addressbalance/<the_address>/")
-@cache.memoize(300)
+@response_cache.cached(300)
 def api__address_balance(the_address):
     if the_address == "INVALID_ADDRESS":
         return application.response_class(mimetype='application/json',
                                           status=404,
                                           response=json.dumps({'message': 'Hi there, did you mean to put in an address?',
                                                                'error': '404'}))
-    address_lookup = db.session.query(AddressSummary).filter_by(address=the_address).first()
+    address_lookup = address_summaries().filter(AddressIds.address == the_address).first()
     if address_lookup is None:
         return application.response_class(mimetype='application/json',
                                           status=404,
                                           response=json.dumps({'message': 'This address is invalid',
                                                                'error': '404'}))
     else:
-        address_balance = address_lookup.balance
+        address_balance = format_eight_zeroes(address_lookup.balance)
         return application.response_class(mimetype='application/json',
                                           status=200,
                                           response=json.dumps({'message': address_balance,
@@ -615,9 +510,9 @@ def api__address_balance(the_address):
 
 
 @application.get("/api/blockcount/")
-@cache.cached(timeout=120)
+@response_cache.cached(120)
 def api__block_count():
-    most_recent_height = db.session.query(Blocks).order_by(desc('height')).first().height
+    most_recent_height = chain_tip.get().height
     return application.response_class(mimetype='application/json',
                                       status=200,
                                       response=json.dumps({'message': most_recent_height,
@@ -625,17 +520,19 @@ def api__block_count():
 
 
 @application.get("/api/confirmations/<userinput_block_height>/")
-@cache.memoize(300)
+@response_cache.cached(300)
 def api__confirmations(userinput_block_height):
     try:
         userinput_block_height = int(userinput_block_height)
     except ValueError:
         # not a block number, check if it's a hash
         try:
-            block_lookup = db.session.query(Blocks).filter_by(hash=userinput_block_height.lower()).first()
+            block_lookup = None
+            if is_hex_hash(userinput_block_height):
+                block_lookup = db.session.query(Blocks).filter_by(hash=userinput_block_height.lower()).first()
             if block_lookup is not None:
                 user_block_height = int(block_lookup.height)
-                latest_block_height = int(db.session.query(Blocks).order_by(desc('height')).first().height)
+                latest_block_height = chain_tip.get().height
                 block_confirmations = (latest_block_height + 1) - user_block_height
                 return application.response_class(mimetype='application/json',
                                                   status=200,
@@ -652,7 +549,7 @@ def api__confirmations(userinput_block_height):
                                               response=json.dumps({'message': 'This block hash/height is invalid',
                                                                    'error': 'invalid'}))
     else:
-        latest_block_height = int(db.session.query(Blocks).order_by(desc('height')).first().height)
+        latest_block_height = chain_tip.get().height
         # check if this is a block number like 0 or something else.
         # +1 because range() goes up to but doesn't include the number, so to include it we do +1
         if userinput_block_height in range(0, latest_block_height + 1):
@@ -669,7 +566,7 @@ def api__confirmations(userinput_block_height):
 
 
 @application.get("/api/connections/")
-@cache.cached(timeout=600)
+@response_cache.cached(600, follows_chain=False)
 def api__connections():
     try:
         total_connections = cryptocurrency.getconnectioncount()
@@ -686,9 +583,9 @@ def api__connections():
 
 
 @application.get("/api/lastdifficulty/")
-@cache.cached(timeout=120)
+@response_cache.cached(120)
 def api__last_difficulty():
-    latest_difficulty = float(db.session.query(Blocks).order_by(desc('height')).first().difficulty)
+    latest_difficulty = float(chain_tip.get().difficulty)
     return application.response_class(mimetype='application/json',
                                       status=200,
                                       response=json.dumps({'message': str(latest_difficulty),
@@ -696,7 +593,7 @@ def api__last_difficulty():
 
 
 @application.get("/api/mempool/")
-@cache.cached(timeout=120)
+@response_cache.cached(120, follows_chain=False)
 def api__mempool():
     try:
         the_mempool = cryptocurrency.getrawmempool(True)
@@ -712,7 +609,7 @@ def api__mempool():
 
 
 @application.get("/api/peers/")
-@cache.cached(timeout=900)
+@response_cache.cached(900, follows_chain=False)
 def api__peers():
     try:
         peers = cryptocurrency.getpeerinfo()
@@ -730,7 +627,7 @@ def api__peers():
 
 
 @application.get("/api/rawtx/<transaction>/")
-@cache.memoize(300)
+@response_cache.cached(300)
 def api__rawtx(transaction):
     if transaction == "INVALIDTRANSACTION":
         return application.response_class(mimetype='application/json',
@@ -751,21 +648,21 @@ def api__rawtx(transaction):
 
 
 @application.get("/api/receivedbyaddress/<the_address>/")
-@cache.memoize(300)
+@response_cache.cached(300)
 def api__received_by_address(the_address):
     if the_address == "INVALID_ADDRESS":
         return application.response_class(mimetype='application/json',
                                           status=404,
                                           response=json.dumps({'message': 'Hi there, did you mean to put in an address?',
                                                                'error': '404'}))
-    address_lookup = db.session.query(AddressSummary).filter_by(address=the_address).first()
+    address_lookup = address_summaries().filter(AddressIds.address == the_address).first()
     if address_lookup is None:
         return application.response_class(mimetype='application/json',
                                           status=404,
                                           response=json.dumps({'message': 'This address is invalid',
                                                                'error': '404'}))
     else:
-        address_received = str(address_lookup.received)
+        address_received = format_eight_zeroes(address_lookup.received)
         return application.response_class(mimetype='application/json',
                                           status=200,
                                           response=json.dumps({'message': address_received,
@@ -773,33 +670,33 @@ def api__received_by_address(the_address):
 
 
 @application.get("/api/richlist/")
-@cache.cached(timeout=3600)
+@response_cache.cached(3600)
 def api__rich_list():
     the_top = db.session.query(AddressSummary).order_by(desc('balance')).limit(500)
     the_rich_list = {}
     for the_index, the_address in enumerate(the_top):
-        the_rich_list[the_index] = {"address": the_address.address, "balance": the_address.balance}
+        the_rich_list[the_index] = {"address": the_address.address, "balance": format_eight_zeroes(the_address.balance)}
     return application.response_class(mimetype='application/json',
                                       status=200,
                                       response=json.dumps({'message': the_rich_list, 'error': 'ok'}))
 
 
 @application.get("/api/sentbyaddress/<the_address>/")
-@cache.memoize(300)
+@response_cache.cached(300)
 def api__sent_by_address(the_address):
     if the_address == "INVALID_ADDRESS":
         return application.response_class(mimetype='application/json',
                                           status=404,
                                           response=json.dumps({'message': 'Hi there, did you mean to put in an address?',
                                                                'error': '404'}))
-    address_lookup = db.session.query(AddressSummary).filter_by(address=the_address).first()
+    address_lookup = address_summaries().filter(AddressIds.address == the_address).first()
     if address_lookup is None:
         return application.response_class(mimetype='application/json',
                                           status=404,
                                           response=json.dumps({'message': 'This address is invalid',
                                                                'error': '404'}))
     else:
-        address_sent = address_lookup.sent
+        address_sent = format_eight_zeroes(address_lookup.sent)
         return application.response_class(mimetype='application/json',
                                           status=200,
                                           response=json.dumps({'message': address_sent,
@@ -807,7 +704,7 @@ def api__sent_by_address(the_address):
 
 
 @application.get("/api/totalcoins/")
-@cache.cached(timeout=300)
+@response_cache.cached(300)
 def api__total_coins():
     return application.response_class(mimetype='application/json',
                                       status=200,
@@ -816,7 +713,7 @@ def api__total_coins():
 
 
 @application.get("/api/totaltransactions/")
-@cache.cached(timeout=300)
+@response_cache.cached(300)
 def api__total_transactions():
     return application.response_class(mimetype='application/json',
                                       status=200,
@@ -825,7 +722,7 @@ def api__total_transactions():
 
 
 @application.get("/api/validateaddress/<the_address>/")
-@cache.memoize(300)
+@response_cache.cached(300, follows_chain=False)
 def api__validate_address(the_address):
     if the_address == "INVALID_ADDRESS":
         return application.response_class(mimetype='application/json',
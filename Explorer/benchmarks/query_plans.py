@@ -0,0 +1,83 @@
+# Checks that the search box's prefix queries (search.py) read their index in order and let LIMIT stop early,
+# instead of sorting every match first. Sorting is switched off for the EXPLAIN, so a Sort only turns up in a plan
+# when no index could give the order, however small the tables are. Exits with 1 when one does.
+#
+# Point it at a database run.py or first_run.py has filled, ideally one whose collation isn't C. From the Explorer
+# directory:
+#   python -m benchmarks.query_plans --database-uri postgresql://postgres@localhost/explorer_bench
+import argparse
+import sys
+from flask import Flask
+from sqlalchemy import event
+from models import db, AddressIds, Blocks, TXs
+from search import address_prefix_query, hash_prefix_query
+
+SORT_NODES = {'Sort', 'Incremental Sort'}
+# Short enough that a real chain has a great many matches for each
+PREFIX_LENGTH = 4
+
+
+def executed_sql(query):
+    # The statement and parameters just as SQLAlchemy sends them, so HexBytes and the rest are already applied.
+    executed = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        query.all()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return executed[0]
+
+
+def explain(query):
+    statement, parameters = executed_sql(query)
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute("SET LOCAL enable_sort = off")
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+    plan = cursor.fetchone()[0][0]['Plan']
+    cursor.close()
+    db.session.rollback()
+    return plan
+
+
+def plan_nodes(plan):
+    yield plan
+    for subplan in plan.get('Plans', ()):
+        yield from plan_nodes(subplan)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-uri', required=True, help="A database with some blocks in it. Only read.")
+    args = parser.parse_args()
+
+    plans_app = Flask(__name__)
+    plans_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    plans_app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    db.init_app(plans_app)
+    with plans_app.app_context():
+        the_address = db.session.query(AddressIds.address).order_by(AddressIds.id).limit(1).scalar()
+        block_hash = db.session.query(Blocks.hash).order_by(Blocks.height).limit(1).scalar()
+        txid = db.session.query(TXs.txid).order_by(TXs.id).limit(1).scalar()
+        if the_address is None or txid is None:
+            parser.error(f"{args.database_uri} doesn't have any addresses or transactions yet")
+        queries = {'address prefix': address_prefix_query(the_address[:PREFIX_LENGTH]),
+                   'block hash prefix': hash_prefix_query(Blocks, Blocks.hash, block_hash[:PREFIX_LENGTH]),
+                   'txid prefix': hash_prefix_query(TXs, TXs.txid, txid[:PREFIX_LENGTH])}
+        sorted_plans = 0
+        for name, query in queries.items():
+            nodes = list(plan_nodes(explain(query)))
+            scans = ', '.join(f"{node['Node Type']} using {node['Index Name']}" if 'Index Name' in node else
+                              f"{node['Node Type']} on {node['Relation Name']}"
+                              for node in nodes if 'Relation Name' in node)
+            sorts = [node for node in nodes if node['Node Type'] in SORT_NODES]
+            print(f"{name}: {'SORTS EVERY MATCH' if sorts else 'ok'} ({scans})")
+            sorted_plans += bool(sorts)
+    return 1 if sorted_plans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+# Calls per second against a local stub daemon, with a new connection per call (how JSONRPC used to work)
+# versus the pooled keep-alive session.
+#
+# From the Explorer directory:
+#   python -m benchmarks.rpc_pool --calls 5000 --threads 8
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.stub_rpc import StubRPCServer
+from helpers import JSONRPC
+
+
+def bare_call(url):
+    postdata = json.dumps({'version': '1.1', 'method': 'getblockcount', 'params': [], 'id': 1})
+    return requests.post(url, headers={'Content-type': 'application/json'}, data=postdata, timeout=30,
+                         auth=('user', 'password')).json()['result']
+
+
+def calls_per_second(the_call, calls, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(lambda _: the_call(), range(calls)):
+            pass
+    return calls / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    stub = StubRPCServer().start()
+    pooled = JSONRPC(stub.url, 'user', 'password')
+    results = {'calls': args.calls,
+               'threads': args.threads,
+               'new_connection_per_call': calls_per_second(lambda: bare_call(stub.url), args.calls, args.threads),
+               'pooled_session': calls_per_second(pooled.getblockcount, args.calls, args.threads)}
+    stub.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# Ingest throughput and per-route latency against a synthetic chain, for comparing one revision with another.
+# Generates a benchmarks.synthetic_chain.SyntheticChain, serves it from a stub daemon, ingests it with
+# bulk_of_first_run_or_cron the way first_run.py does into a scratch PostgreSQL database, then requests every
+# app.py GET route repeatedly through Flask's test client. Results come out as JSON.
+#
+# The database gets dropped and recreated, so never point this at a real one. From the Explorer directory:
+#   python -m benchmarks.run --database-uri postgresql://postgres@localhost/explorer_bench --reset \
+#       --blocks 2000 --txs-per-block 50 --output before.json
+import argparse
+import datetime
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from flask import Flask, url_for
+from sqlalchemy import create_engine, inspect
+import config
+from benchmarks.stub_rpc import chain_methods, StubRPCServer
+from benchmarks.synthetic_chain import SyntheticChain
+from bulk_writer import BulkWriter
+from caches import AddressCache, PrevoutResolver
+from helpers import bulk_of_first_run_or_cron, commit_boundary, CommitPolicy, JSONRPC, pre_boogie
+from migrations import stamp_migrations
+from models import db
+from pipeline import BlockPrefetcher
+
+# Route arguments and the kind of sample each gets filled in with
+ROUTE_SAMPLES = {'block_hash_or_height': 'block_height',
+                 'userinput_block_height': 'block_height',
+                 'transaction': 'txid',
+                 'the_address': 'address'}
+# Endpoints that aren't worth timing: static files, and /metrics which just reads a file
+SKIPPED_ENDPOINTS = {'static', 'prometheus_metrics'}
+WARMUP_REQUESTS = 3
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ingest(chain, stub_url):
+    # Same loop as first_run.py's lets_boogie, timed from the first fetch to the last commit.
+    cryptocurrency = JSONRPC(stub_url, 'user', 'password')
+    uniques = chain.uniques()
+    outstanding_coins, total_cumulative_difficulty = pre_boogie(db, cryptocurrency, 0)
+    writer = BulkWriter(db)
+    prevout_resolver = PrevoutResolver(db, cryptocurrency, writer)
+    address_cache = AddressCache(db)
+    commit_policy = CommitPolicy()
+    the_blocks = range(0, chain.height + 1)
+    started = time.perf_counter()
+    for block_height, fetched_block in BlockPrefetcher(cryptocurrency, uniques, the_blocks):
+        outstanding_coins, total_cumulative_difficulty = bulk_of_first_run_or_cron(
+            None, db, uniques, cryptocurrency, block_height, chain.height, outstanding_coins,
+            total_cumulative_difficulty, prevout_resolver, address_cache, writer, fetched_block)
+        if commit_policy.block_added(writer.rows + len(address_cache.dirty)):
+            commit_boundary(db, writer, address_cache)
+            commit_policy.committed()
+    commit_boundary(db, writer, address_cache)
+    elapsed = time.perf_counter() - started
+    return {'blocks': len(the_blocks),
+            'transactions': len(chain.transactions),
+            'seconds': round(elapsed, 3),
+            'blocks_per_second': round(len(the_blocks) / elapsed, 2),
+            'transactions_per_second': round(len(chain.transactions) / elapsed, 2)}
+
+
+def route_samples(chain, how_many, seed):
+    # Heights and txids picked uniformly, addresses by drawing outputs, so busy addresses come up as often as
+    # they would from real visitors.
+    sample_random = random.Random(seed)
+    paid_addresses = [vout['scriptPubKey']['addresses'][0] for raw_tx in chain.transactions.values()
+                      for vout in raw_tx['vout'] if 'addresses' in vout['scriptPubKey']]
+    txids = list(chain.transactions)
+    return {'block_height': [sample_random.randint(0, chain.height) for _ in range(how_many)],
+            'txid': [sample_random.choice(txids) for _ in range(how_many)],
+            'address': [sample_random.choice(paid_addresses) for _ in range(how_many)]}
+
+
+def time_routes(application, samples, requests_per_route):
+    client = application.test_client()
+    results = {}
+    for rule in sorted(application.url_map.iter_rules(), key=lambda each_rule: each_rule.rule):
+        # The redirect_to_ routes only send the query string on to one of the others
+        if ('GET' not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS
+                or rule.endpoint.startswith('redirect_to_')):
+            continue
+        if any(argument not in ROUTE_SAMPLES for argument in rule.arguments):
+            results[rule.rule] = {'skipped': 'no samples for its arguments'}
+            continue
+        timings = []
+        statuses = {}
+        for request_number in range(WARMUP_REQUESTS + requests_per_route):
+            arguments = {}
+            for argument in rule.arguments:
+                argument_samples = samples[ROUTE_SAMPLES[argument]]
+                arguments[argument] = argument_samples[request_number % len(argument_samples)]
+            with application.test_request_context():
+                path = url_for(rule.endpoint, **arguments)
+            started = time.perf_counter()
+            response = client.get(path)
+            response.close()
+            if request_number >= WARMUP_REQUESTS:
+                timings.append((time.perf_counter() - started) * 1000)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+        results[rule.rule] = {'requests': len(timings),
+                              'p50_ms': round(percentiles[49], 3),
+                              'p99_ms': round(percentiles[98], 3),
+                              'mean_ms': round(statistics.fmean(timings), 3),
+                              'statuses': {str(status): count for status, count in sorted(statuses.items())}}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-uri', required=True,
+                        help="A scratch PostgreSQL database. Everything in it is dropped when --reset is given.")
+    parser.add_argument('--reset', action='store_true', help="Drop whatever tables the database already has")
+    parser.add_argument('--blocks', type=int, default=1000)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--max-inputs', type=int, default=3)
+    parser.add_argument('--max-outputs', type=int, default=3)
+    parser.add_argument('--addresses', type=int, default=10000)
+    parser.add_argument('--address-skew', type=float, default=1.1,
+                        help="Zipf exponent for picking which address an output pays. 0 is uniform.")
+    parser.add_argument('--nulldata-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help="Timed requests per route")
+    parser.add_argument('--cache', action='store_true',
+                        help="Keep app.py's Redis cache, instead of timing every request uncached")
+    parser.add_argument('--output', help="Write the results here as well as to stdout")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_uri)
+    existing_tables = inspect(engine).get_table_names()
+    engine.dispose()
+    if existing_tables and not args.reset:
+        parser.error(f"{args.database_uri} already has tables, add --reset to drop them")
+
+    chain_parameters = {'blocks': args.blocks, 'txs_per_block': args.txs_per_block, 'max_inputs': args.max_inputs,
+                        'max_outputs': args.max_outputs, 'addresses': args.addresses,
+                        'address_skew': args.address_skew, 'nulldata_rate': args.nulldata_rate, 'seed': args.seed}
+    generating_started = time.perf_counter()
+    chain = SyntheticChain(**chain_parameters)
+    generating_seconds = time.perf_counter() - generating_started
+    stub = StubRPCServer(chain_methods(chain)).start()
+
+    ingest_app = Flask(__name__)
+    ingest_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    ingest_app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    db.init_app(ingest_app)
+    with ingest_app.app_context():
+        db.drop_all()
+        db.create_all()
+        stamp_migrations(db.engine)
+        ingest_results = ingest(chain, stub.url)
+        db.session.remove()
+        db.engine.dispose()
+
+    # app.py sets itself up from config when it's imported, so point config at the scratch database and
+    # the stub first.
+    config.database_uri = args.database_uri
+    config.coin_name = 'Bitcoin'
+    config.rpcport = stub.server_address[1]
+    config.rpcuser = 'user'
+    config.rpcpassword = 'password'
+    import app
+    app.coin_uniques = chain.uniques()
+    if not args.cache:
+        app.cache.init_app(app.application, config={'CACHE_TYPE': 'NullCache'})
+    route_results = time_routes(app.application, route_samples(chain, args.requests, args.seed), args.requests)
+    stub.stop()
+
+    results = {'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+               'git_revision': git_revision(),
+               'python': platform.python_version(),
+               'chain': dict(chain_parameters, transactions=len(chain.transactions),
+                             generating_seconds=round(generating_seconds, 3)),
+               'ingest': ingest_results,
+               'routes': route_results,
+               'cached': args.cache}
+    output = json.dumps(results, indent=2, sort_keys=True, default=lambda the_value: str(the_value))
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
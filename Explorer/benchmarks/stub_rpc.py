@@ -0,0 +1,149 @@
+import decimal
+import json
+import re
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def encode_response(response_body):
+    # Decimal amounts go out as bare JSON numbers with every digit, the way the daemon writes them.
+    # json can only turn them into strings, so they're marked as strings and unquoted afterwards.
+    def decimal_marker(the_value):
+        if isinstance(the_value, decimal.Decimal):
+            return f"__decimal__{the_value}__decimal__"
+        raise TypeError(f"{type(the_value).__name__} isn't JSON serializable")
+    return re.sub(r'"__decimal__(.*?)__decimal__"', r'\1', json.dumps(response_body, default=decimal_marker))
+
+
+class StubRPCHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so keep-alive clients actually get to keep their connection.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes, without this Nagle + delayed ACK adds ~40ms to every
+        # response on a kept-alive connection and makes pooling look slower than it is.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        request_body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if isinstance(request_body, list):
+            response_body = self.server.answer_batch(request_body)
+        else:
+            response_body = self.server.answer(request_body)
+        data = encode_response(response_body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubRPCServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, methods=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), StubRPCHandler)
+        self.methods = {'getblockcount': lambda: 0,
+                        'getconnectioncount': lambda: 8}
+        if methods is not None:
+            self.methods.update(methods)
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def answer(self, the_call):
+        the_method = self.methods.get(the_call.get('method'))
+        if the_method is None:
+            return {'id': the_call.get('id'), 'result': None,
+                    'error': {'code': -32601, 'message': 'Method not found'}}
+        try:
+            return {'id': the_call.get('id'), 'result': the_method(*the_call.get('params', [])), 'error': None}
+        except StubRPCError as e:
+            return {'id': the_call.get('id'), 'result': None, 'error': {'code': e.code, 'message': e.message}}
+
+    def answer_batch(self, calls):
+        return [self.answer(each_call) for each_call in calls]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRPCError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def chain_methods(chain):
+    # Everything JSONRPC gets asked by first_run.py, cronjob.py and app.py, answered out of a
+    # benchmarks.synthetic_chain.SyntheticChain.
+    def getblockhash(block_height):
+        if not 0 <= block_height <= chain.height:
+            raise StubRPCError(-8, 'Block height out of range')
+        return chain.block_hashes[block_height]
+
+    def getblock(block_hash, verbosity=1):
+        if block_hash not in chain.blocks:
+            raise StubRPCError(-5, 'Block not found')
+        if verbosity in (0, False):
+            return chain.raw_blocks[block_hash].hex()
+        return dict(chain.blocks[block_hash], confirmations=chain.height - chain.blocks[block_hash]['height'] + 1)
+
+    def getblockheader(block_hash, verbose=True):
+        if block_hash not in chain.headers:
+            raise StubRPCError(-5, 'Block not found')
+        if not verbose:
+            return chain.raw_blocks[block_hash][:80].hex()
+        return dict(chain.headers[block_hash], confirmations=chain.height - chain.headers[block_hash]['height'] + 1)
+
+    def getrawtransaction(txid, verbose=0):
+        if txid not in chain.transactions:
+            raise StubRPCError(-5, 'No such mempool or blockchain transaction')
+        if verbose:
+            return chain.transactions[txid]
+        return chain.raw_transactions[txid].hex()
+
+    def gettxoutsetinfo():
+        if not txoutset_info:
+            spent = set((vin['txid'], vin['vout']) for raw_tx in chain.transactions.values() for vin in raw_tx['vin']
+                        if 'coinbase' not in vin)
+            txoutset_info.update(height=chain.height, bestblock=chain.block_hashes[-1],
+                                 transactions=len(chain.transactions),
+                                 total_amount=sum((vout['value'] for txid, raw_tx in chain.transactions.items()
+                                                   for vout in raw_tx['vout'] if (txid, vout['n']) not in spent),
+                                                  decimal.Decimal(0)))
+        return txoutset_info
+
+    # Worked out on the first call, the chain never changes
+    txoutset_info = {}
+    known_addresses = set(chain.addresses)
+
+    return {'getblockcount': lambda: chain.height,
+            'getbestblockhash': lambda: chain.block_hashes[-1],
+            'getblockhash': getblockhash,
+            'getblock': getblock,
+            'getblockheader': getblockheader,
+            'getrawtransaction': getrawtransaction,
+            # The chain never grows, so there's never anything to wait for.
+            'waitforblockheight': lambda block_height, timeout=0: {'hash': chain.block_hashes[-1],
+                                                                   'height': chain.height},
+            'getconnectioncount': lambda: 8,
+            'getpeerinfo': lambda: [],
+            'getrawmempool': lambda verbose=False: {} if verbose else [],
+            'gettxoutsetinfo': gettxoutsetinfo,
+            'validateaddress': lambda the_address: {'isvalid': the_address in known_addresses,
+                                                    'address': the_address}}
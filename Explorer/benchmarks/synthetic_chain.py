@@ -0,0 +1,191 @@
+import bisect
+import hashlib
+import random
+import struct
+from blockchain import Bitcoin
+from raw_block import base58_check, ByteReader, double_sha256, NULL_HASH, read_transaction, SIGHASH_TYPES
+from raw_block import satoshis_to_coins, verbose_transaction
+
+BLOCK_INTERVAL = 600
+FIRST_BLOCK_TIME = 1400000000
+# Every block at difficulty 1
+BITS = 0x1d00ffff
+# Halves every this many blocks, so a long chain still has fees that matter next to the subsidy
+HALVING_INTERVAL = 150
+
+
+def compact_size(number):
+    if number < 0xfd:
+        return bytes([number])
+    elif number <= 0xffff:
+        return b'\xfd' + struct.pack('<H', number)
+    elif number <= 0xffffffff:
+        return b'\xfe' + struct.pack('<I', number)
+    return b'\xff' + struct.pack('<Q', number)
+
+
+def push_data(data):
+    if len(data) < 0x4c:
+        return bytes([len(data)]) + data
+    return b'\x4c' + bytes([len(data)]) + data
+
+
+def merkle_root(hashes):
+    while len(hashes) > 1:
+        if len(hashes) % 2:
+            hashes = hashes + [hashes[-1]]
+        hashes = [double_sha256(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+
+class SyntheticChain(object):
+    # A made-up Bitcoin-style chain, the same every time for the same arguments, for benchmarks/stub_rpc.py to
+    # serve. Outputs pay P2PKH addresses picked with a Zipf-like skew (a few addresses get most of the activity,
+    # like exchanges and pools do), inputs spend random unspent outputs, and nulldata_rate of the transactions
+    # also get an OP_RETURN output. A fifth of the inputs carry non-DER signatures and another fifth are segwit
+    # spends, so both sides of scriptSig decoding get exercised.
+    # The verbose JSON comes from decoding the raw blocks with raw_block.py, so both fetch paths see the same chain.
+    def __init__(self, blocks=1000, txs_per_block=20, max_inputs=3, max_outputs=3, addresses=10000,
+                 address_skew=1.1, nulldata_rate=0.05, seed=1):
+        self.random = random.Random(seed)
+        self.address_hashes = [hashlib.sha256(f"{seed}-{number}".encode()).digest()[:20]
+                               for number in range(addresses)]
+        self.addresses = [base58_check(Bitcoin.unique['address_prefixes']['pubkeyhash'] + address_hash)
+                          for address_hash in self.address_hashes]
+        self.address_weights = []
+        total_weight = 0.0
+        for number in range(addresses):
+            total_weight += 1 / (number + 1) ** address_skew
+            self.address_weights.append(total_weight)
+        # hash -> serialized block, the verbose block (less confirmations) and getblockheader's answer
+        self.raw_blocks = {}
+        self.blocks = {}
+        self.headers = {}
+        self.block_hashes = []
+        # txid -> serialized transaction and its verbose JSON
+        self.raw_transactions = {}
+        self.transactions = {}
+        unspent = []
+        previous_hash = bytes(32)
+        for block_height in range(blocks):
+            transactions = []
+            fees = 0
+            for _ in range(txs_per_block if block_height > 0 else 0):
+                if not unspent:
+                    break
+                inputs = [unspent.pop(self.random.randrange(len(unspent)))
+                          for _ in range(min(len(unspent), self.random.randint(1, max_inputs)))]
+                input_value = sum(value for _, _, value in inputs)
+                fee = min(input_value // 100, 10000)
+                output_count = self.random.randint(1, max_outputs)
+                outputs = []
+                for n in range(output_count):
+                    value = (input_value - fee) // output_count
+                    if n == 0:
+                        value += (input_value - fee) % output_count
+                    outputs.append((self.pay_to_address(), value))
+                if self.random.random() < nulldata_rate:
+                    outputs.append((b'\x6a' + push_data(self.random.randbytes(20)), 0))
+                txid, raw_transaction = self.transaction(inputs, outputs)
+                transactions.append(raw_transaction)
+                fees += fee
+                unspent.extend((txid, n, value) for n, (script, value) in enumerate(outputs) if value)
+            coinbase_value = (50 * 100000000 >> (block_height // HALVING_INTERVAL)) + fees
+            coinbase_txid, coinbase = self.transaction(None, [(self.pay_to_address(), coinbase_value)], block_height)
+            unspent.append((coinbase_txid, 0, coinbase_value))
+            transactions.insert(0, coinbase)
+            previous_hash = self.block(block_height, previous_hash, transactions)
+
+    def pay_to_address(self):
+        address_number = bisect.bisect_left(self.address_weights, self.random.random() * self.address_weights[-1])
+        return b'\x76\xa9\x14' + self.address_hashes[address_number] + b'\x88\xac'
+
+    def signature(self):
+        if self.random.random() < 0.2:
+            return self.random.randbytes(70) + b'\x01'
+        r_value = bytes([self.random.randrange(1, 0x80)]) + self.random.randbytes(31)
+        s_value = bytes([self.random.randrange(1, 0x80)]) + self.random.randbytes(31)
+        return (b'\x30\x44\x02\x20' + r_value + b'\x02\x20' + s_value
+                + bytes([self.random.choice(list(SIGHASH_TYPES))]))
+
+    def transaction(self, inputs, outputs, block_height=None):
+        # Returns (txid, the serialized transaction)
+        version = struct.pack('<i', 1)
+        witnesses = []
+        if inputs is None:
+            script = push_data(struct.pack('<I', block_height)[:3]) + push_data(self.random.randbytes(8))
+            serialized_inputs = (compact_size(1) + bytes(32) + b'\xff\xff\xff\xff' + compact_size(len(script))
+                                 + script + b'\xff\xff\xff\xff')
+        else:
+            serialized_inputs = compact_size(len(inputs))
+            for txid, n, _ in inputs:
+                signature, public_key = self.signature(), b'\x02' + self.random.randbytes(32)
+                if self.random.random() < 0.2:
+                    script = b''
+                    witnesses.append([signature, public_key])
+                else:
+                    script = push_data(signature) + push_data(public_key)
+                    witnesses.append([])
+                serialized_inputs += (bytes.fromhex(txid)[::-1] + struct.pack('<I', n) + compact_size(len(script))
+                                      + script + b'\xfe\xff\xff\xff')
+        serialized_outputs = compact_size(len(outputs))
+        for script, value in outputs:
+            serialized_outputs += struct.pack('<q', value) + compact_size(len(script)) + script
+        locktime = struct.pack('<I', 0)
+        txid = double_sha256(version + serialized_inputs + serialized_outputs + locktime)[::-1].hex()
+        if any(witnesses):
+            serialized_witnesses = b''
+            for witness in witnesses:
+                serialized_witnesses += compact_size(len(witness))
+                for item in witness:
+                    serialized_witnesses += compact_size(len(item)) + item
+            return txid, (version + b'\x00\x01' + serialized_inputs + serialized_outputs + serialized_witnesses
+                          + locktime)
+        return txid, version + serialized_inputs + serialized_outputs + locktime
+
+    def block(self, block_height, previous_hash, transactions):
+        # Returns the block's hash, in internal byte order for the next block's header
+        txids = []
+        for raw_transaction in transactions:
+            decoded_transaction = read_transaction(ByteReader(raw_transaction), Bitcoin.unique)
+            self.raw_transactions[decoded_transaction.txid] = raw_transaction
+            # The daemon's JSON has values in coins
+            verbose = verbose_transaction(decoded_transaction)
+            for vout in verbose['vout']:
+                vout['value'] = satoshis_to_coins(vout['value'])
+            self.transactions[decoded_transaction.txid] = verbose
+            txids.append(decoded_transaction.txid)
+        block_time = FIRST_BLOCK_TIME + block_height * BLOCK_INTERVAL
+        header = (struct.pack('<I', 4) + previous_hash + merkle_root([bytes.fromhex(txid)[::-1] for txid in txids])
+                  + struct.pack('<III', block_time, BITS, self.random.getrandbits(32)))
+        block_hash = double_sha256(header)[::-1].hex()
+        raw_block = header + compact_size(len(transactions)) + b''.join(transactions)
+        the_block = {'hash': block_hash,
+                     'height': block_height,
+                     'version': 4,
+                     'merkleroot': header[36:68][::-1].hex(),
+                     'time': block_time,
+                     'bits': f"{BITS:08x}",
+                     'nonce': struct.unpack('<I', header[76:80])[0],
+                     'size': len(raw_block),
+                     'difficulty': 1,
+                     'tx': txids}
+        if block_height > 0:
+            the_block['previousblockhash'] = previous_hash[::-1].hex()
+            self.blocks[the_block['previousblockhash']]['nextblockhash'] = block_hash
+            self.headers[the_block['previousblockhash']]['nextblockhash'] = block_hash
+        self.raw_blocks[block_hash] = raw_block
+        self.blocks[block_hash] = the_block
+        self.headers[block_hash] = {key: value for key, value in the_block.items() if key != 'tx'}
+        self.headers[block_hash]['nTx'] = len(transactions)
+        self.block_hashes.append(block_hash)
+        return bytes.fromhex(block_hash)[::-1]
+
+    @property
+    def height(self):
+        return len(self.block_hashes) - 1
+
+    def uniques(self):
+        # Bitcoin's, except for the genesis block
+        return dict(Bitcoin.unique, genesis={'timestamp': FIRST_BLOCK_TIME, 'hash': self.block_hashes[0],
+                                             'prev_hash': NULL_HASH})
@@ -0,0 +1,171 @@
+import decimal
+import mmap
+import os
+import struct
+from metrics import ingest_metrics
+from raw_block import deserialize_block, double_sha256, verbose_block
+
+# How much of a block file gets read (and un-XORed) at a time while looking for the next record after a torn one
+RESYNC_WINDOW = 1 << 20
+
+
+class BlockFiles(object):
+    # Blocks read straight out of a daemon's blocks/blk*.dat, for rebuilding from a copied datadir with no daemon
+    # to ask. The files hold blocks in whatever order they arrived, stale ones included, so everything is indexed
+    # first and the chain is the most-work path from uniques['genesis'].
+    # Stands in for JSONRPC as far as first_run.py needs one: getblockcount() and getblockhash().
+    def __init__(self, blocks_dir, uniques):
+        if not uniques.get('raw_blocks') or uniques.get('network_magic') is None:
+            raise ValueError("This coin's blocks can't be read from its block files")
+        self.uniques = uniques
+        self.magic = uniques['network_magic']
+        # Bitcoin Core 28+ obfuscates block files with the key in xor.dat. All zeros (or no file) means it doesn't.
+        xor_path = os.path.join(blocks_dir, 'xor.dat')
+        self.xor_key = None
+        if os.path.exists(xor_path):
+            with open(xor_path, 'rb') as xor_file:
+                xor_key = xor_file.read()
+            if any(xor_key):
+                self.xor_key = xor_key
+        self.files = []
+        for filename in sorted(os.listdir(blocks_dir)):
+            if filename.startswith('blk') and filename.endswith('.dat'):
+                with open(os.path.join(blocks_dir, filename), 'rb') as block_file:
+                    if os.fstat(block_file.fileno()).st_size > 0:
+                        self.files.append(mmap.mmap(block_file.fileno(), 0, access=mmap.ACCESS_READ))
+        # hash -> (file number, offset of the block, its size, prevhash, bits)
+        self.locations = {}
+        for file_number in range(len(self.files)):
+            self.index_file(file_number)
+        self.chain = self.best_chain()
+
+    def read(self, file_number, offset, size):
+        data = self.files[file_number][offset:offset + size]
+        if self.xor_key is None:
+            return data
+        key_length = len(self.xor_key)
+        key_start = offset % key_length
+        repeated_key = (self.xor_key[key_start:] + self.xor_key[:key_start]) * (size // key_length + 1)
+        return (int.from_bytes(data, 'little') ^ int.from_bytes(repeated_key[:len(data)], 'little')).to_bytes(
+            len(data), 'little')
+
+    def index_file(self, file_number):
+        file_size = len(self.files[file_number])
+        offset = 0
+        while offset + 88 <= file_size:
+            record_header = self.read(file_number, offset, 8)
+            if record_header[:4] != self.magic:
+                # The end of a file is preallocated zeroes. Anything else is a torn write, so skip to the next record.
+                if record_header == b'\0' * 8:
+                    break
+                offset = self.find_magic(file_number, offset + 1)
+                if offset is None:
+                    break
+                continue
+            block_size = struct.unpack('<I', record_header[4:])[0]
+            if offset + 8 + block_size > file_size:
+                break
+            header = self.read(file_number, offset + 8, 80)
+            block_hash = double_sha256(header)[::-1].hex()
+            self.locations[block_hash] = (file_number, offset + 8, block_size, header[4:36][::-1].hex(),
+                                          struct.unpack('<I', header[72:76])[0])
+            offset += 8 + block_size
+
+    def find_magic(self, file_number, offset):
+        # Where the next record starts from offset on, or None. Windows overlap by all but one byte of the magic,
+        # so one split across two of them still turns up.
+        file_size = len(self.files[file_number])
+        while offset < file_size:
+            position = self.read(file_number, offset, RESYNC_WINDOW + len(self.magic) - 1).find(self.magic)
+            if position >= 0:
+                return offset + position
+            offset += RESYNC_WINDOW
+        return None
+
+    def best_chain(self):
+        genesis_hash = self.uniques['genesis']['hash']
+        if genesis_hash not in self.locations:
+            raise ValueError(f"The genesis block {genesis_hash} isn't in these block files")
+        children = {}
+        for block_hash, location in self.locations.items():
+            children.setdefault(location[3], []).append(block_hash)
+        # Blocks that don't connect back to genesis (an orphan whose parent never got written) are ignored.
+        best_hash, best_work = genesis_hash, 0
+        to_visit = [(genesis_hash, block_work(self.locations[genesis_hash][4]))]
+        while to_visit:
+            block_hash, chain_work = to_visit.pop()
+            if chain_work > best_work:
+                best_hash, best_work = block_hash, chain_work
+            for child_hash in children.get(block_hash, []):
+                to_visit.append((child_hash, chain_work + block_work(self.locations[child_hash][4])))
+        chain = [best_hash]
+        while chain[-1] != genesis_hash:
+            chain.append(self.locations[chain[-1]][3])
+        chain.reverse()
+        return chain
+
+    def getblockcount(self):
+        return len(self.chain) - 1
+
+    def getblockhash(self, block_height):
+        from helpers import JSONRPCException
+        if not 0 <= block_height < len(self.chain):
+            raise JSONRPCException({'code': -8, 'message': 'Block height out of range'})
+        return self.chain[block_height]
+
+    def fetch_block(self, block_height):
+        # Same (the_block, raw_transactions) as helpers.fetch_block().
+        block_hash = self.chain[block_height]
+        file_number, offset, block_size, _, bits = self.locations[block_hash]
+        block_header = {'hash': block_hash, 'height': block_height, 'difficulty': block_difficulty(bits)}
+        if block_height + 1 < len(self.chain):
+            block_header['nextblockhash'] = self.chain[block_height + 1]
+        with ingest_metrics.stage('decode'):
+            raw_block = deserialize_block(self.read(file_number, offset, block_size), self.uniques)
+            return verbose_block(raw_block, block_header, self.uniques)
+
+    def blocks(self, heights):
+        return StoredBlocks(self, heights)
+
+    def close(self):
+        for block_file in self.files:
+            block_file.close()
+
+
+class StoredBlocks(object):
+    # BlockPrefetcher's counterpart for BlockFiles. Decoding is CPU-bound, so there's nothing for threads to overlap.
+    def __init__(self, block_files, heights):
+        self.block_files = block_files
+        self.heights = heights
+
+    def __len__(self):
+        return len(self.heights)
+
+    def __iter__(self):
+        for block_height in self.heights:
+            yield block_height, self.block_files.fetch_block(block_height)
+
+
+def bits_target(bits):
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+def block_work(bits):
+    return (1 << 256) // (bits_target(bits) + 1)
+
+
+def block_difficulty(bits):
+    # GetDifficulty(), formatted the way the daemon's JSON would have it.
+    shift = (bits >> 24) & 0xff
+    difficulty = 0x0000ffff / (bits & 0x00ffffff)
+    while shift < 29:
+        difficulty *= 256.0
+        shift += 1
+    while shift > 29:
+        difficulty /= 256.0
+        shift -= 1
+    return decimal.Decimal(f"{difficulty:.16g}")
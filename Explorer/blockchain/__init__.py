@@ -8,7 +8,13 @@ class Bitcoin:
               'genesis': {'timestmap': 1231006505,
                           'hash': '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f',
                           'prev_hash': '0000000000000000000000000000000000000000000000000000000000000000'},
-              'burn_address': None}
+              'burn_address': None,
+              # For raw_block.py, which works out addresses itself instead of asking the daemon for verbose JSON
+              'raw_blocks': True,
+              'address_prefixes': {'pubkeyhash': b'\x00', 'scripthash': b'\x05'},
+              'bech32_hrp': 'bc',
+              # Prefixes each record in blocks/blk*.dat, for blk_files.py
+              'network_magic': b'\xf9\xbe\xb4\xd9'}
 
 
 class Litecoin:
@@ -17,7 +23,11 @@ class Litecoin:
               'genesis': {'timestamp': 1317972665,
                           'hash': '12a765e31ffd4059bada1e25190f6e98c99d9714d334efa41a195a7e7e04bfe2',
                           'prev_hash': '0000000000000000000000000000000000000000000000000000000000000000'},
-              'burn_address': None}
+              'burn_address': None,
+              'raw_blocks': True,
+              'address_prefixes': {'pubkeyhash': b'\x30', 'scripthash': b'\x32'},
+              'bech32_hrp': 'ltc',
+              'network_magic': b'\xfb\xc0\xb6\xdb'}
 
 
 class Defcoin:
@@ -26,7 +36,14 @@ class Defcoin:
               'genesis': {'timestamp': 1394002925,
                           'hash': '192047379f33ffd2bbbab3d53b9c4b9e9b72e48f888eadb3dcf57de95a6038ad',
                           'prev_hash': '0000000000000000000000000000000000000000000000000000000000000000'},
-              'burn_address': None}
+              'burn_address': None,
+              # Neither raw_block.py nor blk_files.py has been checked against Defcoin's blocks, and its network
+              # magic isn't known here, so it keeps to the daemon's verbose JSON.
+              'raw_blocks': False,
+              # For search.py's address check
+              'address_prefixes': {'pubkeyhash': b'\x1e', 'scripthash': b'\x05'},
+              # No segwit
+              'bech32_hrp': None}
 
 
 class Woodcoin:
@@ -36,4 +53,6 @@ class Woodcoin:
               'genesis': {'timestamp': 1413817324,
                           'hash': '30758383eae55ae5c7752b73388c1c85bdfbe930ad25ad877252841ed1e734a4',
                           'prev_hash': '0000000000000000000000000000000000000000000000000000000000000000'},
-              'burn_address': 'WeHonorTheForestsAndTheTrees4pPXTQ'}
+              'burn_address': 'WeHonorTheForestsAndTheTrees4pPXTQ',
+              # Block and transaction hashes aren't double SHA-256, so raw_block.py can't be used.
+              'raw_blocks': False}
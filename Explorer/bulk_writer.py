@@ -0,0 +1,226 @@
+import io
+import json
+import time
+from psycopg2.extras import execute_values
+from caches import AddressIdCache, NO_ADDRESS
+from config import undo_depth
+from partitions import ensure_partitions
+
+# Same columns as the models, minus the serial ids PostgreSQL hands out itself (in COPY order, so ids still
+# follow the order rows were added in).
+COPY_COLUMNS = {'blocks': ('height', 'hash', 'version', 'prevhash', 'nexthash', 'merkleroot', 'time', 'bits', 'nonce',
+                           'size', 'difficulty', 'cumulative_difficulty', 'outstanding', 'value_out', 'transactions',
+                           'transaction_fees'),
+                'txs': ('txid', 'block_height', 'size', 'n', 'version', 'locktime', 'total_out', 'total_in', 'fee'),
+                'coinbasetxin': ('block_height', 'txid', 'scriptsig', 'sequence', 'witness'),
+                'txin': ('block_height', 'txid', 'n', 'scriptsig', 'sequence', 'witness', 'prevout_hash', 'prevout_n',
+                         'address_id', 'value'),
+                'txout': ('block_height', 'txid', 'n', 'value', 'scriptpubkey', 'address_id', 'linked_txid',
+                          'linked_txid_n', 'spent'),
+                'addresses': ('address_id', 'amount', 'n', 'block_height', 'balance', 'block_hash', 'the_time',
+                              'transaction', 'input', 'output'),
+                'block_undo': ('block_height', 'block_hash', 'address_summary', 'spent_outputs')}
+# Hashes and scripts come in as hex and go into BYTEA columns, which COPY takes as \x and the same hex.
+BYTEA_COLUMNS = {'blocks': ('hash', 'prevhash', 'nexthash', 'merkleroot'),
+                 'txs': ('txid',),
+                 'coinbasetxin': ('txid', 'scriptsig'),
+                 'txin': ('txid', 'scriptsig', 'prevout_hash'),
+                 'txout': ('txid', 'scriptpubkey', 'linked_txid'),
+                 'addresses': ('block_hash', 'transaction'),
+                 'block_undo': ('block_hash',)}
+# Addresses are buffered as themselves and become their address_ids ids on flush().
+ADDRESS_ID_COLUMNS = {table: columns.index('address_id') for table, columns in COPY_COLUMNS.items()
+                      if 'address_id' in columns}
+# Order matters only for foreign keys, which there aren't any of (yet), but keep it stable anyway.
+COPY_ORDER = ('blocks', 'txs', 'coinbasetxin', 'txin', 'txout', 'addresses', 'block_undo')
+CHAIN_STATE_UPSERT = ("INSERT INTO chain_state (id, tip_height, tip_hash, outstanding, cumulative_difficulty, "
+                      "committed_at) VALUES (1, %s, %s, %s, %s, %s) "
+                      "ON CONFLICT (id) DO UPDATE SET tip_height = excluded.tip_height, tip_hash = excluded.tip_hash, "
+                      "outstanding = excluded.outstanding, cumulative_difficulty = excluded.cumulative_difficulty, "
+                      "committed_at = excluded.committed_at")
+TXOUT_SPENT = COPY_COLUMNS['txout'].index('spent')
+TXOUT_LINKED_TXID = COPY_COLUMNS['txout'].index('linked_txid')
+TXOUT_LINKED_TXID_N = COPY_COLUMNS['txout'].index('linked_txid_n')
+
+
+def copy_value(the_value):
+    # COPY's text format: \N for NULL, t/f for booleans, and backslash escapes for anything that would break a line.
+    if the_value is None:
+        return '\\N'
+    elif the_value is True:
+        return 't'
+    elif the_value is False:
+        return 'f'
+    the_value = str(the_value)
+    if '\\' in the_value or '\t' in the_value or '\n' in the_value or '\r' in the_value:
+        the_value = the_value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return the_value
+
+
+def copy_bytea(hex_value):
+    # nexthash is NULL until there's a next block, see models.NextHash
+    if hex_value is None or hex_value == 'PLACEHOLDER':
+        return '\\N'
+    return '\\\\x' + hex_value
+
+
+COPY_CONVERTERS = {table: [copy_bytea if column in BYTEA_COLUMNS[table] else copy_value for column in columns]
+                   for table, columns in COPY_COLUMNS.items()}
+
+
+def copy_address_ids(address_ids):
+    def copy_address_id(the_address):
+        if the_address in NO_ADDRESS:
+            return '\\N'
+        return str(address_ids[the_address])
+    return copy_address_id
+
+
+class BulkWriter(object):
+    # Buffers ingest rows as plain lists and streams them into PostgreSQL with COPY ... FROM STDIN on flush(),
+    # inside whatever transaction db.session has open. Nothing goes through the ORM.
+    def __init__(self, db):
+        self.db = db
+        # AddressCache.flush() uses these too, right after flush() has loaded every address it wrote.
+        self.address_ids = AddressIdCache(db)
+        self.buffers = {table: [] for table in COPY_ORDER}
+        # (txid, n) -> position in buffers['txout'], so spending an output that hasn't been written yet just
+        # edits the buffered row.
+        self.txout_positions = {}
+        # Outputs that are already in the database and got spent since the last flush.
+        self.spent_stored_outputs = []
+        # Every output the block being journaled spent, between start_undo() and take_undo()
+        self.undo_spent = None
+        # block_undo rows at or below this height are pruned on the next flush
+        self.undo_prune_height = None
+        # (height, hash, outstanding, cumulative_difficulty) for chain_state, once there's a new tip to write
+        self.tip = None
+        # Highest block buffered since the last flush, and the height partitions are known to go up to
+        self.highest_height = None
+        self.partitions_end = None
+
+    @property
+    def rows(self):
+        return sum(len(buffer) for buffer in self.buffers.values()) + len(self.spent_stored_outputs)
+
+    def block(self, height, hash, version, prevhash, nexthash, merkleroot, time, bits, nonce, size, difficulty,
+              cumulative_difficulty, outstanding, value_out, transactions, transaction_fees):
+        self.buffers['blocks'].append((height, hash, version, prevhash, nexthash, merkleroot, time, bits, nonce, size,
+                                       difficulty, cumulative_difficulty, outstanding, value_out, transactions,
+                                       transaction_fees))
+        if self.highest_height is None or height > self.highest_height:
+            self.highest_height = height
+
+    def chain_tip(self, height, hash, outstanding, cumulative_difficulty):
+        self.tip = (height, hash, outstanding, cumulative_difficulty)
+
+    def tx(self, txid, block_height, size, n, version, locktime, total_out, total_in, fee):
+        self.buffers['txs'].append((txid, block_height, size, n, version, locktime, total_out, total_in, fee))
+
+    def coinbase_txin(self, block_height, txid, scriptsig, sequence, witness):
+        self.buffers['coinbasetxin'].append((block_height, txid, scriptsig, sequence, witness))
+
+    def txin(self, block_height, txid, n, scriptsig, sequence, witness, prevout_hash, prevout_n, address, value):
+        self.buffers['txin'].append((block_height, txid, n, scriptsig, sequence, witness, prevout_hash, prevout_n,
+                                     address, value))
+
+    def txout(self, block_height, txid, n, value, scriptpubkey, address, linked_txid, linked_txid_n, spent):
+        self.txout_positions[(txid, n)] = len(self.buffers['txout'])
+        self.buffers['txout'].append([block_height, txid, n, value, scriptpubkey, address, linked_txid,
+                                      linked_txid_n, spent])
+
+    def address(self, address, amount, n, block_height, balance, block_hash, the_time, transaction, input, output):
+        self.buffers['addresses'].append((address, amount, n, block_height, balance, block_hash, the_time,
+                                          transaction, input, output))
+
+    def block_undo(self, block_height, block_hash, address_summary, spent_outputs):
+        self.buffers['block_undo'].append((block_height, block_hash, json.dumps(address_summary, default=str),
+                                           json.dumps(spent_outputs)))
+        self.undo_prune_height = block_height - undo_depth
+
+    def start_undo(self):
+        self.undo_spent = []
+
+    def take_undo(self):
+        undo_spent, self.undo_spent = self.undo_spent, None
+        return undo_spent
+
+    def pending_output(self, txid, n):
+        # (value, address, block_height) of an output that's buffered but not written yet, or None.
+        position = self.txout_positions.get((txid, n))
+        if position is None:
+            return None
+        buffered_output = self.buffers['txout'][position]
+        return buffered_output[3], buffered_output[5], buffered_output[0]
+
+    def spend(self, txid, n, block_height, linked_txid, linked_txid_n):
+        if self.undo_spent is not None:
+            self.undo_spent.append((txid, n))
+        position = self.txout_positions.get((txid, n))
+        if position is None:
+            self.spent_stored_outputs.append((txid, n, block_height, linked_txid, linked_txid_n))
+        else:
+            buffered_output = self.buffers['txout'][position]
+            buffered_output[TXOUT_SPENT] = True
+            buffered_output[TXOUT_LINKED_TXID] = linked_txid
+            buffered_output[TXOUT_LINKED_TXID_N] = linked_txid_n
+
+    def flush(self):
+        self.address_ids.load({row[position] for table, position in ADDRESS_ID_COLUMNS.items()
+                               for row in self.buffers[table]})
+        copy_address_id = copy_address_ids(self.address_ids.ids)
+        if self.highest_height is not None and (self.partitions_end is None
+                                                or self.highest_height >= self.partitions_end):
+            self.partitions_end = ensure_partitions(self.db.session.connection(), self.highest_height)
+        self.highest_height = None
+        cursor = self.db.session.connection().connection.cursor()
+        for table in COPY_ORDER:
+            buffer = self.buffers[table]
+            if not buffer:
+                continue
+            copy_data = io.StringIO()
+            converters = COPY_CONVERTERS[table]
+            if table in ADDRESS_ID_COLUMNS:
+                converters = list(converters)
+                converters[ADDRESS_ID_COLUMNS[table]] = copy_address_id
+            for row in buffer:
+                copy_data.write('\t'.join([convert(the_value) for convert, the_value in zip(converters, row)]))
+                copy_data.write('\n')
+            copy_data.seek(0)
+            cursor.copy_expert(f"COPY {table} ({', '.join(COPY_COLUMNS[table])}) FROM STDIN", copy_data)
+            buffer.clear()
+        if self.spent_stored_outputs:
+            # With the output's block_height, each row only looks in the txout partition it's in
+            execute_values(cursor,
+                           "UPDATE txout SET spent = true, linked_txid = spent.linked_txid, "
+                           "linked_txid_n = spent.linked_txid_n "
+                           "FROM (VALUES %s) AS spent (txid, n, block_height, linked_txid, linked_txid_n) "
+                           "WHERE txout.block_height = spent.block_height AND txout.txid = spent.txid "
+                           "AND txout.n = spent.n",
+                           [(bytes.fromhex(txid), n, block_height, bytes.fromhex(linked_txid), linked_txid_n)
+                            for txid, n, block_height, linked_txid, linked_txid_n in self.spent_stored_outputs],
+                           template='(%s, %s, %s::integer, %s, %s)',
+                           page_size=1000)
+            self.spent_stored_outputs.clear()
+        if self.undo_prune_height is not None:
+            cursor.execute("DELETE FROM block_undo WHERE block_height <= %s", (self.undo_prune_height,))
+            self.undo_prune_height = None
+        if self.tip is not None:
+            height, hash, outstanding, cumulative_difficulty = self.tip
+            cursor.execute(CHAIN_STATE_UPSERT, (height, bytes.fromhex(hash), outstanding, cumulative_difficulty,
+                                                int(time.time())))
+            self.tip = None
+        cursor.close()
+        self.txout_positions.clear()
+
+    def clear(self):
+        for buffer in self.buffers.values():
+            buffer.clear()
+        self.spent_stored_outputs.clear()
+        self.txout_positions.clear()
+        self.undo_spent = None
+        self.undo_prune_height = None
+        self.tip = None
+        self.highest_height = None
+        # Partitions made in a transaction that then got rolled back are gone again
+        self.partitions_end = None
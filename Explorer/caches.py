@@ -0,0 +1,256 @@
+from collections import OrderedDict
+from sqlalchemy import func, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from config import address_cache_size, address_id_cache_size, prevout_cache_size
+from raw_block import coins_to_satoshis, output_addresses
+
+# What ingest puts in place of an address for outputs that don't have one, plus parallel_sync.py's placeholder
+# for an input whose prevout isn't known yet. Neither gets an address id, they're stored as NULL.
+NO_ADDRESS = frozenset(['nulldata', ''])
+ADDRESS_IDS_SELECT = text("SELECT address, id FROM address_ids WHERE address = ANY(:addresses)")
+# Sorted, so two parallel_sync.py workers adding some of the same addresses lock them in the same order.
+ADDRESS_IDS_INSERT = text("INSERT INTO address_ids (address) SELECT unnest(CAST(:addresses AS varchar[])) ORDER BY 1 "
+                          "ON CONFLICT (address) DO NOTHING RETURNING address, id")
+
+
+def stored_heights(db, txids):
+    # The heights these transactions are stored at, from txs, which isn't partitioned. Filtering txout on them
+    # as well lets PostgreSQL leave out every txout partition that can't hold the outputs, instead of probing the
+    # txid index of each one.
+    from models import TXs
+    return sorted({height for height, in db.session.query(TXs.block_height).filter(TXs.txid.in_(list(txids)))})
+
+
+class PrevoutResolver(object):
+    # Hands back (value, address, block_height) for the outputs a block's inputs spend.
+    # Outputs created recently are kept in an LRU, anything older comes out of txout in one query per block,
+    # and only what's in neither gets asked of the daemon (which is the only case still needing txindex=1).
+    def __init__(self, db, cryptocurrency, writer=None, max_size=prevout_cache_size):
+        self.db = db
+        self.cryptocurrency = cryptocurrency
+        # Outputs the BulkWriter is still holding aren't in txout yet.
+        self.writer = writer
+        self.max_size = max_size
+        self.recent = OrderedDict()
+
+    def remember(self, txid, n, value, address, block_height):
+        self.recent[(txid, n)] = (value, address, block_height)
+        self.recent.move_to_end((txid, n))
+        while len(self.recent) > self.max_size:
+            self.recent.popitem(last=False)
+
+    def clear(self):
+        self.recent.clear()
+
+    def resolve(self, outpoints):
+        from helpers import JSONRPCException
+        from models import AddressIds, TxOut
+        resolved = {}
+        missing = []
+        for outpoint in outpoints:
+            if outpoint in resolved:
+                continue
+            try:
+                # Once an output is spent it's very unlikely to come up again, so there's no reason to keep it.
+                resolved[outpoint] = self.recent.pop(outpoint)
+            except KeyError:
+                pending_output = None if self.writer is None else self.writer.pending_output(*outpoint)
+                if pending_output is None:
+                    missing.append(outpoint)
+                else:
+                    resolved[outpoint] = pending_output
+        # Chunked so a huge block doesn't turn into one enormous IN (...). Joined to address_ids rather than using
+        # TxOut.address, which would look each one up on its own.
+        stored_address = func.coalesce(AddressIds.address, 'nulldata').label('address')
+        for start in range(0, len(missing), 5000):
+            chunk = missing[start:start + 5000]
+            heights = stored_heights(self.db, {txid for txid, _ in chunk})
+            if not heights:
+                continue
+            stored_outputs = self.db.session.query(TxOut.txid, TxOut.n, TxOut.value, stored_address,
+                                                   TxOut.block_height).outerjoin(
+                AddressIds, AddressIds.id == TxOut.address_id).filter(
+                TxOut.block_height.in_(heights), tuple_(TxOut.txid, TxOut.n).in_(chunk)).all()
+            for stored_output in stored_outputs:
+                resolved[(stored_output.txid, stored_output.n)] = (stored_output.value, stored_output.address,
+                                                                   stored_output.block_height)
+        still_missing = [outpoint for outpoint in missing if outpoint not in resolved]
+        if still_missing:
+            if self.cryptocurrency is None:
+                raise KeyError(f"Prevout {still_missing[0][0]}:{still_missing[0][1]} isn't stored yet")
+            previous_txids = list(dict.fromkeys(txid for txid, _ in still_missing))
+            previous_transactions = {}
+            for txid, previous_tx in zip(previous_txids, self.cryptocurrency.batch_in_chunks(
+                    [('getrawtransaction', txid, 1) for txid in previous_txids])):
+                if isinstance(previous_tx, JSONRPCException):
+                    raise previous_tx
+                previous_transactions[txid] = previous_tx
+            # No height, since these aren't in txout for anything to mark spent. An output without an address is
+            # 'nulldata', same as ingest stores it.
+            for txid, n in still_missing:
+                this_prev_vout = previous_transactions[txid]['vout'][n]
+                the_addresses = output_addresses(this_prev_vout['scriptPubKey'])
+                resolved[(txid, n)] = (coins_to_satoshis(this_prev_vout['value']),
+                                       the_addresses[0] if the_addresses else 'nulldata', None)
+        return resolved
+
+
+class AddressIdCache(object):
+    # address -> its id in address_ids, for BulkWriter and AddressCache to write ids where ingest has addresses.
+    # New addresses are added on a connection of their own that commits straight away, so an id never has to be
+    # forgotten because the ingest transaction rolled back (address_ids only ever grows, and an id nothing uses is
+    # harmless), and parallel_sync.py's workers never wait on each other's long transactions for one.
+    def __init__(self, db, max_size=address_id_cache_size):
+        self.db = db
+        self.max_size = max_size
+        self.ids = OrderedDict()
+
+    def load(self, addresses):
+        missing = set()
+        for the_address in addresses:
+            if the_address in self.ids:
+                self.ids.move_to_end(the_address)
+            elif the_address not in NO_ADDRESS:
+                missing.add(the_address)
+        if not missing:
+            return
+        missing = sorted(missing)
+        with self.db.engine.connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            for start in range(0, len(missing), 5000):
+                chunk = missing[start:start + 5000]
+                self.ids.update(connection.execute(ADDRESS_IDS_SELECT, {'addresses': chunk}).all())
+                new_addresses = [the_address for the_address in chunk if the_address not in self.ids]
+                if new_addresses:
+                    self.ids.update(connection.execute(ADDRESS_IDS_INSERT, {'addresses': new_addresses}).all())
+                    # Whatever another worker added in the meantime didn't come back from the insert.
+                    raced = [the_address for the_address in new_addresses if the_address not in self.ids]
+                    if raced:
+                        self.ids.update(connection.execute(ADDRESS_IDS_SELECT, {'addresses': raced}).all())
+
+    def trim(self):
+        # Only between flushes, BulkWriter.flush() looks up everything it loaded.
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+
+class AddressCache(object):
+    # Write-behind copy of address_summary for the addresses ingest is touching.
+    # Each block's addresses are loaded in one query, every change after that happens here, and the changed rows
+    # go back as batched upserts when flush() runs right before a commit.
+    # Entries are [balance, transactions_in, received, transactions_out, sent], or None for an address that
+    # has no address_summary row (yet).
+    def __init__(self, db, max_size=address_cache_size):
+        self.db = db
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.dirty = set()
+        # address -> its entry from before the block being journaled, between start_undo() and take_undo()
+        self.undo = None
+
+    def load(self, addresses):
+        from models import AddressIds, AddressSummary
+        missing = [the_address for the_address in addresses
+                   if the_address not in self.entries and the_address not in NO_ADDRESS]
+        for the_address in addresses:
+            if the_address in self.entries:
+                self.entries.move_to_end(the_address)
+        for start in range(0, len(missing), 5000):
+            chunk = missing[start:start + 5000]
+            for the_address in chunk:
+                self.entries[the_address] = None
+            stored_summaries = self.db.session.query(AddressIds.address, AddressSummary.balance,
+                                                     AddressSummary.transactions_in, AddressSummary.received,
+                                                     AddressSummary.transactions_out, AddressSummary.sent).join(
+                AddressSummary, AddressSummary.address_id == AddressIds.id).filter(
+                AddressIds.address.in_(chunk)).all()
+            for summary in stored_summaries:
+                self.entries[summary.address] = [summary.balance, summary.transactions_in, summary.received,
+                                                 summary.transactions_out, summary.sent]
+
+    def known(self, the_address):
+        # Outputs without an address never get an address_summary row.
+        return self.entries.get(the_address) is not None
+
+    def journal(self, the_address, entry):
+        if self.undo is not None and the_address not in self.undo:
+            self.undo[the_address] = None if entry is None else list(entry)
+
+    def start_undo(self):
+        self.undo = {}
+
+    def take_undo(self):
+        undo, self.undo = self.undo, None
+        return undo
+
+    def receive(self, the_address, value):
+        entry = self.entries[the_address]
+        self.journal(the_address, entry)
+        if entry is None:
+            entry = [value, 1, value, 0, 0]
+            self.entries[the_address] = entry
+        else:
+            entry[0] += value
+            entry[1] += 1
+            entry[2] += value
+        self.dirty.add(the_address)
+        return entry[0]
+
+    def spend(self, the_address, value):
+        entry = self.entries[the_address]
+        self.journal(the_address, entry)
+        if entry is None:
+            entry = [-value, 0, 0, 1, value]
+            self.entries[the_address] = entry
+        else:
+            entry[0] -= value
+            entry[3] += 1
+            entry[4] += value
+        self.dirty.add(the_address)
+        return entry[0]
+
+    def flush(self, address_ids):
+        from models import AddressSummary
+        address_ids.load(self.dirty)
+        rows = [{'address_id': address_ids.ids[the_address],
+                 'balance': self.entries[the_address][0],
+                 'transactions_in': self.entries[the_address][1],
+                 'received': self.entries[the_address][2],
+                 'transactions_out': self.entries[the_address][3],
+                 'sent': self.entries[the_address][4]} for the_address in self.dirty]
+        for start in range(0, len(rows), 1000):
+            upsert = insert(AddressSummary).values(rows[start:start + 1000])
+            upsert = upsert.on_conflict_do_update(index_elements=[AddressSummary.address_id],
+                                                  set_={'balance': upsert.excluded.balance,
+                                                        'transactions_in': upsert.excluded.transactions_in,
+                                                        'received': upsert.excluded.received,
+                                                        'transactions_out': upsert.excluded.transactions_out,
+                                                        'sent': upsert.excluded.sent})
+            self.db.session.execute(upsert)
+        self.dirty.clear()
+
+    def restore(self, previous_summaries):
+        # Puts address_summary back the way undo records had it before their blocks. The rows to keep go out with
+        # the next flush(), the ones that didn't exist before get deleted straight away.
+        from models import AddressIds, AddressSummary
+        self.clear()
+        removed = [the_address for the_address, entry in previous_summaries.items() if entry is None]
+        for start in range(0, len(removed), 5000):
+            self.db.session.query(AddressSummary).filter(AddressSummary.address_id.in_(
+                select(AddressIds.id).where(AddressIds.address.in_(removed[start:start + 5000])))).delete(
+                synchronize_session=False)
+        for the_address, entry in previous_summaries.items():
+            # Undo records from before address ids can have a 'nulldata' entry, which has no row to go back to.
+            if entry is not None and the_address not in NO_ADDRESS:
+                self.entries[the_address] = [int(entry[0]), entry[1], int(entry[2]), entry[3], int(entry[4])]
+                self.dirty.add(the_address)
+
+    def trim(self):
+        # Only safe once whatever was dirty has been flushed and committed.
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.dirty.clear()
+        self.undo = None
@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+from collections import namedtuple
+import redis
+from sqlalchemy.sql import desc
+from config import chain_tip_ttl, redis_url
+from models import db, Blocks
+
+# cronjob.py publishes "height:hash" here after every commit that moves the tip, rollbacks included
+CHAIN_TIP_CHANNEL = 'cce:chain_tip'
+# Redis is left alone for this long after it couldn't be reached, by both sides
+REDIS_RETRY_SECONDS = 30
+
+Tip = namedtuple('Tip', ('height', 'hash', 'difficulty', 'time'))
+
+
+class ChainTip(object):
+    # The newest block, kept in memory by each app.py worker instead of every request asking the database for it.
+    # A thread subscribed to CHAIN_TIP_CHANNEL throws it away whenever cronjob.py announces a different one, and
+    # it's reloaded after chain_tip_ttl seconds regardless, in case Redis is down or an announcement was missed.
+    def __init__(self, url=redis_url, ttl=chain_tip_ttl):
+        self.url = url
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (Tip, time.monotonic() when it was loaded). Swapped whole, so the listener never needs the lock.
+        self.loaded = None
+        self.listener_pid = None
+
+    def get(self):
+        self.listen()
+        loaded = self.loaded
+        if loaded is None or time.monotonic() - loaded[1] >= self.ttl:
+            the_block = db.session.query(Blocks).order_by(desc(Blocks.height)).first()
+            loaded = (Tip(the_block.height, the_block.hash, the_block.difficulty, the_block.time), time.monotonic())
+            self.loaded = loaded
+        return loaded[0]
+
+    def announced(self, message):
+        loaded = self.loaded
+        if loaded is None or message.decode() != f"{loaded[0].height}:{loaded[0].hash}":
+            self.loaded = None
+
+    def listen(self):
+        # Started on first use rather than at import, so that each of gunicorn's forked workers gets its own.
+        if self.url is None or self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid != os.getpid():
+                self.listener_pid = os.getpid()
+                threading.Thread(target=self.subscribe, name='chain-tip', daemon=True).start()
+
+    def subscribe(self):
+        while True:
+            try:
+                pubsub = redis.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHAIN_TIP_CHANNEL)
+                # Whatever got announced while nothing was listening is lost
+                self.loaded = None
+                for message in pubsub.listen():
+                    self.announced(message['data'])
+            except redis.RedisError:
+                pass
+            time.sleep(REDIS_RETRY_SECONDS)
+
+
+class ChainTipAnnouncer(object):
+    # cronjob.py's (and first_run.py's) side of ChainTip. A publish that fails only means app.py's workers notice
+    # the new tip chain_tip_ttl later, so it never holds ingest up.
+    def __init__(self, url=redis_url):
+        self.client = None
+        if url is not None:
+            self.client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self.retry_at = 0
+
+    def announce(self, height, the_hash):
+        if self.client is None or time.monotonic() < self.retry_at:
+            return
+        try:
+            self.client.publish(CHAIN_TIP_CHANNEL, f"{height}:{the_hash}")
+        except redis.RedisError:
+            self.retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+chain_tip_announcer = ChainTipAnnouncer()
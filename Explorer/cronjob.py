@@ -1,18 +1,29 @@
+import argparse
 import logging
 import sys
+import time
 from pathlib import Path
 from flask import Flask
 from logging.handlers import RotatingFileHandler
 from psycopg2 import errors
-from sqlalchemy.sql import desc
 import blockchain
 from config import coin_name, rpcpassword, rpcport, rpcuser
-from config import database_uri
+from config import commit_every_blocks, database_uri, rpc_connect_timeout, rpc_read_timeout, undo_depth
+from config import follow_poll_seconds, follow_wait_seconds, follow_zmq_hashblock
 from sqlalchemy.exc import IntegrityError
-from helpers import bulk_of_first_run_or_cron, JSONRPC, pre_boogie
+from bulk_writer import BulkWriter
+from caches import AddressCache, PrevoutResolver
+from helpers import bulk_of_first_run_or_cron, commit_boundary, CommitPolicy, fill_in_nexthash, JSONRPC
+from helpers import chain_state, JSONRPCException, pre_boogie
+from indexes import missing_indexes
+from metrics import ingest_metrics
+from migrations import pending_migrations
 from models import db, Blocks
+from pipeline import BlockPrefetcher
+from reorg import find_fork, roll_back
 
-EXPECTED_TABLES = {'addresses', 'address_summary', 'blocks', 'coinbasetxin', 'txs', 'txout', 'txin'}
+EXPECTED_TABLES = {'addresses', 'address_ids', 'address_summary', 'blocks', 'block_undo', 'chain_state',
+                   'coinbasetxin', 'schema_migrations', 'txs', 'txout', 'txin'}
 UniqueViolation = errors.lookup('23505')
 DiskFull = errors.lookup('53100')
 
@@ -32,48 +43,188 @@ def create_app():
     return the_cronjob
 
 
-def lets_boogie(the_blocks, uniques, cryptocurrency):
-    outstanding_coins, total_cumulative_difficulty = pre_boogie(db, cryptocurrency, most_recent_stored_block)
-    for block_height in the_blocks:
+class IngestState(object):
+    # What lets_boogie carries from one block to the next. A run-once cronjob.py builds it once per run,
+    # --follow keeps the same one (caches and all) for as long as it's up.
+    def __init__(self, cryptocurrency, stored_block):
+        self.outstanding_coins, self.total_cumulative_difficulty = pre_boogie(db, cryptocurrency, stored_block)
+        self.writer = BulkWriter(db)
+        self.prevout_resolver = PrevoutResolver(db, cryptocurrency, self.writer)
+        self.address_cache = AddressCache(db)
+        self.commit_policy = CommitPolicy()
+        self.tip_height = stored_block
+        self.tip_hash = chain_state(db).tip_hash
+
+    def rolled_back(self, fork_block):
+        # The running totals as of the fork block, and nothing cached from the orphaned ones.
+        self.outstanding_coins = fork_block.outstanding
+        self.total_cumulative_difficulty = fork_block.cumulative_difficulty
+        self.tip_height = fork_block.height
+        self.tip_hash = fork_block.hash
+        self.writer.clear()
+        self.writer.chain_tip(fork_block.height, fork_block.hash, fork_block.outstanding,
+                              fork_block.cumulative_difficulty)
+        self.prevout_resolver.clear()
+
+
+def lets_boogie(the_blocks, uniques, cryptocurrency, ingest_state, chain_tip):
+    # Returns False if the daemon's chain stopped lining up with ours partway through, so catch_up() can roll back.
+    writer = ingest_state.writer
+    address_cache = ingest_state.address_cache
+    first_uncommitted_block = the_blocks[0]
+    try:
+        for block_height, fetched_block in BlockPrefetcher(cryptocurrency, uniques, the_blocks):
+            if fetched_block[0].get('previousblockhash') != ingest_state.tip_hash:
+                if first_uncommitted_block < block_height:
+                    commit_boundary(db, writer, address_cache)
+                    ingest_state.commit_policy.committed()
+                return False
+            with ingest_metrics.stage('block'):
+                ingest_state.outstanding_coins, ingest_state.total_cumulative_difficulty = bulk_of_first_run_or_cron(
+                    cronjob, db, uniques, cryptocurrency, block_height, chain_tip, ingest_state.outstanding_coins,
+                    ingest_state.total_cumulative_difficulty, ingest_state.prevout_resolver, address_cache, writer,
+                    fetched_block, keep_undo=chain_tip - block_height < undo_depth)
+            ingest_state.tip_height = block_height
+            ingest_state.tip_hash = fetched_block[0]['hash']
+            # A long catch-up after downtime batches like first_run.py does,
+            # but near the tip every block gets committed (and shows up on the site) on its own.
+            if (ingest_state.commit_policy.block_added(writer.rows + len(address_cache.dirty))
+                    or chain_tip - block_height < commit_every_blocks):
+                commit_boundary(db, writer, address_cache)
+                ingest_state.commit_policy.committed()
+                if first_uncommitted_block == block_height:
+                    cronjob.logger.info(f"committed block {block_height}")
+                else:
+                    cronjob.logger.info(f"committed blocks {first_uncommitted_block} to {block_height}")
+                first_uncommitted_block = block_height + 1
+    except(IntegrityError, UniqueViolation) as e:
+        cronjob.logger.error(f"ERROR: {str(e)}")
+        db.session.rollback()
+        db.session.close()
+        sys.exit()
+    # If disk is full we can't log anything.. so, shutdown.
+    except DiskFull:
+        cronjob.logger.error(f"ERROR: Disk full! Shutting down..")
+        db.session.rollback()
+        db.session.close()
+        sys.exit()
+    return True
+
+
+def catch_up(uniques, cryptocurrency, ingest_state):
+    # Brings what's stored up to the daemon's tip, first rolling back whatever it reorged out.
+    while True:
         try:
-            outstanding_coins, total_cumulative_difficulty = bulk_of_first_run_or_cron(cronjob, db, uniques,
-                                                                                       cryptocurrency, block_height,
-                                                                                       most_recent_block,
-                                                                                       outstanding_coins,
-                                                                                       total_cumulative_difficulty)
-        except(IntegrityError, UniqueViolation) as e:
-            cronjob.logger.error(f"ERROR: {str(e)}")
-            db.session.rollback()
-            db.session.close()
-            sys.exit()
-        # If disk is full we can't log anything.. so, shutdown.
-        except DiskFull:
-            cronjob.logger.error(f"ERROR: Disk full! Shutting down..")
-            db.session.rollback()
-            db.session.close()
-            sys.exit()
-        else:
-            cronjob.logger.info(f"committed block {block_height}")
+            chain_tip = cryptocurrency.getblockcount()
+        except JSONRPCException as e:
+            cronjob.logger.error(f"Couldn't get the daemon's block count: {e}")
+            return
+        ingest_metrics.tips(node_tip=chain_tip, db_tip=ingest_state.tip_height)
+        try:
+            fork_height = find_fork(db, cryptocurrency, ingest_state.tip_height, ingest_state.tip_hash)
+        except JSONRPCException as e:
+            # The daemon went away between getblockcount and here. Same as getblockcount failing, try again later.
+            cronjob.logger.error(f"Couldn't check for a reorg: {e}")
+            return
+        if fork_height < ingest_state.tip_height:
+            cronjob.logger.info(f"Reorg: rolling back blocks {fork_height + 1} to {ingest_state.tip_height}")
+            with ingest_metrics.stage('rollback'):
+                fork_block = roll_back(db, ingest_state.address_cache, fork_height) if fork_height >= 0 else None
+            if fork_block is None:
+                cronjob.logger.error(f"Reorg goes deeper than the undo records (undo_depth = {undo_depth}). "
+                                     "Drop all and resync with first_run.py.")
+                db.session.rollback()
+                db.session.close()
+                sys.exit()
+            ingest_state.rolled_back(fork_block)
+            commit_boundary(db, ingest_state.writer, ingest_state.address_cache)
+            cronjob.logger.info(f"Rolled back to block {fork_height}")
+        if chain_tip <= ingest_state.tip_height:
+            return
+        fill_in_nexthash(db, cryptocurrency, db.session.get(Blocks, ingest_state.tip_hash))
+        if lets_boogie(range(ingest_state.tip_height + 1, chain_tip + 1), uniques, cryptocurrency, ingest_state,
+                       chain_tip):
+            return
+
+
+def zmq_hashblock_socket():
+    try:
+        import zmq
+    except ImportError:
+        cronjob.logger.error("follow_zmq_hashblock is set but pyzmq isn't installed. Long-polling instead.")
+        return None
+    hashblock_socket = zmq.Context.instance().socket(zmq.SUB)
+    hashblock_socket.setsockopt_string(zmq.SUBSCRIBE, 'hashblock')
+    hashblock_socket.connect(follow_zmq_hashblock)
+    return hashblock_socket
+
+
+def wait_for_block(waiting_rpc, hashblock_socket, block_height):
+    # Returns once block_height might exist, or after follow_wait_seconds regardless. The caller always checks
+    # getblockcount afterwards, so a missed notification only costs one wait.
+    if hashblock_socket is not None:
+        if hashblock_socket.poll(follow_wait_seconds * 1000):
+            # Several blocks at once (a reorg, or a burst) only need one look at the tip.
+            while hashblock_socket.poll(0):
+                hashblock_socket.recv_multipart()
+        return
+    try:
+        # Unlike waitfornewblock, this returns straight away if the block already showed up before we asked.
+        waiting_rpc.waitforblockheight(block_height, follow_wait_seconds * 1000)
+    except JSONRPCException:
+        # The daemon is down or restarting, or older than waitforblockheight (0.14). Either way, poll instead.
+        time.sleep(follow_poll_seconds)
+
+
+def follow(uniques, cryptocurrency, ingest_state):
+    # Stays up, keeping the connections, caches and running totals between blocks instead of
+    # rebuilding them every run, and indexes each block as soon as the daemon has it.
+    db.session.remove()
+    # Its own connection, with a read timeout long enough to sit in waitforblockheight.
+    waiting_rpc = JSONRPC(f"http://127.0.0.1:{rpcport}", rpcuser, rpcpassword,
+                          timeout=(rpc_connect_timeout, follow_wait_seconds + rpc_read_timeout))
+    hashblock_socket = zmq_hashblock_socket() if follow_zmq_hashblock else None
+    cronjob.logger.info(f"Following the chain from block {ingest_state.tip_height}")
+    while True:
+        catch_up(uniques, cryptocurrency, ingest_state)
+        wait_for_block(waiting_rpc, hashblock_socket, ingest_state.tip_height + 1)
 
 
 if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--follow', action='store_true',
+                                 help="Keep running and index each new block as the daemon gets it, "
+                                      "instead of catching up once and exiting")
+    arguments = argument_parser.parse_args()
     cronjob = create_app()
     cronjob.app_context().push()
+    # Migrations (and the tables added since first_run.py made this database) are first_run.py's job, since the
+    # bigger ones rewrite whole tables and shouldn't start unattended from cron. Checked before the indexes, since
+    # one that adds an index makes it look missing until it's run.
+    if pending_migrations(db.engine):
+        cronjob.logger.error("The database needs migrating. Run first_run.py and pick Continue first.")
+        sys.exit()
+    if missing_indexes(db.engine):
+        cronjob.logger.error("Some indexes haven't been built yet. Let first_run.py finish first.")
+        sys.exit()
 
     rpcurl = f"http://127.0.0.1:{rpcport}"
     crypto_currency = JSONRPC(rpcurl, rpcuser, rpcpassword)
 
-    most_recent_block = crypto_currency.getblockcount()
-
-    most_recent_stored_block = db.session.query(Blocks).order_by(desc('height')).first().height
-    db.session.remove()
+    most_recent_stored_block = chain_state(db).tip_height
 
     coin_name_in_config = coin_name.capitalize()
     the_coin = getattr(blockchain, coin_name_in_config)()
     the_uniques = the_coin.unique
 
-    if most_recent_stored_block != most_recent_block:
-        all_the_blocks = range(most_recent_stored_block + 1, most_recent_block + 1)
-        lets_boogie(all_the_blocks, the_uniques, crypto_currency)
+    the_ingest_state = IngestState(crypto_currency, most_recent_stored_block)
+    if arguments.follow:
+        try:
+            follow(the_uniques, crypto_currency, the_ingest_state)
+        except KeyboardInterrupt:
+            cronjob.logger.info("KeyboardInterrupt caught.")
+            db.session.rollback()
+            db.session.close()
+            sys.exit()
     else:
-        sys.exit()
+        catch_up(the_uniques, crypto_currency, the_ingest_state)
@@ -1,3 +1,4 @@
+import argparse
 import datetime
 import logging
 import sys
@@ -7,18 +8,28 @@ from logging.handlers import RotatingFileHandler
 from flask import Flask
 from psycopg2 import errors
 from sqlalchemy import create_engine, inspect
-from sqlalchemy.sql import desc
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import close_all_sessions
 import blockchain
 from blockchain import SUPPORTED_COINS
 from config import autodetect_config, autodetect_tables
-from config import coin_name, rpcpassword, rpcport, rpcuser
+from config import coin_name, rpcpassword, rpcport, rpcuser, undo_depth
 from config import app_key, csrf_key, database_uri
-from helpers import bulk_of_first_run_or_cron, JSONRPC, JSONRPCException, pre_boogie
-from models import db, Blocks
+from blk_files import BlockFiles
+from bulk_writer import BulkWriter
+from caches import AddressCache, PrevoutResolver
+from helpers import bulk_of_first_run_or_cron, commit_boundary, CommitPolicy, JSONRPC, JSONRPCException
+from helpers import pre_boogie, stored_tip_height
+from indexes import build_indexes, create_tables_without_indexes, INGEST_INDEXES, missing_indexes
+from metrics import ingest_metrics
+from migrations import migrate, stamp_migrations
+from models import db, BlockUndo, ChainState
+from parallel_sync import parallel_first_run
+from partitions import partition_names
+from pipeline import BlockPrefetcher
 
-EXPECTED_TABLES = {'addresses', 'address_summary', 'blocks', 'coinbasetxin', 'txs', 'txout', 'txin'}
+EXPECTED_TABLES = {'addresses', 'address_ids', 'address_summary', 'blocks', 'block_undo', 'chain_state',
+                   'coinbasetxin', 'schema_migrations', 'txs', 'txout', 'txin'}
 # https://www.postgresql.org/docs/current/errcodes-appendix.html#ERRCODES-TABLE
 UniqueViolation = errors.lookup('23505')
 DiskFull = errors.lookup('53100')
@@ -39,32 +50,53 @@ def create_app():
 
 def process_block(current_item):
     if current_item is not None:
-        return f'[{start_time}] Processing block {current_item} of {block_length}'
+        return f'[{start_time}] Processing block {current_item[0]} of {block_length}'
+
+
+def fetched_blocks(cryptocurrency, the_blocks):
+    if isinstance(cryptocurrency, BlockFiles):
+        return cryptocurrency.blocks(the_blocks)
+    return BlockPrefetcher(cryptocurrency, uniques, the_blocks)
 
 
 def lets_boogie(the_blocks, cryptocurrency, current_block):
     # These are returned here and in bulk_of_first_run_or_cron, because otherwise we'll need to run sql queries
     # every single block. Which drastically slows first_run / cron down.
     outstanding_coins, total_cumulative_difficulty = pre_boogie(db, cryptocurrency, current_block)
-    with click.progressbar(the_blocks, item_show_func=process_block) as progress_bar:
-        for block_height in progress_bar:
-            try:
-                outstanding_coins, total_cumulative_difficulty = bulk_of_first_run_or_cron(first_run_app, db, uniques,
-                                                                                           cryptocurrency, block_height,
-                                                                                           block_length,
-                                                                                           outstanding_coins,
-                                                                                           total_cumulative_difficulty)
-            # If disk is full we can't log anything.. so, shutdown.
-            except DiskFull:
-                first_run_app.logger.error(f"ERROR: Disk full! Shutting down..")
-                db.session.rollback()
-                db.session.close()
-                sys.exit()
-            except(IntegrityError, UniqueViolation) as e:
-                first_run_app.logger.error(f"ERROR: {str(e)}")
-                db.session.rollback()
-                db.session.close()
-                sys.exit()
+    writer = BulkWriter(db)
+    address_cache = AddressCache(db)
+    commit_policy = CommitPolicy()
+    if isinstance(cryptocurrency, BlockFiles):
+        # Every prevout is either already stored or still in the writer, and there's no daemon to fall back on.
+        prevout_resolver = PrevoutResolver(db, None, writer)
+    else:
+        prevout_resolver = PrevoutResolver(db, cryptocurrency, writer)
+    prefetched_blocks = fetched_blocks(cryptocurrency, the_blocks)
+    with click.progressbar(prefetched_blocks, item_show_func=process_block) as progress_bar:
+        try:
+            for block_height, fetched_block in progress_bar:
+                # The last undo_depth blocks get undo records, for cronjob.py to roll back with if they're reorged out.
+                keep_undo = most_recent_block - block_height < undo_depth
+                with ingest_metrics.stage('block'):
+                    outstanding_coins, total_cumulative_difficulty = bulk_of_first_run_or_cron(
+                        first_run_app, db, uniques, cryptocurrency, block_height, block_length, outstanding_coins,
+                        total_cumulative_difficulty, prevout_resolver, address_cache, writer, fetched_block,
+                        keep_undo)
+                if commit_policy.block_added(writer.rows + len(address_cache.dirty)):
+                    commit_boundary(db, writer, address_cache)
+                    commit_policy.committed()
+            commit_boundary(db, writer, address_cache)
+        # If disk is full we can't log anything.. so, shutdown.
+        except DiskFull:
+            first_run_app.logger.error(f"ERROR: Disk full! Shutting down..")
+            db.session.rollback()
+            db.session.close()
+            sys.exit()
+        except(IntegrityError, UniqueViolation) as e:
+            first_run_app.logger.error(f"ERROR: {str(e)}")
+            db.session.rollback()
+            db.session.close()
+            sys.exit()
 
 
 def detect_flask_config():
@@ -87,6 +119,8 @@ def detect_coin(cryptocurrency):
         if '401 Authorization Required' in str(e):
             first_run_app.logger.error("The rpcport is right but one or both these is wrong: rpcuser/rpcpassword.")
             first_run_app.logger.error("Go into config.py and fix this.")
+        else:
+            first_run_app.logger.error(f"Couldn't ask the daemon for the genesis block: {e}")
         sys.exit()
     else:
         if coin_name.capitalize() not in SUPPORTED_COINS:
@@ -116,23 +150,35 @@ def detect_coin(cryptocurrency):
             return the_coin.unique
 
 
-def detect_tables():
+def detect_tables(defer_indexes=False, keep_indexes=()):
     try:
         engine = create_engine(database_uri)
         inspector = inspect(engine)
-        detected_tables = set(inspector.get_table_names())
+        # Partitions of txin, txout and addresses are tables too, as far as the inspector's concerned.
+        with engine.connect() as connection:
+            detected_tables = set(inspector.get_table_names()).difference(partition_names(connection))
         engine.dispose()
         # TODO - The expected tables will change when segwit is supported.
         #  Though, obviously segwit won't be manipulated/added to if the specific chain doesn't support it.
         extra_tables_detected = detected_tables.difference(EXPECTED_TABLES)
         valid_tables_missing = EXPECTED_TABLES.difference(detected_tables)
         if len(detected_tables) == 0:
-            db.create_all()
+            if defer_indexes:
+                create_tables_without_indexes(db.engine, keep=keep_indexes)
+            else:
+                db.create_all()
+            # Made with today's models, so there's nothing for migrate() to do
+            stamp_migrations(db.engine)
         else:
             if len(extra_tables_detected) != 0:
                 first_run_app.logger.error('There were extra tables detected:')
                 first_run_app.logger.error(extra_tables_detected)
                 sys.exit()
+            elif valid_tables_missing and valid_tables_missing.issubset({'address_ids', 'block_undo', 'chain_state',
+                                                                         'schema_migrations'}):
+                # Tables added since this database was made. address_ids and schema_migrations come from migrate(),
+                # after Continue.
+                db.metadata.create_all(db.engine, tables=[BlockUndo.__table__, ChainState.__table__])
             elif len(valid_tables_missing) != 0:
                 first_run_app.logger.error('These expected tables are missing:')
                 first_run_app.logger.error(valid_tables_missing)
@@ -144,36 +190,80 @@ def detect_tables():
 
 
 if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--workers', type=int, default=1,
+                                 help="Load a from-scratch sync with this many processes, then work out balances, "
+                                      "fees and spent outputs in one pass at the end. The last undo_depth blocks are "
+                                      "loaded one at a time after that, to keep their undo records.")
+    argument_parser.add_argument('--defer-indexes', action='store_true',
+                                 help="Create the tables without their secondary indexes and build those once every "
+                                      "block is loaded. cronjob.py and the explorer won't start until they exist.")
+    argument_parser.add_argument('--blocks-dir',
+                                 help="Read blocks from the blk*.dat files in this directory (a daemon's "
+                                      "datadir/blocks, copied or with the daemon stopped) instead of over RPC")
+    arguments = argument_parser.parse_args()
+    if arguments.blocks_dir and arguments.workers > 1:
+        argument_parser.error("--blocks-dir reads the files in one process, so it can't be used with --workers")
     first_run_app = create_app()
     first_run_app.app_context().push()
 
     try:
         if autodetect_config:
             detect_flask_config()
-        try:
-            rpcurl = f"http://127.0.0.1:{rpcport}"
-            crypto_currency = JSONRPC(rpcurl, rpcuser, rpcpassword)
-        except(JSONRPCException, ValueError):
-            first_run_app.logger.error("One/all of these are wrong: rpcuser/rpcpassword/rpcport. Fix this in config.py")
-            sys.exit()
+        if arguments.blocks_dir:
+            # Nothing to auto-detect the coin from, so coin_name has to be right.
+            if coin_name.capitalize() not in SUPPORTED_COINS:
+                first_run_app.logger.error("--blocks-dir needs a supported coin_name set in config.py.")
+                sys.exit()
+            uniques = getattr(blockchain, coin_name.capitalize())().unique
+            try:
+                first_run_app.logger.info(f"Indexing the block files in {arguments.blocks_dir}")
+                crypto_currency = BlockFiles(arguments.blocks_dir, uniques)
+            except(OSError, ValueError) as e:
+                first_run_app.logger.error(f"Can't read blocks from {arguments.blocks_dir}: {str(e)}")
+                sys.exit()
+        else:
+            try:
+                rpcurl = f"http://127.0.0.1:{rpcport}"
+                crypto_currency = JSONRPC(rpcurl, rpcuser, rpcpassword)
+            except(JSONRPCException, ValueError):
+                first_run_app.logger.error("One/all of these are wrong: rpcuser/rpcpassword/rpcport. "
+                                           "Fix this in config.py")
+                sys.exit()
 
-        uniques = detect_coin(crypto_currency)
+            uniques = detect_coin(crypto_currency)
 
         if autodetect_tables:
-            detect_tables()
+            # With one process, the ingest needs INGEST_INDEXES to look up what each input spends.
+            detect_tables(arguments.defer_indexes, INGEST_INDEXES if arguments.workers == 1 else ())
 
-        most_recent_block = crypto_currency.getblockcount()
-        if most_recent_block is None:
+        try:
+            most_recent_block = crypto_currency.getblockcount()
+        except JSONRPCException:
             first_run_app.logger.error("Doesn't look like you have the daemon running. Fix this.")
             sys.exit()
+        ingest_metrics.tips(node_tip=most_recent_block)
         try:
-            most_recent_stored_block = db.session.query(Blocks).order_by(desc('height')).first().height
-        except AttributeError:
+            most_recent_stored_block = stored_tip_height(db)
+            if most_recent_stored_block is None:
+                raise LookupError
+        except LookupError:
             all_the_blocks = range(0, most_recent_block + 1)
             block_length = len(all_the_blocks)
             start_time = time.strftime('%Y/%m/%d - %H:%M:%S')
             # If most_recent_stored_block fails, that means nothing exists.
-            lets_boogie(all_the_blocks, crypto_currency, 0)
+            if arguments.workers > 1:
+                # The last undo_depth blocks go through lets_boogie() once the rest are in, so cronjob.py has their
+                # undo records to roll a reorg back with.
+                parallel_blocks = all_the_blocks[:max(len(all_the_blocks) - undo_depth, 0)]
+                if parallel_blocks:
+                    parallel_first_run(first_run_app, uniques, parallel_blocks, arguments.workers)
+                    ingest_indexes = [index for index in missing_indexes(db.engine) if index.name in INGEST_INDEXES]
+                    build_indexes(db.engine, ingest_indexes, first_run_app.logger)
+                lets_boogie(all_the_blocks[len(parallel_blocks):], crypto_currency, len(parallel_blocks))
+            else:
+                lets_boogie(all_the_blocks, crypto_currency, 0)
+            build_indexes(db.engine, missing_indexes(db.engine), first_run_app.logger)
         except OperationalError as exception:
             if 'database' in str(exception) and 'does not exist' in str(exception):
                 first_run_app.logger.info("You'll need to follow the documentation to create the database.")
@@ -197,6 +287,10 @@ if __name__ == '__main__':
                             print(f'OperationError: {str(e_)}')
                     sys.exit()
                 elif user_input in ['c', 'continue']:
+                    # The session still has chain_state read (and locked against ALTER TABLE) from above.
+                    db.session.close()
+                    migrate(db.engine, first_run_app.logger,
+                            lambda the_blocks: fetched_blocks(crypto_currency, the_blocks))
                     break
                 elif user_input in ['e', 'exit', 'x', 'quit', 'leave']:
                     sys.exit()
@@ -206,10 +300,13 @@ if __name__ == '__main__':
                 all_the_blocks = range(most_recent_stored_block + 1, most_recent_block + 1)
                 block_length = most_recent_block
                 start_time = time.strftime('%Y/%m/%d - %H:%M:%S')
+                ingest_indexes = [index for index in missing_indexes(db.engine) if index.name in INGEST_INDEXES]
+                build_indexes(db.engine, ingest_indexes, first_run_app.logger)
                 lets_boogie(all_the_blocks, crypto_currency, block_length)
             else:
                 first_run_app.logger.info("Looks like you're all up-to-date")
-                sys.exit()
+            # Picks up where an interrupted --defer-indexes run left off.
+            build_indexes(db.engine, missing_indexes(db.engine), first_run_app.logger)
     except KeyboardInterrupt:
         first_run_app.logger.info("KeyboardInterrupt caught.")
         db.session.rollback()
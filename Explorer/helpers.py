@@ -1,7 +1,23 @@
 import datetime
 import decimal
+import itertools
 import json
+import logging
+import string
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bulk_writer import BulkWriter
+from caches import AddressCache, NO_ADDRESS, PrevoutResolver
+from chain_tip import chain_tip_announcer
+from config import rpc_backoff_factor, rpc_batch_size, rpc_connect_timeout, rpc_pool_size, rpc_read_timeout
+from config import commit_every_blocks, commit_every_rows, commit_every_seconds, raw_block_fetch, rpc_retries
+from metrics import ingest_metrics
+from raw_block import (coins_to_satoshis, deserialize_block, output_addresses, RawFormatError, RIPEMD160_AVAILABLE,
+                       verbose_block)
+
+logger = logging.getLogger(__name__)
 
 # This is a placeholder to indicate the transaction is empty
 EMPTY = []
@@ -15,41 +31,168 @@ def chain_age(timestamp, genesis_time):
     return f"{difference_in_days:.2f}"
 
 
+def is_hex_hash(the_string):
+    # Anything else can't be in a hash column, and won't convert to bytes to look for it there.
+    return len(the_string) == 64 and all(character in string.hexdigits for character in the_string)
+
+
+def hash_prefix_range(prefix):
+    # The lowest and highest hash starting with these hex digits, so finding them is a range scan of the hash
+    # column's own index.
+    return prefix.ljust(64, '0'), prefix.ljust(64, 'f')
+
+
+def format_satoshis(satoshis):
+    # Amounts are stored as integer satoshis, this is the only place they turn back into coins.
+    coins, remainder = divmod(abs(satoshis), 100000000)
+    return f"{'-' if satoshis < 0 else ''}{coins}.{remainder:08d}"
+
+
 def pre_boogie(db, cryptocurrency, block_height):
-    from sqlalchemy.sql import desc
     from models import Blocks
     if block_height == 0:
         total_cumulative_difficulty = decimal.Decimal(0.0)
-        outstanding_coins = decimal.Decimal(0.0)
+        outstanding_coins = 0
     else:
-        total_cumulative_difficulty = db.session.query(Blocks).order_by(
-            desc('cumulative_difficulty')).first().cumulative_difficulty
-        outstanding_coins = db.session.query(Blocks).order_by(
-            desc('outstanding')).first().outstanding
-        current_block = db.session.query(Blocks).order_by(desc('height')).first()
-        if current_block.nexthash == 'PLACEHOLDER':
-            try:
-                next_block_hash = cryptocurrency.getblockhash(current_block.height + 1)
-                current_block.nexthash = next_block_hash
-                db.session.commit()
-            # next_block_hash fails because we're already at the most recently block.
-            except JSONRPCException:
-                pass
+        the_chain_state = chain_state(db)
+        total_cumulative_difficulty = the_chain_state.cumulative_difficulty
+        outstanding_coins = the_chain_state.outstanding
+        current_block = db.session.get(Blocks, the_chain_state.tip_hash)
+        fill_in_nexthash(db, cryptocurrency, current_block)
     return outstanding_coins, total_cumulative_difficulty
 
 
-def bulk_of_first_run_or_cron(name_of_flask_app, db, uniques, cryptocurrency, block_height, total_blocks,
-                              outstanding_coins, total_cumulative_difficulty):
-    from models import Addresses, AddressSummary, Blocks, CoinbaseTXIn, TXIn, TXs, TxOut
-    total_value_out = decimal.Decimal(0.0)
-    total_value_out_sans_coinbase = decimal.Decimal(0.0)
-    tx_value_out = decimal.Decimal(0.0)
-    tx_value_in = decimal.Decimal(0.0)
-    prev_out_total_out = decimal.Decimal(0.0)
-    prev_out_total_out_with_fees = decimal.Decimal(0.0)
-    block_total_fees = decimal.Decimal(0.0)
+def chain_state(db):
+    # Where ingest has got to, or None for an empty database.
+    # A database from before chain_state existed gets it worked out the slow way, until the next commit stores it.
+    from sqlalchemy.sql import desc
+    from models import Blocks, ChainState
+    the_chain_state = db.session.get(ChainState, 1)
+    if the_chain_state is None:
+        tip_block = db.session.query(Blocks).order_by(desc('height')).first()
+        if tip_block is None:
+            return None
+        the_chain_state = ChainState(id=1,
+                                     tip_height=tip_block.height,
+                                     tip_hash=tip_block.hash,
+                                     outstanding=db.session.query(Blocks).order_by(
+                                         desc('outstanding')).first().outstanding,
+                                     cumulative_difficulty=db.session.query(Blocks).order_by(
+                                         desc('cumulative_difficulty')).first().cumulative_difficulty,
+                                     committed_at=0)
+    return the_chain_state
+
+
+def stored_tip_height(db):
+    # Same height chain_state() gives, or None, without reading any column a pending migration might change.
+    from sqlalchemy.sql import func
+    from models import Blocks, ChainState
+    tip_height = db.session.query(ChainState.tip_height).filter(ChainState.id == 1).scalar()
+    if tip_height is None:
+        tip_height = db.session.query(func.max(Blocks.height)).scalar()
+    return tip_height
+
+
+def fill_in_nexthash(db, cryptocurrency, current_block):
+    # The stored tip was written before the block after it existed.
+    if current_block.nexthash == 'PLACEHOLDER':
+        try:
+            next_block_hash = cryptocurrency.getblockhash(current_block.height + 1)
+            current_block.nexthash = next_block_hash
+            db.session.commit()
+        # next_block_hash fails because we're already at the most recently block.
+        except JSONRPCException:
+            pass
+
+
+def fetch_block(cryptocurrency, uniques, block_height):
+    # Everything a block needs from the daemon, in a handful of batched requests instead of one
+    # getrawtransaction per transaction. Prevouts are left to PrevoutResolver.
     block_raw_hash = cryptocurrency.getblockhash(block_height)
+    if raw_block_fetch and RIPEMD160_AVAILABLE and uniques.get('raw_blocks'):
+        # The serialized block plus its header (for height, next hash and difficulty): two items in one request,
+        # and nothing for the daemon to render.
+        raw_block_hex, block_header = cryptocurrency.batch([('getblock', block_raw_hash, False),
+                                                            ('getblockheader', block_raw_hash)])
+        if not isinstance(raw_block_hex, JSONRPCException) and not isinstance(block_header, JSONRPCException):
+            try:
+                with ingest_metrics.stage('decode'):
+                    return verbose_block(deserialize_block(bytes.fromhex(raw_block_hex), uniques), block_header,
+                                         uniques)
+            except RawFormatError:
+                pass
     the_block = cryptocurrency.getblock(block_raw_hash)
+    # Woodcoin's genesis transaction (and anything else in uniques['tx']) can't be fetched, so don't ask.
+    wanted_txids = [txid for txid in the_block['tx'] if txid not in uniques['tx']]
+    raw_transactions = {}
+    for txid, raw_tx in zip(wanted_txids, cryptocurrency.batch_in_chunks(
+            [('getrawtransaction', txid, 1) for txid in wanted_txids])):
+        # A transaction the daemon can't give us gets skipped, same as before.
+        if not isinstance(raw_tx, JSONRPCException):
+            for vout in raw_tx['vout']:
+                vout['value'] = coins_to_satoshis(vout['value'])
+                the_addresses = output_addresses(vout['scriptPubKey'])
+                if the_addresses:
+                    vout['scriptPubKey']['addresses'] = the_addresses
+            raw_transactions[txid] = raw_tx
+    return the_block, raw_transactions
+
+
+def resolve_block_prevouts(prevout_resolver, raw_transactions, block_height):
+    # This block's own outputs go in first, since a later transaction in the block can spend an earlier one.
+    spent_outpoints = []
+    for txid, raw_tx in raw_transactions.items():
+        for vout in raw_tx['vout']:
+            try:
+                the_address = vout['scriptPubKey']['addresses'][0]
+            except KeyError:
+                the_address = 'nulldata'
+            prevout_resolver.remember(txid, vout['n'], vout['value'], the_address, block_height)
+        for vin in raw_tx['vin']:
+            if 'coinbase' not in vin:
+                spent_outpoints.append((vin['txid'], vin['vout']))
+    return prevout_resolver.resolve(spent_outpoints)
+
+
+def block_addresses(raw_transactions, prevouts):
+    the_addresses = set(prevout_address for _, prevout_address, _ in prevouts.values())
+    for raw_tx in raw_transactions.values():
+        for vout in raw_tx['vout']:
+            try:
+                the_addresses.add(vout['scriptPubKey']['addresses'][0])
+            except KeyError:
+                pass
+    return the_addresses
+
+
+def bulk_of_first_run_or_cron(name_of_flask_app, db, uniques, cryptocurrency, block_height, total_blocks,
+                              outstanding_coins, total_cumulative_difficulty, prevout_resolver=None,
+                              address_cache=None, writer=None, fetched_block=None, keep_undo=False):
+    total_value_out = 0
+    total_value_out_sans_coinbase = 0
+    tx_value_out = 0
+    tx_value_in = 0
+    prev_out_total_out = 0
+    prev_out_total_out_with_fees = 0
+    block_total_fees = 0
+    # fetched_block is fetch_block()'s result when a BlockPrefetcher already got it.
+    if fetched_block is None:
+        fetched_block = fetch_block(cryptocurrency, uniques, block_height)
+    the_block, raw_transactions = fetched_block
+    if writer is None:
+        writer = BulkWriter(db)
+    if prevout_resolver is None:
+        prevout_resolver = PrevoutResolver(db, cryptocurrency, writer)
+    with ingest_metrics.stage('prevouts'):
+        prevouts = resolve_block_prevouts(prevout_resolver, raw_transactions, block_height)
+    if address_cache is None:
+        address_cache = AddressCache(db)
+    with ingest_metrics.stage('address_lookup'):
+        address_cache.load(block_addresses(raw_transactions, prevouts))
+    # Near the tip, keep what's needed to roll this block back if it gets reorged out (see reorg.py).
+    if keep_undo:
+        address_cache.start_undo()
+        writer.start_undo()
     raw_block_transactions = the_block['tx']
     how_many_transactions = len(raw_block_transactions)
     coinbase_captured = False
@@ -57,8 +200,8 @@ def bulk_of_first_run_or_cron(name_of_flask_app, db, uniques, cryptocurrency, bl
     # block_confirmations = cryptocurrency.getblockcount() + 1 - block_height
     for number, this_transaction in enumerate(raw_block_transactions):
         try:
-            raw_block_tx = cryptocurrency.getrawtransaction(this_transaction, 1)
-        except JSONRPCException as e:
+            raw_block_tx = raw_transactions[this_transaction]
+        except KeyError:
             pass
             # if 'No information available about transaction' in str(e):
             # TODO - Add something to indicate this transaction is unavailable
@@ -82,234 +225,300 @@ def bulk_of_first_run_or_cron(name_of_flask_app, db, uniques, cryptocurrency, bl
                             coinbase_captured = True
                     except KeyError:
                         # TODO - Setting address to 'nulldata' here is wrong
-                        commit_transaction_out = TxOut(block_height=block_height,
-                                                       txid=this_transaction,
-                                                       n=vout['n'],
-                                                       value=vout['value'],
-                                                       scriptpubkey=vout['scriptPubKey']['asm'],
-                                                       address='nulldata',
-                                                       linked_txid=None,
-                                                       linked_txid_n=None,
-                                                       spent=False)
-                        db.session.add(commit_transaction_out)
+                        writer.txout(block_height=block_height,
+                                     txid=this_transaction,
+                                     n=vout['n'],
+                                     value=vout['value'],
+                                     scriptpubkey=vout['scriptPubKey']['hex'],
+                                     address='nulldata',
+                                     linked_txid=None,
+                                     linked_txid_n=None,
+                                     spent=False)
                     else:
-                        address_summary_lookup = db.session.query(AddressSummary).filter_by(
-                            address=the_address).one_or_none()
-                        if address_summary_lookup is None:
-                            commit_address_transaction_output = Addresses(address=the_address,
-                                                                          amount=vout['value'],
-                                                                          n=vout['n'],
-                                                                          block_height=block_height,
-                                                                          balance=vout['value'],
-                                                                          block_hash=the_block['hash'],
-                                                                          the_time=the_block['time'],
-                                                                          transaction=this_transaction,
-                                                                          input=False,
-                                                                          output=True)
-                            db.session.add(commit_address_transaction_output)
-                            address_summary = AddressSummary(address=the_address,
-                                                             balance=vout['value'],
-                                                             transactions_in=1,
-                                                             received=vout['value'],
-                                                             transactions_out=0,
-                                                             sent=decimal.Decimal(0.00000000))
-                            db.session.add(address_summary)
-                        else:
-                            the_balance = address_summary_lookup.balance
-                            commit_address_transaction_output = Addresses(address=the_address,
-                                                                          amount=vout['value'],
-                                                                          n=vout['n'],
-                                                                          block_height=block_height,
-                                                                          balance=the_balance + vout['value'],
-                                                                          block_hash=the_block['hash'],
-                                                                          the_time=the_block['time'],
-                                                                          transaction=this_transaction,
-                                                                          input=False,
-                                                                          output=True)
-                            db.session.add(commit_address_transaction_output)
-                            address_summary_lookup.balance += vout['value']
-                            address_summary_lookup.transactions_in += 1
-                            address_summary_lookup.received += vout['value']
-                            db.session.add(address_summary_lookup)
+                        the_new_balance = address_cache.receive(the_address, vout['value'])
+                        writer.address(address=the_address,
+                                       amount=vout['value'],
+                                       n=vout['n'],
+                                       block_height=block_height,
+                                       balance=the_new_balance,
+                                       block_hash=the_block['hash'],
+                                       the_time=the_block['time'],
+                                       transaction=this_transaction,
+                                       input=False,
+                                       output=True)
                         ###
                         tx_value_out += vout['value']
-                        commit_transaction_out = TxOut(block_height=block_height,
-                                                       txid=this_transaction,
-                                                       n=vout['n'],
-                                                       value=vout['value'],
-                                                       scriptpubkey=vout['scriptPubKey']['asm'],
-                                                       address=the_address,
-                                                       linked_txid=None,
-                                                       linked_txid_n=None,
-                                                       spent=False)
-                        db.session.add(commit_transaction_out)
+                        writer.txout(block_height=block_height,
+                                     txid=this_transaction,
+                                     n=vout['n'],
+                                     value=vout['value'],
+                                     scriptpubkey=vout['scriptPubKey']['hex'],
+                                     address=the_address,
+                                     linked_txid=None,
+                                     linked_txid_n=None,
+                                     spent=False)
                     # 'nulldata' still has a value, even if it's 0, so this doesn't go in the try/except/else
                     total_value_out += vout['value']
                 for vin_num, vin in enumerate(raw_block_tx['vin']):
                     if number == 0 and vin_num == 0:
-                        commit_coinbase = CoinbaseTXIn(block_height=block_height,
-                                                       txid=this_transaction,
-                                                       scriptsig=vin['coinbase'],
-                                                       sequence=vin['sequence'],
-                                                       # TODO - This needs pulled from bootstrap
-                                                       # TODO - Witness actually needs supported
-                                                       witness=None)
-                        db.session.add(commit_coinbase)
+                        writer.coinbase_txin(block_height=block_height,
+                                             txid=this_transaction,
+                                             scriptsig=vin['coinbase'],
+                                             sequence=vin['sequence'],
+                                             # TODO - This needs pulled from bootstrap
+                                             # TODO - Witness actually needs supported
+                                             witness=None)
                     else:
-                        previous_transaction = cryptocurrency.getrawtransaction(vin['txid'], 1)
-                        prev_txid = previous_transaction['txid']
-                        this_prev_vin = previous_transaction['vout'][vin['vout']]
-                        the_prevout_n = this_prev_vin['n']
-                        prevout_value = this_prev_vin['value']
+                        prev_txid = vin['txid']
+                        the_prevout_n = vin['vout']
+                        prevout_value, prevout_address, prevout_block_height = prevouts[(prev_txid, the_prevout_n)]
                         prev_out_total_out += prevout_value
                         tx_value_in += prevout_value
-                        prevout_address = this_prev_vin['scriptPubKey']['addresses'][0]
-
-                        address_summary_lookup = db.session.query(AddressSummary).filter_by(
-                            address=prevout_address).one_or_none()
-                        if address_summary_lookup is not None:
-                            the_new_balance = address_summary_lookup.balance - prevout_value
-                            commit_address_transaction_input = Addresses(address=prevout_address,
-                                                                         amount=-prevout_value,
-                                                                         n=vin_num,
-                                                                         block_height=block_height,
-                                                                         balance=the_new_balance,
-                                                                         block_hash=the_block['hash'],
-                                                                         the_time=the_block['time'],
-                                                                         transaction=this_transaction,
-                                                                         input=True,
-                                                                         output=False)
-                            db.session.add(commit_address_transaction_input)
-
-                            address_summary_lookup.balance -= prevout_value
-                            address_summary_lookup.transactions_out += 1
-                            address_summary_lookup.sent += prevout_value
-                            db.session.add(address_summary_lookup)
-                        else:
+
+                        if address_cache.known(prevout_address):
+                            the_new_balance = address_cache.spend(prevout_address, prevout_value)
+                            writer.address(address=prevout_address,
+                                           amount=-prevout_value,
+                                           n=vin_num,
+                                           block_height=block_height,
+                                           balance=the_new_balance,
+                                           block_hash=the_block['hash'],
+                                           the_time=the_block['time'],
+                                           transaction=this_transaction,
+                                           input=True,
+                                           output=False)
+                        elif prevout_address not in NO_ADDRESS:
                             # This shouldn't be a thing, since it would cause a negative balance.
-                            commit_address_transaction_input = Addresses(address=prevout_address,
-                                                                         amount=-prevout_value,
-                                                                         n=vin_num,
-                                                                         block_height=block_height,
-                                                                         balance=-prevout_value,
-                                                                         block_hash=the_block['hash'],
-                                                                         the_time=the_block['time'],
-                                                                         transaction=this_transaction,
-                                                                         input=True,
-                                                                         output=False)
-                            address_summary = AddressSummary(address=prevout_address,
-                                                             balance=-prevout_value,
-                                                             transactions_in=0,
-                                                             received=decimal.Decimal(0.00000000),
-                                                             transactions_out=1,
-                                                             sent=prevout_value)
-                            db.session.add(address_summary)
-
-                        commit_transaction_in = TXIn(block_height=block_height,
-                                                     txid=this_transaction,
-                                                     n=number,
-                                                     scriptsig=vin['scriptSig']['asm'],
-                                                     sequence=vin['sequence'],
-                                                     # TODO - This needs pulled from bootstrap
-                                                     # TODO - Witness actually needs supported
-                                                     witness=None,
-                                                     prevout_hash=prev_txid,
-                                                     prevout_n=the_prevout_n,
-                                                     address=prevout_address,
-                                                     value=prevout_value)
-                        the_spent_transaction_out = db.session.query(TxOut).filter_by(txid=prev_txid,
-                                                                                      n=the_prevout_n).one_or_none()
-                        if the_spent_transaction_out is not None:
-                            the_spent_transaction_out.spent = True
-                            the_spent_transaction_out.linked_txid = this_transaction
-                            the_spent_transaction_out.linked_txid_n = vin_num
-                            db.session.add(the_spent_transaction_out)
-                        db.session.add(commit_transaction_in)
+                            address_cache.spend(prevout_address, prevout_value)
+
+                        writer.spend(txid=prev_txid,
+                                     n=the_prevout_n,
+                                     block_height=prevout_block_height,
+                                     linked_txid=this_transaction,
+                                     linked_txid_n=vin_num)
+                        writer.txin(block_height=block_height,
+                                    txid=this_transaction,
+                                    n=number,
+                                    scriptsig=vin['scriptSig']['hex'],
+                                    sequence=vin['sequence'],
+                                    # TODO - This needs pulled from bootstrap
+                                    # TODO - Witness actually needs supported
+                                    witness=None,
+                                    prevout_hash=prev_txid,
+                                    prevout_n=the_prevout_n,
+                                    address=prevout_address,
+                                    value=prevout_value)
                 tx_total_fees = prev_out_total_out - total_value_out_sans_coinbase
                 outstanding_coins -= tx_total_fees
                 block_total_fees += tx_total_fees
-                the_tx = TXs(txid=this_transaction,
-                             block_height=block_height,
-                             size=raw_block_tx['size'],
-                             n=number,
-                             version=raw_block_tx['version'],
-                             locktime=raw_block_tx['locktime'],
-                             total_out=tx_value_out,
-                             total_in=tx_value_in,
-                             fee=tx_total_fees)
-                db.session.add(the_tx)
-                prev_out_total_out = decimal.Decimal(0.0)
-                total_value_out_sans_coinbase = decimal.Decimal(0.0)
-                tx_value_out = decimal.Decimal(0.0)
-                tx_value_in = decimal.Decimal(0.0)
+                writer.tx(txid=this_transaction,
+                          block_height=block_height,
+                          size=raw_block_tx['size'],
+                          n=number,
+                          version=raw_block_tx['version'],
+                          locktime=raw_block_tx['locktime'],
+                          total_out=tx_value_out,
+                          total_in=tx_value_in,
+                          fee=tx_total_fees)
+                prev_out_total_out = 0
+                total_value_out_sans_coinbase = 0
+                tx_value_out = 0
+                tx_value_in = 0
     # block_height == 0
+    # The daemon leaves nextblockhash out at its tip, which with several blocks per commit would otherwise throw
+    # away the whole batch.
     if block_height == 0:
         prev_block_hash = uniques['genesis']['prev_hash']
-        next_block_hash = the_block['nextblockhash']
+        next_block_hash = the_block.get('nextblockhash', 'PLACEHOLDER')
     # block_height is inbetween 0 and total_blocks
     elif total_blocks > block_height > 0:
         prev_block_hash = the_block['previousblockhash']
-        next_block_hash = the_block['nextblockhash']
+        next_block_hash = the_block.get('nextblockhash', 'PLACEHOLDER')
     # block_height == total_blocks
     else:
         prev_block_hash = the_block['previousblockhash']
         next_block_hash = 'PLACEHOLDER'
     total_cumulative_difficulty += decimal.Decimal(the_block['difficulty'])
-    this_blocks_info = Blocks(height=the_block['height'],
-                              hash=the_block['hash'],
-                              version=the_block['version'],
-                              prevhash=prev_block_hash,
-                              nexthash=next_block_hash,
-                              merkleroot=the_block['merkleroot'],
-                              time=the_block['time'],
-                              bits=the_block['bits'],
-                              nonce=the_block['nonce'],
-                              size=the_block['size'],
-                              difficulty=decimal.Decimal(the_block['difficulty']),
-                              cumulative_difficulty=total_cumulative_difficulty,
-                              outstanding=outstanding_coins,
-                              value_out=total_value_out,
-                              transactions=how_many_transactions,
-                              transaction_fees=block_total_fees)
-    db.session.add(this_blocks_info)
-    db.session.commit()
-    db.session.close()
+    writer.block(height=the_block['height'],
+                 hash=the_block['hash'],
+                 version=the_block['version'],
+                 prevhash=prev_block_hash,
+                 nexthash=next_block_hash,
+                 merkleroot=the_block['merkleroot'],
+                 time=the_block['time'],
+                 bits=the_block['bits'],
+                 nonce=the_block['nonce'],
+                 size=the_block['size'],
+                 difficulty=decimal.Decimal(the_block['difficulty']),
+                 cumulative_difficulty=total_cumulative_difficulty,
+                 outstanding=outstanding_coins,
+                 value_out=total_value_out,
+                 transactions=how_many_transactions,
+                 transaction_fees=block_total_fees)
+    writer.chain_tip(the_block['height'], the_block['hash'], outstanding_coins, total_cumulative_difficulty)
+    if keep_undo:
+        writer.block_undo(block_height, the_block['hash'], address_cache.take_undo(), writer.take_undo())
+    ingest_metrics.count('blocks')
     return outstanding_coins, total_cumulative_difficulty
 
 
+def commit_boundary(db, writer, address_cache):
+    # Everything since the last commit goes out in one transaction, chain_state included, so a restart always
+    # resumes from a whole block and pre_boogie's totals line up with what's stored.
+    # flush() hands chain_state its tip and forgets it
+    tip = writer.tip
+    if ingest_metrics.enabled:
+        ingest_metrics.count('rows', writer.rows + len(address_cache.dirty))
+        if tip is not None:
+            ingest_metrics.tips(db_tip=tip[0])
+    with ingest_metrics.stage('flush'):
+        writer.flush()
+    with ingest_metrics.stage('address_flush'):
+        address_cache.flush(writer.address_ids)
+    with ingest_metrics.stage('commit'):
+        db.session.commit()
+    if tip is not None:
+        chain_tip_announcer.announce(tip[0], tip[1])
+    address_cache.trim()
+    writer.address_ids.trim()
+    db.session.close()
+    ingest_metrics.write()
+
+
+class CommitPolicy(object):
+    # Commit every N blocks, every T seconds or every M buffered rows, whichever comes first.
+    def __init__(self, every_blocks=commit_every_blocks, every_seconds=commit_every_seconds,
+                 every_rows=commit_every_rows):
+        self.every_blocks = every_blocks
+        self.every_seconds = every_seconds
+        self.every_rows = every_rows
+        self.blocks_since_commit = 0
+        self.last_commit = time.monotonic()
+
+    def block_added(self, pending_rows):
+        self.blocks_since_commit += 1
+        return (self.blocks_since_commit >= self.every_blocks
+                or pending_rows >= self.every_rows
+                or time.monotonic() - self.last_commit >= self.every_seconds)
+
+    def committed(self):
+        self.blocks_since_commit = 0
+        self.last_commit = time.monotonic()
+
+
+def rpc_session(rpc_user, rpc_password):
+    # One keep-alive connection pool per daemon, instead of a new TCP connection (and ephemeral port) per call.
+    # urllib3's pool is thread-safe, and under gunicorn's gevent worker its queue is greenlet-safe too.
+    # pool_block=True makes rpc_pool_size a hard cap: extra callers wait for a free connection rather than
+    # opening throwaway ones that get closed straight after, which is what was exhausting ports.
+    retries = Retry(total=rpc_retries,
+                    connect=rpc_retries,
+                    # A read timeout means the daemon is busy with it, asking again just doubles the wait.
+                    read=False,
+                    # bitcoind answers 503 when its RPC work queue is full, that one is worth another try.
+                    status=rpc_retries,
+                    status_forcelist=(503,),
+                    # Everything we send is a read-only getter, so retrying the POST is safe.
+                    allowed_methods=frozenset(['POST']),
+                    backoff_factor=rpc_backoff_factor,
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=rpc_pool_size, max_retries=retries, pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = (rpc_user, rpc_password)
+    session.headers.update({'Content-type': 'application/json'})
+    return session
+
+
 class JSONRPC(object):
-    __id_count = 0
+    # itertools.count because prefetch workers share one JSONRPC, and `+= 1` on a class attribute isn't atomic.
+    __id_count = itertools.count(1)
 
-    def __init__(self, url, rpc_user, rpc_password, rpc_method=None, timeout=30):
+    def __init__(self, url, rpc_user, rpc_password, rpc_method=None, timeout=None, session=None):
         self.__url = url
         self.__user = rpc_user
         self.__password = rpc_password
         self.__method_name = rpc_method
+        if timeout is None:
+            timeout = (rpc_connect_timeout, rpc_read_timeout)
         self.__timeout = timeout
+        # Every JSONRPC made through __getattr__ shares the session of the one that made it.
+        if session is None:
+            session = rpc_session(rpc_user, rpc_password)
+        self.__session = session
 
     def __getattr__(self, method_name):
-        return JSONRPC(self.__url, self.__user, self.__password, method_name, timeout=self.__timeout)
+        return JSONRPC(self.__url, self.__user, self.__password, method_name, timeout=self.__timeout,
+                       session=self.__session)
+
+    def batch(self, calls):
+        # calls is a list of (method_name, *params) tuples. They all go out in one POST as a JSON array,
+        # and the results come back in the same order as the calls. An item the daemon refused is returned
+        # as a JSONRPCException in its place instead of being raised, so one bad call doesn't lose the rest.
+        if not calls:
+            return []
+        postdata = []
+        positions = {}
+        for position, (method_name, *params) in enumerate(calls):
+            request_id = next(JSONRPC.__id_count)
+            positions[request_id] = position
+            postdata.append({'version': '1.1', 'method': method_name,
+                             'params': params, 'id': request_id})
+        try:
+            # A batch of mixed calls is timed under all of their names, e.g. getblock+getblockheader
+            with ingest_metrics.rpc('+'.join(dict.fromkeys(each_call[0] for each_call in calls))):
+                response = self.__session.post(self.__url,
+                                               data=json.dumps(postdata),
+                                               timeout=self.__timeout)
+                response = response.json(parse_float=decimal.Decimal)
+        except Exception as e:
+            raise JSONRPCException({'code': -344,
+                                    'message': f'JSON-RPC batch request failed: {e}'})
+        # A batch the daemon couldn't parse at all comes back as a single error object.
+        if isinstance(response, dict):
+            raise JSONRPCException(response.get('error') or {'code': -343,
+                                                             'message': 'missing JSON-RPC result'})
+        results = [JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})] * len(calls)
+        # bitcoind answers in order, but the spec doesn't promise it, so match on id.
+        for each_response in response:
+            position = positions.get(each_response.get('id'))
+            if position is None:
+                continue
+            if each_response.get('error') is not None:
+                results[position] = JSONRPCException(each_response['error'])
+            elif 'result' in each_response:
+                results[position] = each_response['result']
+        return results
+
+    def batch_in_chunks(self, calls, chunk_size=None):
+        # Same as batch(), but keeps each POST to at most rpc_batch_size calls so a 3,000 transaction block
+        # doesn't turn into one enormous request/response.
+        if chunk_size is None:
+            chunk_size = rpc_batch_size
+        results = []
+        for start in range(0, len(calls), chunk_size):
+            results.extend(self.batch(calls[start:start + chunk_size]))
+        return results
 
     def __call__(self, *args):
         response = None
-        headers = {'Content-type': 'application/json'}
-        JSONRPC.__id_count += 1
         postdata = json.dumps({'version': '1.1', 'method': self.__method_name,
-                               'params': args, 'id': JSONRPC.__id_count})
+                               'params': args, 'id': next(JSONRPC.__id_count)})
         try:
-            response = requests.post(self.__url,
-                                     headers=headers,
-                                     data=postdata,
-                                     timeout=self.__timeout,
-                                     auth=(self.__user,
-                                           self.__password))
-            # TODO - this is better than float, but need to make sure we properly format
-            # TODO - scientific notation. 1+E8 isn't slick looking.
-            response = response.json(parse_float=decimal.Decimal)
-        except Exception:
-            return
+            with ingest_metrics.rpc(self.__method_name):
+                response = self.__session.post(self.__url,
+                                               data=postdata,
+                                               timeout=self.__timeout)
+                # TODO - this is better than float, but need to make sure we properly format
+                # TODO - scientific notation. 1+E8 isn't slick looking.
+                response = response.json(parse_float=decimal.Decimal)
+        except Exception as e:
+            logger.warning(f"JSON-RPC {self.__method_name} failed: {e}")
+            raise JSONRPCException({'code': -344,
+                                    'message': f'JSON-RPC request failed: {e}'})
         if response.get('error') is not None:
-            print(response['error'])
+            logger.debug(f"JSON-RPC {self.__method_name} returned an error: {response['error']}")
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
             raise JSONRPCException({'code': -343,
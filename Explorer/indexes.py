@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+from config import index_build_maintenance_workers, index_build_workers
+from models import db
+
+# The sequential ingest looks outputs up by txid while it loads (PrevoutResolver, after finding their heights in
+# txs, and the spent UPDATE in BulkWriter.flush), so those can't wait. The parallel first run doesn't read anything
+# back until the end.
+INGEST_INDEXES = {'ix_txout_txid', 'ix_txs_txid'}
+
+
+def declared_indexes():
+    return {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+
+
+def create_tables_without_indexes(engine, keep=()):
+    # Same as db.create_all(), minus the secondary indexes. Primary keys are part of CREATE TABLE so they stay.
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            connection.execute(CreateTable(table))
+            for index in table.indexes:
+                if index.name in keep:
+                    index.create(connection)
+
+
+def missing_indexes(engine):
+    # An index left invalid by an interrupted build counts as missing.
+    with engine.connect() as connection:
+        valid_indexes = set(connection.execute(text(
+            "SELECT pg_class.relname FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_index.indisvalid")).scalars())
+    return [index for name, index in declared_indexes().items() if name not in valid_indexes]
+
+
+def build_index(engine, index):
+    with engine.connect() as connection:
+        connection.execute(text(f"SET max_parallel_maintenance_workers = {int(index_build_maintenance_workers)}"))
+        connection.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+        index.create(connection)
+        connection.commit()
+    return index.name
+
+
+def build_indexes(engine, indexes, logger):
+    # Plain CREATE INDEX only takes a SHARE lock, which doesn't conflict with itself, so several indexes on the same
+    # table build at the same time (CONCURRENTLY would serialise those and scan each table twice). Readers aren't
+    # blocked either way, and nothing else should be writing until first_run.py is done.
+    if not indexes:
+        return
+    logger.info(f"Building {len(indexes)} indexes with {index_build_workers} connections")
+    with ThreadPoolExecutor(max_workers=index_build_workers) as executor:
+        for index_name in executor.map(lambda index: build_index(engine, index), indexes):
+            logger.info(f"Built {index_name}")
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from pathlib import Path
+from config import metrics_enabled, metrics_file
+
+# blocks/s and rows/s are worked out over at least this many seconds, so committing every block near the tip
+# doesn't make them jump around.
+RATE_WINDOW_SECONDS = 10
+TIMED_FAMILIES = (('stage', 'stage', 'Seconds spent in each part of ingesting a block'),
+                  ('rpc', 'method', 'Seconds spent waiting on the daemon, by RPC method'))
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    __slots__ = ('metrics', 'key', 'started')
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.key, time.perf_counter() - self.started)
+        return False
+
+
+class IngestMetrics(object):
+    # Timings and counters for first_run.py and cronjob.py, written in Prometheus' text format to metrics_file on
+    # every commit. app.py serves that file at /metrics, or node_exporter's textfile collector can read it.
+    # With metrics_enabled off every call returns straight away, and timer() hands back a shared no-op.
+    def __init__(self, enabled=metrics_enabled, path=metrics_file):
+        self.enabled = enabled
+        # Relative paths are relative to this directory, like the log files.
+        self.path = Path(Path(__file__).parent, path)
+        # Prefetch workers time their RPC calls from other threads.
+        self.lock = threading.Lock()
+        # (family, label) -> [seconds, calls]
+        self.timings = {}
+        self.counters = {'blocks': 0, 'rows': 0}
+        self.node_tip = None
+        self.db_tip = None
+        self.rate_since = (time.monotonic(), 0, 0)
+        self.rates = None
+
+    def timer(self, family, label):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, (family, label))
+
+    def stage(self, name):
+        return self.timer('stage', name)
+
+    def rpc(self, method):
+        return self.timer('rpc', method)
+
+    def observe(self, key, seconds):
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                self.timings[key] = [seconds, 1]
+            else:
+                timing[0] += seconds
+                timing[1] += 1
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += amount
+
+    def tips(self, node_tip=None, db_tip=None):
+        if self.enabled:
+            if node_tip is not None:
+                self.node_tip = node_tip
+            if db_tip is not None:
+                self.db_tip = db_tip
+
+    def render(self):
+        now = time.monotonic()
+        with self.lock:
+            timings = sorted(self.timings.items())
+            blocks, rows = self.counters['blocks'], self.counters['rows']
+        since, since_blocks, since_rows = self.rate_since
+        # The first write goes by however long it's been, so a short run still gets a rate.
+        if (self.rates is None and now > since) or now - since >= RATE_WINDOW_SECONDS:
+            self.rates = ((blocks - since_blocks) / (now - since), (rows - since_rows) / (now - since))
+            self.rate_since = (now, blocks, rows)
+        lines = []
+        for family, label_name, help_text in TIMED_FAMILIES:
+            lines.append(f"# HELP explorer_{family}_seconds_total {help_text}")
+            lines.append(f"# TYPE explorer_{family}_seconds_total counter")
+            for (timed_family, label), (seconds, _) in timings:
+                if timed_family == family:
+                    lines.append(f'explorer_{family}_seconds_total{{{label_name}="{label}"}} {seconds:.6f}')
+            lines.append(f"# HELP explorer_{family}_calls_total Times each {label_name} was timed")
+            lines.append(f"# TYPE explorer_{family}_calls_total counter")
+            for (timed_family, label), (_, calls) in timings:
+                if timed_family == family:
+                    lines.append(f'explorer_{family}_calls_total{{{label_name}="{label}"}} {calls}')
+        for name, value, help_text in (('blocks', blocks, 'Blocks ingested by this process'),
+                                       ('rows', rows, 'Rows written by this process')):
+            lines.append(f"# HELP explorer_ingest_{name}_total {help_text}")
+            lines.append(f"# TYPE explorer_ingest_{name}_total counter")
+            lines.append(f"explorer_ingest_{name}_total {value}")
+        rates = self.rates or (0.0, 0.0)
+        gauges = [('ingest_blocks_per_second', f"{rates[0]:.3f}",
+                   f"Blocks ingested per second over the last {RATE_WINDOW_SECONDS}s or more"),
+                  ('ingest_rows_per_second', f"{rates[1]:.3f}",
+                   f"Rows written per second over the last {RATE_WINDOW_SECONDS}s or more")]
+        if self.node_tip is not None:
+            gauges.append(('node_tip_height', self.node_tip, "Height of the daemon's best block"))
+        if self.db_tip is not None:
+            gauges.append(('db_tip_height', self.db_tip, 'Height of the last committed block'))
+        if self.node_tip is not None and self.db_tip is not None:
+            gauges.append(('tip_lag_blocks', self.node_tip - self.db_tip, 'Blocks the database is behind the daemon'))
+        gauges.append(('metrics_written_timestamp_seconds', int(time.time()), 'When this file was last written'))
+        for name, value, help_text in gauges:
+            lines.append(f"# HELP explorer_{name} {help_text}")
+            lines.append(f"# TYPE explorer_{name} gauge")
+            lines.append(f"explorer_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # Written beside the real file and renamed over it, so a scrape never sees half of one.
+        if not self.enabled:
+            return
+        partial_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        partial_path.write_text(self.render())
+        os.replace(partial_path, self.path)
+
+
+ingest_metrics = IngestMetrics()
@@ -0,0 +1,288 @@
+import json
+import time
+from psycopg2.extras import execute_values
+from sqlalchemy import inspect, text
+from config import partition_blocks
+from partitions import partition_name, PARTITIONED_TABLES
+from raw_block import asm_script, coins_to_satoshis
+
+# Amount columns that started out as unbounded NUMERIC coins
+SATOSHI_COLUMNS = {'addresses': ('amount', 'balance'),
+                   'address_summary': ('balance', 'received', 'sent'),
+                   'blocks': ('outstanding', 'value_out', 'transaction_fees'),
+                   'chain_state': ('outstanding',),
+                   'txs': ('total_out', 'total_in', 'fee'),
+                   'txin': ('value',),
+                   'txout': ('value',)}
+
+
+def column_type(connection, table, column):
+    return connection.execute(text("SELECT data_type FROM information_schema.columns "
+                                   "WHERE table_schema = current_schema() AND table_name = :table "
+                                   "AND column_name = :column"), {'table': table, 'column': column}).scalar()
+
+
+def amounts_to_satoshis(connection):
+    # Only columns that are still NUMERIC, since a table created since (chain_state, say) is already BIGINT.
+    # Each table is rewritten once, however many of its columns change.
+    for table, columns in SATOSHI_COLUMNS.items():
+        numeric_columns = [column for column in columns if column_type(connection, table, column) == 'numeric']
+        if numeric_columns:
+            connection.execute(text(f"ALTER TABLE {table} " + ', '.join(
+                f"ALTER COLUMN {column} TYPE bigint USING round({column} * 100000000)::bigint"
+                for column in numeric_columns)))
+    # Undo records keep [balance, transactions_in, received, transactions_out, sent] as JSON, in coins.
+    undo_records = connection.execute(text("SELECT block_height, address_summary FROM block_undo")).all()
+    for block_height, address_summary in undo_records:
+        for the_address, entry in address_summary.items():
+            if entry is not None:
+                address_summary[the_address] = [coins_to_satoshis(entry[0]), entry[1], coins_to_satoshis(entry[2]),
+                                                entry[3], coins_to_satoshis(entry[4])]
+        connection.execute(text("UPDATE block_undo SET address_summary = CAST(:address_summary AS jsonb) "
+                                "WHERE block_height = :block_height"),
+                           {'address_summary': json.dumps(address_summary), 'block_height': block_height})
+
+
+# Hex strings that became BYTEA. nexthash's 'PLACEHOLDER' becomes NULL.
+HASH_COLUMNS = {'addresses': ('block_hash', 'transaction'),
+                'block_undo': ('block_hash',),
+                'blocks': ('hash', 'prevhash', 'nexthash', 'merkleroot'),
+                'chain_state': ('tip_hash',),
+                'coinbasetxin': ('txid', 'scriptsig'),
+                'txs': ('txid',),
+                'txin': ('txid', 'prevout_hash'),
+                'txout': ('txid', 'linked_txid')}
+# asm text that became the script's bytes
+ASM_COLUMNS = {'txin': 'scriptsig',
+               'txout': 'scriptpubkey'}
+# What picks out a row's script in its block: an input by what it spends, an output by its n
+SCRIPT_KEYS = {'txin': ('txid', 'prevout_hash', 'prevout_n'),
+               'txout': ('txid', 'n')}
+SCRIPT_BLOCKS_PER_BATCH = 20
+# Which asm columns still need their scripts read again, and the height they've been done up to. It only exists
+# while hashes_and_scripts_to_bytes is part way through.
+SCRIPT_REFETCH_TABLE = text("CREATE TABLE IF NOT EXISTS script_refetch (table_name varchar PRIMARY KEY, "
+                            "column_name varchar NOT NULL, done_height integer NOT NULL)")
+
+
+def hashes_and_scripts_to_bytes(engine, fetch_blocks, logger):
+    # The column types change in a transaction of their own, so the ALTER TABLEs' locks are let go before a single
+    # block is fetched. The scripts are then read again a batch at a time, each batch committed along with how far
+    # it got, so a daemon that drops out part way only costs the batch it was on.
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE blocks ALTER COLUMN nexthash DROP NOT NULL"))
+        connection.execute(SCRIPT_REFETCH_TABLE)
+        for table in sorted(set(HASH_COLUMNS) | set(ASM_COLUMNS)):
+            changes = []
+            for column in HASH_COLUMNS.get(table, ()):
+                if column_type(connection, table, column) != 'bytea':
+                    hex_value = "nullif(nexthash, 'PLACEHOLDER')" if column == 'nexthash' else column
+                    changes.append(f"ALTER COLUMN {column} TYPE bytea USING decode({hex_value}, 'hex')")
+            asm_column = ASM_COLUMNS.get(table)
+            if asm_column is not None and column_type(connection, table, asm_column) != 'bytea':
+                # The asm goes in as its own bytes for now, and gets replaced by refetch_scripts().
+                changes.append(f"ALTER COLUMN {asm_column} TYPE bytea USING convert_to({asm_column}, 'UTF8')")
+                connection.execute(text("INSERT INTO script_refetch (table_name, column_name, done_height) "
+                                        "VALUES (:table, :column, -1)"), {'table': table, 'column': asm_column})
+            if changes:
+                connection.execute(text(f"ALTER TABLE {table} " + ', '.join(changes)))
+    refetch_scripts(engine, fetch_blocks, logger)
+
+
+def block_scripts(raw_transactions):
+    # SCRIPT_KEYS -> the script's bytes, for each table
+    scripts = {'txin': {}, 'txout': {}}
+    for txid, raw_tx in raw_transactions.items():
+        for vin in raw_tx['vin']:
+            if 'coinbase' not in vin:
+                scripts['txin'][(txid, vin['txid'], vin['vout'])] = bytes.fromhex(vin['scriptSig']['hex'])
+        for vout in raw_tx['vout']:
+            scripts['txout'][(txid, vout['n'])] = bytes.fromhex(vout['scriptPubKey']['hex'])
+    return scripts
+
+
+def refetch_scripts(engine, fetch_blocks, logger):
+    # asm doesn't always say which bytes it came from (non-minimal pushes, which PUSHDATA opcode, signatures shown
+    # with their sighash type), so every script is read again from its block, a batch of blocks at a time.
+    # asm_script() is only for a row its block doesn't have, which gets logged as approximate.
+    with engine.connect() as connection:
+        refetching = connection.execute(text("SELECT table_name, column_name, done_height FROM script_refetch")).all()
+        done_height = min((row.done_height for row in refetching), default=None)
+        heights = [] if done_height is None else connection.execute(text(
+            "SELECT height FROM blocks WHERE height > :done_height ORDER BY height"),
+            {'done_height': done_height}).scalars().all()
+    asm_columns = {row.table_name: row.column_name for row in refetching}
+    if heights:
+        logger.info(f"Reading the scripts of {len(heights)} blocks again, from block {heights[0]}")
+    approximated = {table: 0 for table in asm_columns}
+    for start in range(0, len(heights), SCRIPT_BLOCKS_PER_BATCH):
+        batch = heights[start:start + SCRIPT_BLOCKS_PER_BATCH]
+        # Fetched before the transaction starts, so it isn't held open waiting on the daemon
+        scripts = {table: {} for table in asm_columns}
+        for _, (the_block, raw_transactions) in fetch_blocks(batch):
+            for table, table_scripts in block_scripts(raw_transactions).items():
+                if table in scripts:
+                    scripts[table].update(table_scripts)
+        with engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            for table, column in asm_columns.items():
+                cursor.execute(f"SELECT id, {', '.join(SCRIPT_KEYS[table])}, {column} FROM {table} "
+                               f"WHERE block_height BETWEEN %s AND %s", (batch[0], batch[-1]))
+                updates = []
+                for row_id, *key, asm in cursor.fetchall():
+                    if asm is None:
+                        continue
+                    key = tuple(bytes(part).hex() if isinstance(part, memoryview) else part for part in key)
+                    script = scripts[table].get(key)
+                    if script is None:
+                        approximated[table] += 1
+                        script = asm_script(bytes(asm).decode())
+                    updates.append((row_id, script))
+                execute_values(cursor,
+                               f"UPDATE {table} SET {column} = fetched.script FROM (VALUES %s) AS fetched (id, script) "
+                               f"WHERE {table}.id = fetched.id",
+                               updates,
+                               template='(%s, %s::bytea)',
+                               page_size=1000)
+            cursor.close()
+            connection.execute(text("UPDATE script_refetch SET done_height = :done_height"),
+                               {'done_height': batch[-1]})
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS script_refetch"))
+    for table, rows in approximated.items():
+        if rows:
+            logger.warning(f"{rows} {table} scripts weren't in their blocks any more and were rebuilt from their asm. "
+                           f"They show the same asm but may not be the same bytes. Resync to be sure of them.")
+
+
+# Tables that kept the address itself, which now point at address_ids instead
+ADDRESS_TABLES = ('address_summary', 'addresses', 'txin', 'txout')
+
+
+def addresses_to_ids(connection):
+    from models import AddressIds
+    AddressIds.__table__.create(connection, checkfirst=True)
+    # txout has nearly every address there is. The rest are ones only the daemon knew (outputs of transactions
+    # that never get stored), which inputs and address_summary still picked up.
+    connection.execute(text("INSERT INTO address_ids (address) "
+                            "SELECT DISTINCT address FROM txout WHERE address NOT IN ('nulldata', '')"))
+    connection.execute(text("INSERT INTO address_ids (address) "
+                            "SELECT address FROM (SELECT address FROM txin UNION SELECT address FROM address_summary) "
+                            "AS stray WHERE address NOT IN ('nulldata', '') AND NOT EXISTS "
+                            "(SELECT 1 FROM address_ids WHERE address_ids.address = stray.address)"))
+    for table in ADDRESS_TABLES:
+        if column_type(connection, table, 'address_id') is None:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN address_id bigint"))
+        if column_type(connection, table, 'address') is not None:
+            connection.execute(text(f"UPDATE {table} SET address_id = address_ids.id FROM address_ids "
+                                    f"WHERE address_ids.address = {table}.address"))
+            # Takes its index (and address_summary's primary key) with it
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN address"))
+    # Spending an output without an address used to give 'nulldata' a history and a balance of its own.
+    connection.execute(text("DELETE FROM addresses WHERE address_id IS NULL"))
+    connection.execute(text("DELETE FROM address_summary WHERE address_id IS NULL"))
+    connection.execute(text("ALTER TABLE addresses ALTER COLUMN address_id SET NOT NULL"))
+    connection.execute(text("ALTER TABLE address_summary ADD PRIMARY KEY (address_id)"))
+    # addresses.address_id's index is left to first_run.py's build_indexes(), which runs after migrate()
+
+
+def partition_by_block_height(connection):
+    # Each table becomes the first partition of a new one just as it is, so nothing gets copied. It covers every
+    # height it has rows for, rounded up to a whole partition_blocks, and the partitions after it are the usual size.
+    from models import db
+    for table in PARTITIONED_TABLES:
+        relkind = connection.execute(text("SELECT relkind FROM pg_class WHERE relname = :table "
+                                          "AND relnamespace = current_schema()::regnamespace"),
+                                     {'table': table}).scalar()
+        if relkind == 'p':
+            continue
+        first_partition = partition_name(table, 0)
+        highest = connection.execute(text(f"SELECT max(block_height) FROM {table}")).scalar()
+        end = ((highest or 0) // partition_blocks + 1) * partition_blocks
+        connection.execute(text(f"ALTER TABLE {table} RENAME TO {first_partition}"))
+        # The new primary key (id, block_height) gets its own index when the partition's attached
+        connection.execute(text(f"ALTER TABLE {first_partition} DROP CONSTRAINT IF EXISTS {table}_pkey"))
+        # Out of the way of the new table's names. Same names PostgreSQL would give them on a partition.
+        for index in db.metadata.tables[table].indexes:
+            columns = '_'.join(column.name for column in index.columns)
+            connection.execute(text(f"ALTER INDEX IF EXISTS {index.name} RENAME TO {first_partition}_{columns}_idx"))
+        connection.execute(text(f"CREATE TABLE {table} (LIKE {first_partition} INCLUDING DEFAULTS) "
+                                f"PARTITION BY RANGE (block_height)"))
+        # Same ids carrying on, and the sequence goes when the table does
+        connection.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+        connection.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id, block_height)"))
+        connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {first_partition} "
+                                f"FOR VALUES FROM (0) TO ({end})"))
+        # The partition's existing indexes get attached to these instead of being built again
+        for index in db.metadata.tables[table].indexes:
+            index.create(connection)
+
+
+def address_history_index(connection):
+    # ix_addresses_history starts with address_id, so the index on that alone is just more to write. The new one
+    # is left to build_indexes() like any other missing index.
+    connection.execute(text("DROP INDEX IF EXISTS ix_addresses_address_id"))
+
+
+def address_prefix_collation(connection):
+    # varchar_pattern_ops served the search's LIKE but not its ORDER BY. ix_address_ids_address_c replaces it, and
+    # gets built by build_indexes().
+    connection.execute(text("DROP INDEX IF EXISTS ix_address_ids_address_prefix"))
+
+
+# Migrations that read blocks again, for what older databases didn't keep. They take the engine instead of a
+# connection and commit as they go, so they have to be safe to run again after being interrupted. They're also given
+# a function taking a list of heights, which iterates (height, fetch_block() result), and migrate()'s logger.
+CHAIN_MIGRATIONS = {'hashes_and_scripts_to_bytes'}
+# (version, name, migration) in the order they have to run. Each one gets its own transaction, apart from
+# CHAIN_MIGRATIONS.
+MIGRATIONS = ((1, 'amounts_to_satoshis', amounts_to_satoshis),
+              (2, 'hashes_and_scripts_to_bytes', hashes_and_scripts_to_bytes),
+              (3, 'addresses_to_ids', addresses_to_ids),
+              (4, 'partition_by_block_height', partition_by_block_height),
+              (5, 'address_history_index', address_history_index),
+              (6, 'address_prefix_collation', address_prefix_collation))
+
+
+def applied_versions(connection):
+    if not inspect(connection).has_table('schema_migrations'):
+        return set()
+    return set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def pending_migrations(engine):
+    with engine.connect() as connection:
+        done = applied_versions(connection)
+    return [migration for migration in MIGRATIONS if migration[0] not in done]
+
+
+def record_migration(connection, version, name):
+    connection.execute(text("INSERT INTO schema_migrations (version, name, applied_at) "
+                            "VALUES (:version, :name, :applied_at)"),
+                       {'version': version, 'name': name, 'applied_at': int(time.time())})
+
+
+def stamp_migrations(engine):
+    # For a database create_all() just made, which already has the schema every migration leads to.
+    from models import SchemaMigrations
+    SchemaMigrations.__table__.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+        for version, name, _ in MIGRATIONS:
+            if version not in done:
+                record_migration(connection, version, name)
+
+
+def migrate(engine, logger, fetch_blocks):
+    from models import SchemaMigrations
+    SchemaMigrations.__table__.create(engine, checkfirst=True)
+    for version, name, migration in pending_migrations(engine):
+        logger.info(f"Migrating the database: {name}")
+        started = time.monotonic()
+        if name in CHAIN_MIGRATIONS:
+            migration(engine, fetch_blocks, logger)
+        with engine.begin() as connection:
+            if name not in CHAIN_MIGRATIONS:
+                migration(connection)
+            record_migration(connection, version, name)
+        logger.info(f"Finished {name} in {time.monotonic() - started:.0f}s")
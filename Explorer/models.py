@@ -1,37 +1,127 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import LargeBinary, TypeDecorator
+from raw_block import script_asm
 
 
 db = SQLAlchemy()
+# Amounts (value, balance, fee, outstanding and the rest) are integer satoshis. They only become decimal strings
+# when app.py shows them.
+
+
+class HexBytes(TypeDecorator):
+    # Hashes (and coinbase scripts) are stored as their bytes, half the size of the hex, but everything outside
+    # the database keeps using the daemon's hex strings.
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return bytes.fromhex(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value.hex()
+
+
+class NextHash(HexBytes):
+    # NULL until the next block turns up, which everything else knows as 'PLACEHOLDER'.
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value == 'PLACEHOLDER':
+            return None
+        return super().process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return 'PLACEHOLDER'
+        return value.hex()
+
+
+class Script(TypeDecorator):
+    # Raw script bytes, written as hex and read back as the asm bitcoind would show for them.
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, decode_sighash=False):
+        super().__init__()
+        self.decode_sighash = decode_sighash
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return bytes.fromhex(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return script_asm(bytes(value), decode_sighash=self.decode_sighash)
+
+
+class AddressIds(db.Model):
+    # Every address ingest has come across, once. The other tables keep its id instead of the address itself,
+    # and each of them has an `address` that reads it back from here. Ids are never taken back, not even when the
+    # blocks that brought an address in get reorged out, so caches.AddressIdCache can hold on to them.
+    __tablename__ = 'address_ids'
+    id = db.Column(db.BIGINT,
+                   primary_key=True)
+    address = db.Column(db.String,
+                        unique=True,
+                        nullable=False)
+
+
+# For the search box's prefix LIKE and its ORDER BY address COLLATE "C", which the unique index can't serve unless
+# the database's collation is C. Same order either way, so LIMIT stops as soon as it has enough.
+db.Index('ix_address_ids_address_c', AddressIds.address.collate('C'))
+
+
+def address_of(address_id, missing=None, deferred=False):
+    # The address for an address_id column, as a read-only column of its own. Filter and join on the id instead,
+    # this is a lookup per row.
+    # correlate_except, so a query that joins address_ids itself doesn't swallow this one's FROM
+    the_address = select(AddressIds.address).where(AddressIds.id == address_id).correlate_except(
+        AddressIds).scalar_subquery()
+    if missing is not None:
+        the_address = func.coalesce(the_address, missing)
+    return db.column_property(the_address, deferred=deferred)
 
 
 class Addresses(db.Model):
     __tablename__ = 'addresses'
+    # One partition per partition_blocks heights, see partitions.py. The primary key has to include block_height.
+    __table_args__ = {'postgresql_partition_by': 'RANGE (block_height)'}
     id = db.Column(db.Integer,
-                   primary_key=True)
-    address = db.Column(db.String,
-                        unique=False,
-                        nullable=False,
-                        index=True)
-    amount = db.Column(db.Numeric,
+                   primary_key=True,
+                   autoincrement=True)
+    # Indexed by ix_addresses_history, below
+    address_id = db.Column(db.BIGINT,
+                           unique=False,
+                           nullable=False)
+    # The address page already knows which address it's showing
+    address = address_of(address_id, deferred=True)
+    amount = db.Column(db.BIGINT,
                        unique=False,
                        nullable=False)
     n = db.Column(db.Integer,
                   unique=False,
                   nullable=False)
     block_height = db.Column(db.Integer,
-                             unique=False,
-                             nullable=False,
+                             primary_key=True,
                              index=True)
-    balance = db.Column(db.Numeric,
+    balance = db.Column(db.BIGINT,
                         unique=False,
                         nullable=False)
-    block_hash = db.Column(db.String,
+    block_hash = db.Column(HexBytes,
                            unique=False,
                            nullable=False)
     the_time = db.Column(db.Integer,
                          unique=False,
                          nullable=False)
-    transaction = db.Column(db.String,
+    transaction = db.Column(HexBytes,
                             index=True,
                             unique=False,
                             nullable=False)
@@ -43,47 +133,79 @@ class Addresses(db.Model):
                        nullable=False)
 
 
+# An address page is one range of this, newest first, with every column it shows in the index itself
+db.Index('ix_addresses_history', Addresses.address_id, Addresses.id.desc(),
+         postgresql_include=['transaction', 'block_hash', 'block_height', 'the_time', 'amount', 'balance'])
+
+
 class AddressSummary(db.Model):
     __tablename__ = 'address_summary'
-    address = db.Column(db.String,
-                        primary_key=True)
-    balance = db.Column(db.Numeric,
+    address_id = db.Column(db.BIGINT,
+                           primary_key=True,
+                           autoincrement=False)
+    address = address_of(address_id)
+    balance = db.Column(db.BIGINT,
                         unique=False,
                         nullable=False)
     transactions_in = db.Column(db.Integer,
                                 unique=False,
                                 nullable=False)
-    received = db.Column(db.Numeric,
+    received = db.Column(db.BIGINT,
                          unique=False,
                          nullable=False)
     transactions_out = db.Column(db.Integer,
                                  unique=False,
                                  nullable=False)
-    sent = db.Column(db.Numeric,
+    sent = db.Column(db.BIGINT,
                      unique=False,
                      nullable=False)
 
 
+def address_summaries():
+    # AddressSummary.address is a lookup per row, so anything that goes by the address itself goes through
+    # address_ids and its unique index first.
+    return db.session.query(AddressSummary).join(AddressIds, AddressIds.id == AddressSummary.address_id)
+
+
+class BlockUndo(db.Model):
+    # What it takes to pull a block back off if it gets reorged out. Only the last undo_depth blocks keep one.
+    __tablename__ = 'block_undo'
+    block_height = db.Column(db.Integer,
+                             primary_key=True)
+    block_hash = db.Column(HexBytes,
+                           unique=False,
+                           nullable=False)
+    # address -> its address_summary row from before this block,
+    # [balance, transactions_in, received, transactions_out, sent], or null if it didn't have one
+    address_summary = db.Column(JSONB,
+                                unique=False,
+                                nullable=False)
+    # [txid, n] of every output this block spent
+    spent_outputs = db.Column(JSONB,
+                              unique=False,
+                              nullable=False)
+
+
 class Blocks(db.Model):
     __tablename__ = 'blocks'
     height = db.Column(db.Integer,
                        unique=True,
                        nullable=False,
                        index=True)
-    hash = db.Column(db.String,
+    hash = db.Column(HexBytes,
                      primary_key=True,
                      unique=True)
     version = db.Column(db.Integer,
                         unique=False,
                         nullable=False)
-    prevhash = db.Column(db.String,
+    prevhash = db.Column(HexBytes,
                          unique=False,
                          nullable=False,
                          index=True)
-    nexthash = db.Column(db.String,
+    nexthash = db.Column(NextHash,
                          unique=False,
-                         nullable=False)
-    merkleroot = db.Column(db.String,
+                         nullable=True)
+    merkleroot = db.Column(HexBytes,
                            unique=False,
                            nullable=False)
     time = db.Column(db.Integer,
@@ -104,16 +226,16 @@ class Blocks(db.Model):
     cumulative_difficulty = db.Column(db.Numeric,
                                       unique=False,
                                       nullable=False)
-    outstanding = db.Column(db.Numeric,
+    outstanding = db.Column(db.BIGINT,
                             unique=False,
                             nullable=False)
-    value_out = db.Column(db.Numeric,
+    value_out = db.Column(db.BIGINT,
                           unique=False,
                           nullable=False)
     transactions = db.Column(db.Integer,
                              unique=False,
                              nullable=False)
-    transaction_fees = db.Column(db.Numeric,
+    transaction_fees = db.Column(db.BIGINT,
                                  unique=False,
                                  nullable=False)
 
@@ -122,7 +244,7 @@ class TXs(db.Model):
     __tablename__ = 'txs'
     id = db.Column(db.Integer,
                    primary_key=True)
-    txid = db.Column(db.String,
+    txid = db.Column(HexBytes,
                      unique=False,
                      nullable=False,
                      index=True)
@@ -142,28 +264,52 @@ class TXs(db.Model):
     locktime = db.Column(db.Integer,
                          unique=False,
                          nullable=False)
-    total_out = db.Column(db.Numeric,
+    total_out = db.Column(db.BIGINT,
                           unique=False,
                           nullable=False)
-    total_in = db.Column(db.Numeric,
+    total_in = db.Column(db.BIGINT,
                          unique=False,
                          nullable=False)
-    fee = db.Column(db.Numeric,
+    fee = db.Column(db.BIGINT,
                     unique=False,
                     nullable=False)
 
 
+class ChainState(db.Model):
+    # One row (id 1): where ingest has got to, updated in the same transaction as every commit, so starting up
+    # doesn't mean sorting the blocks table.
+    __tablename__ = 'chain_state'
+    id = db.Column(db.Integer,
+                   primary_key=True)
+    tip_height = db.Column(db.Integer,
+                           unique=False,
+                           nullable=False)
+    tip_hash = db.Column(HexBytes,
+                         unique=False,
+                         nullable=False)
+    outstanding = db.Column(db.BIGINT,
+                            unique=False,
+                            nullable=False)
+    cumulative_difficulty = db.Column(db.Numeric,
+                                      unique=False,
+                                      nullable=False)
+    # Unix time of the commit that last moved it
+    committed_at = db.Column(db.Integer,
+                             unique=False,
+                             nullable=False)
+
+
 class CoinbaseTXIn(db.Model):
     __tablename__ = 'coinbasetxin'
     block_height = db.Column(db.Integer,
                              unique=False,
                              nullable=False,
                              primary_key=True)
-    txid = db.Column(db.String,
+    txid = db.Column(HexBytes,
                      unique=False,
                      nullable=False,
                      index=True)
-    scriptsig = db.Column(db.String,
+    scriptsig = db.Column(HexBytes,
                           unique=False,
                           nullable=True)
     sequence = db.Column(db.BIGINT,
@@ -174,22 +320,37 @@ class CoinbaseTXIn(db.Model):
                         nullable=True)
 
 
+class SchemaMigrations(db.Model):
+    # One row per migrations.py migration this database has had, or didn't need because create_all() made it.
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer,
+                        primary_key=True)
+    name = db.Column(db.String,
+                     unique=False,
+                     nullable=False)
+    applied_at = db.Column(db.Integer,
+                           unique=False,
+                           nullable=False)
+
+
 class TXIn(db.Model):
     __tablename__ = 'txin'
+    # Partitioned by block_height, like addresses
+    __table_args__ = {'postgresql_partition_by': 'RANGE (block_height)'}
     id = db.Column(db.Integer,
-                   primary_key=True)
+                   primary_key=True,
+                   autoincrement=True)
     block_height = db.Column(db.Integer,
-                             unique=False,
-                             nullable=False,
+                             primary_key=True,
                              index=True)
-    txid = db.Column(db.String,
+    txid = db.Column(HexBytes,
                      unique=False,
                      nullable=False,
                      index=True)
     n = db.Column(db.Integer,
                   unique=False,
                   nullable=False)
-    scriptsig = db.Column(db.String,
+    scriptsig = db.Column(Script(decode_sighash=True),
                           unique=False,
                           nullable=True)
     sequence = db.Column(db.BIGINT,
@@ -198,7 +359,7 @@ class TXIn(db.Model):
     witness = db.Column(db.String,
                         unique=False,
                         nullable=True)
-    prevout_hash = db.Column(db.String,
+    prevout_hash = db.Column(HexBytes,
                              unique=False,
                              nullable=False,
                              index=True)
@@ -206,39 +367,45 @@ class TXIn(db.Model):
                           unique=False,
                           nullable=False,
                           index=True)
-    address = db.Column(db.String,
-                        unique=False,
-                        nullable=False)
-    value = db.Column(db.Numeric,
+    # NULL when the output it spends has no address
+    address_id = db.Column(db.BIGINT,
+                           unique=False,
+                           nullable=True)
+    address = address_of(address_id, missing='nulldata')
+    value = db.Column(db.BIGINT,
                       unique=False,
                       nullable=False)
 
 
 class TxOut(db.Model):
     __tablename__ = 'txout'
+    # Partitioned by block_height, like addresses
+    __table_args__ = {'postgresql_partition_by': 'RANGE (block_height)'}
     id = db.Column(db.Integer,
-                   primary_key=True)
+                   primary_key=True,
+                   autoincrement=True)
     block_height = db.Column(db.Integer,
-                             unique=False,
-                             nullable=False,
+                             primary_key=True,
                              index=True)
-    txid = db.Column(db.String,
+    txid = db.Column(HexBytes,
                      unique=False,
                      nullable=False,
                      index=True)
     n = db.Column(db.Integer,
                   unique=False,
                   nullable=False)
-    value = db.Column(db.Numeric,
+    value = db.Column(db.BIGINT,
                       unique=False,
                       nullable=False)
-    scriptpubkey = db.Column(db.String,
+    scriptpubkey = db.Column(Script,
                              unique=False,
                              nullable=False)
-    address = db.Column(db.String,
-                        unique=False,
-                        nullable=False)
-    linked_txid = db.Column(db.String,
+    # NULL for nulldata (and anything else without an address)
+    address_id = db.Column(db.BIGINT,
+                           unique=False,
+                           nullable=True)
+    address = address_of(address_id, missing='nulldata')
+    linked_txid = db.Column(HexBytes,
                             unique=False,
                             nullable=True)
     linked_txid_n = db.Column(db.Integer,
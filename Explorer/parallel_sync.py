@@ -0,0 +1,239 @@
+import decimal
+import multiprocessing
+import click
+from flask import Flask
+from sqlalchemy import text
+from bulk_writer import BulkWriter
+from config import database_uri, parallel_chunk_blocks, rpcpassword, rpcport, rpcuser
+from helpers import CommitPolicy, JSONRPC
+from models import db
+from partitions import ensure_partitions
+from pipeline import BlockPrefetcher
+
+# Set in each worker process by start_worker()
+worker_app = None
+worker_rpc = None
+worker_uniques = None
+
+# Everything that depends on the blocks before it, worked out once all of them are loaded.
+# Each statement mirrors what bulk_of_first_run_or_cron does one row at a time.
+DEFERRED_PASS = (
+    # TXIn.address_id/value come from the output being spent.
+    """UPDATE txin SET address_id = txout.address_id, value = txout.value
+       FROM txout
+       WHERE txout.txid = txin.prevout_hash AND txout.n = txin.prevout_n""",
+    # TxOut.spent links. txin.n is the transaction's position in its block, so the input's own position is
+    # recovered from the order its rows were written in.
+    """UPDATE txout SET spent = true, linked_txid = spending.txid, linked_txid_n = spending.vin_num
+       FROM (SELECT txid, prevout_hash, prevout_n,
+                    row_number() OVER (PARTITION BY block_height, txid ORDER BY id) - 1 AS vin_num
+             FROM txin) AS spending
+       WHERE txout.txid = spending.prevout_hash AND txout.n = spending.prevout_n""",
+    # TXs.total_in/fee. Like the sequential loop, the fee only leaves out a transaction's outputs once the
+    # block's coinbase has paid out to an address.
+    """UPDATE txs SET total_in = computed.total_in, fee = computed.fee
+       FROM (SELECT txs.id,
+                    COALESCE(inputs.total_in, 0) AS total_in,
+                    CASE WHEN txs.n = 0 THEN 0
+                         WHEN captured.block_height IS NOT NULL THEN COALESCE(inputs.total_in, 0) - txs.total_out
+                         ELSE COALESCE(inputs.total_in, 0)
+                    END AS fee
+             FROM txs
+             LEFT JOIN (SELECT block_height, txid, SUM(value) AS total_in
+                        FROM txin GROUP BY block_height, txid) AS inputs
+                    ON inputs.block_height = txs.block_height AND inputs.txid = txs.txid
+             LEFT JOIN (SELECT DISTINCT txout.block_height
+                        FROM txout JOIN txs ON txs.block_height = txout.block_height AND txs.txid = txout.txid
+                        WHERE txs.n = 0 AND txout.address_id IS NOT NULL) AS captured
+                    ON captured.block_height = txs.block_height) AS computed
+       WHERE txs.id = computed.id""",
+    # Blocks.transaction_fees, and the running outstanding/cumulative_difficulty totals.
+    """UPDATE blocks SET transaction_fees = computed.fees,
+                         outstanding = computed.outstanding,
+                         cumulative_difficulty = computed.cumulative_difficulty
+       FROM (SELECT blocks.height,
+                    COALESCE(fees.fees, 0) AS fees,
+                    SUM(COALESCE(minted.minted, 0) - COALESCE(fees.fees, 0)) OVER (ORDER BY blocks.height)
+                        AS outstanding,
+                    SUM(blocks.difficulty) OVER (ORDER BY blocks.height) AS cumulative_difficulty
+             FROM blocks
+             LEFT JOIN (SELECT block_height, SUM(fee) AS fees FROM txs GROUP BY block_height) AS fees
+                    ON fees.block_height = blocks.height
+             LEFT JOIN (SELECT txout.block_height,
+                               COALESCE(SUM(txout.value) FILTER (WHERE txs.n = 0), SUM(txout.value)) AS minted
+                        FROM txout JOIN txs ON txs.block_height = txout.block_height AND txs.txid = txout.txid
+                        WHERE txout.address_id IS NOT NULL
+                        GROUP BY txout.block_height) AS minted
+                    ON minted.block_height = blocks.height) AS computed
+       WHERE blocks.height = computed.height""",
+    # Addresses, written in the order the sequential loop would have (so ids still sort by history),
+    # with the running balance as a window sum.
+    """INSERT INTO addresses (address_id, amount, n, block_height, balance, block_hash, the_time, transaction,
+                             input, output)
+       SELECT history.address_id, history.amount, history.n, history.block_height,
+              SUM(history.amount) OVER (PARTITION BY history.address_id
+                                        ORDER BY history.block_height, history.tx_n, history.input, history.n
+                                        ROWS UNBOUNDED PRECEDING),
+              blocks.hash, blocks.time, history.transaction, history.input, NOT history.input
+       FROM (SELECT txout.address_id, txout.value AS amount, txout.n, txout.block_height, txs.n AS tx_n,
+                    false AS input, txout.txid AS transaction
+             FROM txout JOIN txs ON txs.block_height = txout.block_height AND txs.txid = txout.txid
+             WHERE txout.address_id IS NOT NULL
+             UNION ALL
+             SELECT address_id, -value, vin_num, block_height, n, true, txid
+             FROM (SELECT address_id, value,
+                          row_number() OVER (PARTITION BY block_height, txid ORDER BY id) - 1 AS vin_num,
+                          block_height, n, txid
+                   FROM txin) AS spending
+             WHERE address_id IS NOT NULL) AS history
+       JOIN blocks ON blocks.height = history.block_height
+       ORDER BY history.block_height, history.tx_n, history.input, history.n""",
+    """INSERT INTO address_summary (address_id, balance, transactions_in, received, transactions_out, sent)
+       SELECT address_id,
+              SUM(amount),
+              COUNT(*) FILTER (WHERE output),
+              COALESCE(SUM(amount) FILTER (WHERE output), 0),
+              COUNT(*) FILTER (WHERE input),
+              COALESCE(-SUM(amount) FILTER (WHERE input), 0)
+       FROM addresses
+       GROUP BY address_id""",
+    """INSERT INTO chain_state (id, tip_height, tip_hash, outstanding, cumulative_difficulty, committed_at)
+       SELECT 1, height, hash, outstanding, cumulative_difficulty, extract(epoch FROM now())::integer
+       FROM blocks ORDER BY height DESC LIMIT 1""",
+)
+
+
+def load_block_deferred(writer, uniques, block_height, fetched_block):
+    # The order-independent half of bulk_of_first_run_or_cron: blocks, txs, txin, txout and coinbasetxin rows,
+    # with everything that needs earlier blocks left at zero for DEFERRED_PASS.
+    the_block, raw_transactions = fetched_block
+    total_value_out = 0
+    for number, this_transaction in enumerate(the_block['tx']):
+        raw_block_tx = raw_transactions.get(this_transaction)
+        if raw_block_tx is None or this_transaction in uniques['tx']:
+            continue
+        tx_value_out = 0
+        for vout in raw_block_tx['vout']:
+            # if type is "nulldata", this address won't exist.
+            try:
+                the_address = vout['scriptPubKey']['addresses'][0]
+            except KeyError:
+                the_address = 'nulldata'
+            else:
+                tx_value_out += vout['value']
+            writer.txout(block_height=block_height,
+                         txid=this_transaction,
+                         n=vout['n'],
+                         value=vout['value'],
+                         scriptpubkey=vout['scriptPubKey']['hex'],
+                         address=the_address,
+                         linked_txid=None,
+                         linked_txid_n=None,
+                         spent=False)
+            total_value_out += vout['value']
+        for vin_num, vin in enumerate(raw_block_tx['vin']):
+            if number == 0 and vin_num == 0:
+                writer.coinbase_txin(block_height=block_height,
+                                     txid=this_transaction,
+                                     scriptsig=vin['coinbase'],
+                                     sequence=vin['sequence'],
+                                     witness=None)
+            else:
+                writer.txin(block_height=block_height,
+                            txid=this_transaction,
+                            n=number,
+                            scriptsig=vin['scriptSig']['hex'],
+                            sequence=vin['sequence'],
+                            witness=None,
+                            prevout_hash=vin['txid'],
+                            prevout_n=vin['vout'],
+                            address='',
+                            value=0)
+        writer.tx(txid=this_transaction,
+                  block_height=block_height,
+                  size=raw_block_tx['size'],
+                  n=number,
+                  version=raw_block_tx['version'],
+                  locktime=raw_block_tx['locktime'],
+                  total_out=tx_value_out,
+                  total_in=0,
+                  fee=0)
+    if block_height == 0:
+        prev_block_hash = uniques['genesis']['prev_hash']
+    else:
+        prev_block_hash = the_block['previousblockhash']
+    writer.block(height=the_block['height'],
+                 hash=the_block['hash'],
+                 version=the_block['version'],
+                 prevhash=prev_block_hash,
+                 nexthash=the_block.get('nextblockhash', 'PLACEHOLDER'),
+                 merkleroot=the_block['merkleroot'],
+                 time=the_block['time'],
+                 bits=the_block['bits'],
+                 nonce=the_block['nonce'],
+                 size=the_block['size'],
+                 difficulty=decimal.Decimal(the_block['difficulty']),
+                 cumulative_difficulty=0,
+                 outstanding=0,
+                 value_out=total_value_out,
+                 transactions=len(the_block['tx']),
+                 transaction_fees=0)
+
+
+def start_worker(uniques):
+    global worker_app, worker_rpc, worker_uniques
+    worker_app = Flask(__name__)
+    worker_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    worker_app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    db.init_app(worker_app)
+    worker_app.app_context().push()
+    worker_rpc = JSONRPC(f"http://127.0.0.1:{rpcport}", rpcuser, rpcpassword)
+    worker_uniques = uniques
+
+
+def load_chunk(block_heights):
+    writer = BulkWriter(db)
+    commit_policy = CommitPolicy()
+    try:
+        for block_height, fetched_block in BlockPrefetcher(worker_rpc, worker_uniques, block_heights):
+            load_block_deferred(writer, worker_uniques, block_height, fetched_block)
+            if commit_policy.block_added(writer.rows):
+                writer.flush()
+                db.session.commit()
+                writer.address_ids.trim()
+                commit_policy.committed()
+        writer.flush()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.close()
+    return len(block_heights)
+
+
+def deferred_balance_pass():
+    for statement in DEFERRED_PASS:
+        db.session.execute(text(statement))
+    db.session.commit()
+    db.session.close()
+
+
+def parallel_first_run(the_app, uniques, the_blocks, workers):
+    # Only for a from-scratch sync: workers load interleaved chunks of heights in whatever order they finish,
+    # so there's nothing sensible to resume from if this gets interrupted. Drop all and start again instead.
+    chunks = [the_blocks[start:start + parallel_chunk_blocks]
+              for start in range(0, len(the_blocks), parallel_chunk_blocks)]
+    the_app.logger.info(f"Loading {len(the_blocks)} blocks with {workers} workers")
+    # Every partition up front: workers making them as they go would lock each other out of the tables.
+    with db.engine.begin() as connection:
+        ensure_partitions(connection, the_blocks[-1])
+    # spawn, so no worker inherits the parent's database connections or RPC session
+    with multiprocessing.get_context('spawn').Pool(processes=workers, initializer=start_worker,
+                                                   initargs=(uniques,)) as pool:
+        with click.progressbar(length=len(the_blocks), label='Loading blocks') as progress_bar:
+            for blocks_loaded in pool.imap_unordered(load_chunk, chunks):
+                progress_bar.update(blocks_loaded)
+    the_app.logger.info("All blocks loaded, working out balances, fees and spent outputs")
+    deferred_balance_pass()
+    the_app.logger.info("Parallel first run finished")
@@ -0,0 +1,48 @@
+import re
+from sqlalchemy import text
+from config import partition_blocks
+
+# Range partitioned by block_height, see their models. Everything that goes by height (a block's rows, a reorg's
+# DELETE, VACUUM and REINDEX a partition at a time, moving old history to another tablespace) only has to touch
+# the partitions it's about.
+PARTITIONED_TABLES = ('addresses', 'txin', 'txout')
+PARTITION_BOUNDS = text("SELECT parent.relname, pg_get_expr(child.relpartbound, child.oid) "
+                        "FROM pg_inherits "
+                        "JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent "
+                        "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+                        "WHERE parent.relnamespace = current_schema()::regnamespace "
+                        "AND parent.relname = ANY(:tables)")
+UPPER_BOUND = re.compile(r"TO \((\d+)\)")
+
+
+def partition_name(table, start):
+    return f"{table}_p{start}"
+
+
+def partitions_end(connection):
+    # table -> the height its partitions go up to (but not including), 0 when it has none yet.
+    # Partitions are only ever added on the end, so that's everything below it.
+    ends = {table: 0 for table in PARTITIONED_TABLES}
+    for table, bound in connection.execute(PARTITION_BOUNDS, {'tables': list(PARTITIONED_TABLES)}):
+        ends[table] = max(ends[table], int(UPPER_BOUND.search(bound).group(1)))
+    return ends
+
+
+def partition_names(connection):
+    return set(connection.execute(text("SELECT relname FROM pg_class WHERE relispartition "
+                                       "AND relnamespace = current_schema()::regnamespace")).scalars())
+
+
+def ensure_partitions(connection, block_height):
+    # Adds whatever partitions it takes for block_height to have somewhere to go, and returns the height everything
+    # is covered up to. CREATE TABLE ... PARTITION OF locks the whole table, so do it in the transaction that's
+    # about to write there (or before anything else is), not from a connection of its own while that one waits.
+    ends = partitions_end(connection)
+    for table, end in ends.items():
+        while end <= block_height:
+            next_end = (end // partition_blocks + 1) * partition_blocks
+            connection.execute(text(f"CREATE TABLE {partition_name(table, end)} PARTITION OF {table} "
+                                    f"FOR VALUES FROM ({end}) TO ({next_end})"))
+            end = next_end
+        ends[table] = end
+    return min(ends.values())
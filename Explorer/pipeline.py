@@ -0,0 +1,44 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import prefetch_depth, prefetch_workers
+from helpers import fetch_block
+from metrics import ingest_metrics
+
+
+class BlockPrefetcher(object):
+    # Iterates (block_height, fetch_block() result) strictly in height order, while a bounded pool of workers
+    # is already fetching the heights after it. Fetching and writing overlap instead of taking turns.
+    # At most `depth` fetched blocks wait in memory, which is what keeps a fast daemon from outrunning the writer.
+    def __init__(self, cryptocurrency, uniques, heights, workers=prefetch_workers, depth=prefetch_depth):
+        self.cryptocurrency = cryptocurrency
+        self.uniques = uniques
+        self.heights = heights
+        self.workers = workers
+        self.depth = max(depth, workers)
+
+    def __len__(self):
+        return len(self.heights)
+
+    def __iter__(self):
+        heights = iter(self.heights)
+        in_flight = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+        try:
+            for block_height in heights:
+                in_flight.append((block_height, executor.submit(fetch_block, self.cryptocurrency, self.uniques,
+                                                                block_height)))
+                if len(in_flight) >= self.depth:
+                    break
+            while in_flight:
+                block_height, fetching = in_flight.popleft()
+                # Topping up before waiting keeps the workers busy while this block is being written.
+                next_height = next(heights, None)
+                if next_height is not None:
+                    in_flight.append((next_height, executor.submit(fetch_block, self.cryptocurrency, self.uniques,
+                                                                   next_height)))
+                # Time spent here is the writer waiting on the daemon, i.e. fetching is the bottleneck.
+                with ingest_metrics.stage('fetch_wait'):
+                    fetched_block = fetching.result()
+                yield block_height, fetched_block
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,407 @@
+import decimal
+import hashlib
+import struct
+from collections import namedtuple
+
+# Compact records for `getblock <hash> 0`. Values are integer satoshis, scripts are bytes, and each output's
+# address is worked out here from the coin's prefixes in the blockchain classes instead of by the daemon.
+RawBlock = namedtuple('RawBlock', 'hash version prevhash merkleroot time bits nonce size transactions')
+RawTransaction = namedtuple('RawTransaction', 'txid size version locktime vin vout')
+RawTxIn = namedtuple('RawTxIn', 'prevout_hash prevout_n script sequence')
+RawTxOut = namedtuple('RawTxOut', 'value script addresses')
+
+NULL_HASH = '0000000000000000000000000000000000000000000000000000000000000000'
+SIGHASH_TYPES = {0x01: 'ALL', 0x02: 'NONE', 0x03: 'SINGLE',
+                 0x81: 'ALL|ANYONECANPAY', 0x82: 'NONE|ANYONECANPAY', 0x83: 'SINGLE|ANYONECANPAY'}
+# GetOpName() from bitcoind's script.cpp, for everything that isn't a push.
+OPCODE_NAMES = {0x4f: '-1', 0x50: 'OP_RESERVED', 0x61: 'OP_NOP', 0x62: 'OP_VER', 0x63: 'OP_IF', 0x64: 'OP_NOTIF',
+                0x65: 'OP_VERIF', 0x66: 'OP_VERNOTIF', 0x67: 'OP_ELSE', 0x68: 'OP_ENDIF', 0x69: 'OP_VERIFY',
+                0x6a: 'OP_RETURN', 0x6b: 'OP_TOALTSTACK', 0x6c: 'OP_FROMALTSTACK', 0x6d: 'OP_2DROP', 0x6e: 'OP_2DUP',
+                0x6f: 'OP_3DUP', 0x70: 'OP_2OVER', 0x71: 'OP_2ROT', 0x72: 'OP_2SWAP', 0x73: 'OP_IFDUP',
+                0x74: 'OP_DEPTH', 0x75: 'OP_DROP', 0x76: 'OP_DUP', 0x77: 'OP_NIP', 0x78: 'OP_OVER', 0x79: 'OP_PICK',
+                0x7a: 'OP_ROLL', 0x7b: 'OP_ROT', 0x7c: 'OP_SWAP', 0x7d: 'OP_TUCK', 0x7e: 'OP_CAT', 0x7f: 'OP_SUBSTR',
+                0x80: 'OP_LEFT', 0x81: 'OP_RIGHT', 0x82: 'OP_SIZE', 0x83: 'OP_INVERT', 0x84: 'OP_AND', 0x85: 'OP_OR',
+                0x86: 'OP_XOR', 0x87: 'OP_EQUAL', 0x88: 'OP_EQUALVERIFY', 0x89: 'OP_RESERVED1',
+                0x8a: 'OP_RESERVED2', 0x8b: 'OP_1ADD', 0x8c: 'OP_1SUB', 0x8d: 'OP_2MUL', 0x8e: 'OP_2DIV',
+                0x8f: 'OP_NEGATE', 0x90: 'OP_ABS', 0x91: 'OP_NOT', 0x92: 'OP_0NOTEQUAL', 0x93: 'OP_ADD',
+                0x94: 'OP_SUB', 0x95: 'OP_MUL', 0x96: 'OP_DIV', 0x97: 'OP_MOD', 0x98: 'OP_LSHIFT', 0x99: 'OP_RSHIFT',
+                0x9a: 'OP_BOOLAND', 0x9b: 'OP_BOOLOR', 0x9c: 'OP_NUMEQUAL', 0x9d: 'OP_NUMEQUALVERIFY',
+                0x9e: 'OP_NUMNOTEQUAL', 0x9f: 'OP_LESSTHAN', 0xa0: 'OP_GREATERTHAN', 0xa1: 'OP_LESSTHANOREQUAL',
+                0xa2: 'OP_GREATERTHANOREQUAL', 0xa3: 'OP_MIN', 0xa4: 'OP_MAX', 0xa5: 'OP_WITHIN',
+                0xa6: 'OP_RIPEMD160', 0xa7: 'OP_SHA1', 0xa8: 'OP_SHA256', 0xa9: 'OP_HASH160', 0xaa: 'OP_HASH256',
+                0xab: 'OP_CODESEPARATOR', 0xac: 'OP_CHECKSIG', 0xad: 'OP_CHECKSIGVERIFY', 0xae: 'OP_CHECKMULTISIG',
+                0xaf: 'OP_CHECKMULTISIGVERIFY', 0xb0: 'OP_NOP1', 0xb1: 'OP_CHECKLOCKTIMEVERIFY',
+                0xb2: 'OP_CHECKSEQUENCEVERIFY', 0xb3: 'OP_NOP4', 0xb4: 'OP_NOP5', 0xb5: 'OP_NOP6', 0xb6: 'OP_NOP7',
+                0xb7: 'OP_NOP8', 0xb8: 'OP_NOP9', 0xb9: 'OP_NOP10', 0xba: 'OP_CHECKSIGADD', 0xff: 'OP_INVALIDOPCODE'}
+OPCODE_NAMES.update({0x50 + number: str(number) for number in range(1, 17)})
+ASM_OPCODES = {name: opcode for opcode, name in OPCODE_NAMES.items()}
+ASM_OPCODES.update({'0': 0x00, 'OP_UNKNOWN': 0xbb})
+ASM_SIGHASH_TYPES = {name: sighash_type for sighash_type, name in SIGHASH_TYPES.items()}
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32_ALPHABET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32M_CONSTANT = 0x2bc830a3
+
+try:
+    hashlib.new('ripemd160')
+except ValueError:
+    # Some OpenSSL 3 builds leave ripemd160 out, and there's no address without it. fetch_block() checks this
+    # and sticks to verbose JSON.
+    RIPEMD160_AVAILABLE = False
+else:
+    RIPEMD160_AVAILABLE = True
+
+
+class RawFormatError(ValueError):
+    pass
+
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash160(data):
+    return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
+
+
+def base58_check(payload):
+    data = payload + double_sha256(payload)[:4]
+    number = int.from_bytes(data, 'big')
+    encoded = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    return '1' * (len(data) - len(data.lstrip(b'\0'))) + encoded
+
+
+def bech32_polymod(values):
+    generator = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for bit in range(5):
+            checksum ^= generator[bit] if (top >> bit) & 1 else 0
+    return checksum
+
+
+def segwit_address(hrp, witness_version, program):
+    # BIP173, and BIP350's bech32m for anything past version 0.
+    data = [witness_version]
+    accumulator = 0
+    bits = 0
+    for byte in program:
+        accumulator = (accumulator << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((accumulator >> bits) & 31)
+    if bits:
+        data.append((accumulator << (5 - bits)) & 31)
+    constant = 1 if witness_version == 0 else BECH32M_CONSTANT
+    expanded_hrp = [ord(character) >> 5 for character in hrp] + [0] + [ord(character) & 31 for character in hrp]
+    polymod = bech32_polymod(expanded_hrp + data + [0, 0, 0, 0, 0, 0]) ^ constant
+    checksum = [(polymod >> 5 * (5 - position)) & 31 for position in range(6)]
+    return hrp + '1' + ''.join(BECH32_ALPHABET[value] for value in data + checksum)
+
+
+def script_ops(script):
+    # (opcode, pushed data or None) for each op. A push that runs off the end yields (None, None) and stops,
+    # which is what bitcoind renders as [error].
+    position = 0
+    while position < len(script):
+        opcode = script[position]
+        position += 1
+        if opcode > 0x4e:
+            yield opcode, None
+            continue
+        if opcode < 0x4c:
+            size = opcode
+        else:
+            width = {0x4c: 1, 0x4d: 2, 0x4e: 4}[opcode]
+            if position + width > len(script):
+                yield None, None
+                return
+            size = int.from_bytes(script[position:position + width], 'little')
+            position += width
+        if position + size > len(script):
+            yield None, None
+            return
+        yield opcode, script[position:position + size]
+        position += size
+
+
+def script_number(data):
+    if not data:
+        return 0
+    number = int.from_bytes(data, 'little')
+    if data[-1] & 0x80:
+        return -(number & ~(0x80 << (8 * (len(data) - 1))))
+    return number
+
+
+def is_signature(data):
+    # IsValidSignatureEncoding() (strict DER) plus a defined sighash type, same as bitcoind checks before it'll
+    # show [ALL] and friends.
+    if len(data) < 9 or len(data) > 73 or data[0] != 0x30 or data[1] != len(data) - 3 or data[2] != 0x02:
+        return False
+    length_r = data[3]
+    if length_r == 0 or 5 + length_r >= len(data):
+        return False
+    length_s = data[5 + length_r]
+    if length_r + length_s + 7 != len(data) or length_s == 0 or data[4 + length_r] != 0x02:
+        return False
+    if data[4] & 0x80 or (length_r > 1 and data[4] == 0 and not data[5] & 0x80):
+        return False
+    if data[6 + length_r] & 0x80 or (length_s > 1 and data[6 + length_r] == 0 and not data[7 + length_r] & 0x80):
+        return False
+    return data[-1] in SIGHASH_TYPES
+
+
+def script_asm(script, decode_sighash=False):
+    # ScriptToAsmStr(), so stored scripts read the same whichever way the block was fetched.
+    decode_sighash = decode_sighash and not (script and script[0] == 0x6a) and len(script) <= 10000
+    rendered = []
+    for opcode, data in script_ops(script):
+        if opcode is None:
+            rendered.append('[error]')
+        elif data is None:
+            rendered.append(OPCODE_NAMES.get(opcode, 'OP_UNKNOWN'))
+        elif len(data) <= 4:
+            rendered.append(str(script_number(data)))
+        elif decode_sighash and is_signature(data):
+            rendered.append(f"{data[:-1].hex()}[{SIGHASH_TYPES[data[-1]]}]")
+        else:
+            rendered.append(data.hex())
+    return ' '.join(rendered)
+
+
+def script_push(data):
+    if len(data) < 0x4c:
+        return bytes([len(data)]) + data
+    elif len(data) <= 0xff:
+        return b'\x4c' + bytes([len(data)]) + data
+    elif len(data) <= 0xffff:
+        return b'\x4d' + struct.pack('<H', len(data)) + data
+    return b'\x4e' + struct.pack('<I', len(data)) + data
+
+
+def script_number_bytes(number):
+    if number == 0:
+        return b''
+    magnitude = abs(number)
+    data = bytearray(magnitude.to_bytes((magnitude.bit_length() + 7) // 8, 'little'))
+    if data[-1] & 0x80:
+        data.append(0x80 if number < 0 else 0)
+    elif number < 0:
+        data[-1] |= 0x80
+    return bytes(data)
+
+
+def asm_script(asm):
+    # script_asm() backwards, for the asm text older databases stored. The exact bytes aren't always in there
+    # (non-minimal pushes, which unknown opcode, what was left after an [error]), so this gives back a script
+    # that renders the same asm rather than necessarily the original.
+    script = b''
+    for token in asm.split():
+        if token in ASM_OPCODES:
+            script += bytes([ASM_OPCODES[token]])
+        elif token == '[error]':
+            # A push that ran off the end. Only the fact it did survives, so end on one that does too.
+            script += b'\x4c'
+            break
+        elif token.endswith(']'):
+            data, sighash_type = token[:-1].split('[')
+            script += script_push(bytes.fromhex(data) + bytes([ASM_SIGHASH_TYPES[sighash_type]]))
+        elif token.lstrip('-').isdigit() and abs(int(token)) < 2 ** 31:
+            # Pushes of up to 4 bytes are shown as numbers. A 5 byte push that happens to be all digits is shown
+            # as hex instead, but it's ambiguous with a 10 digit number, and locktimes are far more common.
+            script += script_push(script_number_bytes(int(token)))
+        else:
+            script += script_push(bytes.fromhex(token))
+    return script
+
+
+def is_pubkey(data):
+    return (len(data) == 33 and data[0] in (2, 3)) or (len(data) == 65 and data[0] in (4, 6, 7))
+
+
+def script_addresses(script, uniques):
+    # What the verbose scriptPubKey 'addresses' would hold. Nulldata and nonstandard scripts have none.
+    prefixes = uniques['address_prefixes']
+    length = len(script)
+    if length == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+        return [base58_check(prefixes['pubkeyhash'] + script[3:23])]
+    if length == 23 and script[:2] == b'\xa9\x14' and script[22] == 0x87:
+        return [base58_check(prefixes['scripthash'] + script[2:22])]
+    if 4 <= length <= 42 and (script[0] == 0 or 0x51 <= script[0] <= 0x60) and script[1] == length - 2:
+        witness_version = 0 if script[0] == 0 else script[0] - 0x50
+        if uniques['bech32_hrp'] is None or (witness_version == 0 and length not in (22, 34)):
+            return []
+        return [segwit_address(uniques['bech32_hrp'], witness_version, script[2:])]
+    ops = list(script_ops(script))
+    if len(ops) == 2 and ops[1] == (0xac, None) and ops[0][1] is not None and is_pubkey(ops[0][1]):
+        return [base58_check(prefixes['pubkeyhash'] + hash160(ops[0][1]))]
+    if len(ops) >= 4 and ops[-1] == (0xae, None) and all(data is not None for _, data in ops[1:-2]):
+        required, keys = ops[0][0], ops[-2][0]
+        pubkeys = [data for _, data in ops[1:-2]]
+        if (0x51 <= required <= keys <= 0x60 and keys - 0x50 == len(pubkeys)
+                and all(is_pubkey(pubkey) for pubkey in pubkeys)):
+            return [base58_check(prefixes['pubkeyhash'] + hash160(pubkey)) for pubkey in pubkeys]
+    return []
+
+
+class ByteReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size):
+        if self.position + size > len(self.data):
+            raise RawFormatError(f"Ran out of bytes at {self.position} reading {size}")
+        chunk = self.data[self.position:self.position + size]
+        self.position += size
+        return chunk
+
+    def unpack(self, the_format, size):
+        return struct.unpack(the_format, self.read(size))[0]
+
+    def compact_size(self):
+        first = self.read(1)[0]
+        if first < 0xfd:
+            return first
+        return self.unpack({0xfd: '<H', 0xfe: '<I', 0xff: '<Q'}[first], {0xfd: 2, 0xfe: 4, 0xff: 8}[first])
+
+
+def read_transaction(reader, uniques):
+    start = reader.position
+    version = reader.unpack('<i', 4)
+    flags = 0
+    counts_start = reader.position
+    input_count = reader.compact_size()
+    if input_count == 0:
+        # BIP144's marker. (A transaction with no inputs can't be in a block anyway.)
+        flags = reader.read(1)[0]
+        if flags == 0 or flags & ~0x09:
+            raise RawFormatError(f"Unknown transaction flags {flags}")
+        counts_start = reader.position
+        input_count = reader.compact_size()
+    vin = []
+    for _ in range(input_count):
+        prevout_hash = reader.read(32)[::-1].hex()
+        prevout_n = reader.unpack('<I', 4)
+        script = reader.read(reader.compact_size())
+        vin.append(RawTxIn(prevout_hash, prevout_n, script, reader.unpack('<I', 4)))
+    vout = []
+    for _ in range(reader.compact_size()):
+        value = reader.unpack('<q', 8)
+        script = reader.read(reader.compact_size())
+        vout.append(RawTxOut(value, script, script_addresses(script, uniques)))
+    stripped_end = reader.position
+    if flags & 0x01:
+        for _ in range(input_count):
+            for _ in range(reader.compact_size()):
+                reader.read(reader.compact_size())
+    if flags & 0x08 and reader.read(1)[0] != 0:
+        # Litecoin's MWEB: the HogEx transaction carries an empty one, anything else we don't understand.
+        raise RawFormatError("MWEB transaction data isn't supported")
+    locktime_bytes = reader.read(4)
+    # txid is the hash of the serialization without the marker, flags and witnesses.
+    if flags:
+        stripped = reader.data[start:start + 4] + reader.data[counts_start:stripped_end] + locktime_bytes
+    else:
+        stripped = reader.data[start:reader.position]
+    return RawTransaction(txid=double_sha256(stripped)[::-1].hex(),
+                          size=reader.position - start,
+                          version=version,
+                          locktime=struct.unpack('<I', locktime_bytes)[0],
+                          vin=vin,
+                          vout=vout)
+
+
+def deserialize_block(raw_bytes, uniques):
+    reader = ByteReader(raw_bytes)
+    header = reader.read(80)
+    version, prevhash, merkleroot, the_time, bits, nonce = struct.unpack('<i32s32sIII', header)
+    transactions = [read_transaction(reader, uniques) for _ in range(reader.compact_size())]
+    # Whatever's left (Litecoin's MWEB block) isn't anything the explorer stores.
+    return RawBlock(hash=double_sha256(header)[::-1].hex(),
+                    version=version,
+                    prevhash=prevhash[::-1].hex(),
+                    merkleroot=merkleroot[::-1].hex(),
+                    time=the_time,
+                    bits=bits,
+                    nonce=nonce,
+                    size=len(raw_bytes),
+                    transactions=transactions)
+
+
+def satoshis_to_coins(value):
+    return decimal.Decimal(value).scaleb(-8)
+
+
+def coins_to_satoshis(value):
+    # The daemon's JSON amounts, parsed as Decimal (or written out by str() as a Decimal would be), are exact.
+    return int(decimal.Decimal(value).scaleb(8))
+
+
+def output_addresses(script_pubkey):
+    # A daemon's verbose scriptPubKey as an 'addresses' list. Bitcoin Core 22 and later only give the one 'address'
+    # (and nothing for multisig) unless started with -deprecatedrpc=addresses.
+    if 'addresses' in script_pubkey:
+        return script_pubkey['addresses']
+    if 'address' in script_pubkey:
+        return [script_pubkey['address']]
+    return []
+
+
+def is_coinbase(raw_transaction):
+    return (len(raw_transaction.vin) == 1 and raw_transaction.vin[0].prevout_hash == NULL_HASH
+            and raw_transaction.vin[0].prevout_n == 0xffffffff)
+
+
+def verbose_transaction(raw_transaction):
+    # The parts of getrawtransaction's verbose JSON that bulk_of_first_run_or_cron reads, with values left as
+    # integer satoshis like fetch_block() turns the daemon's into. Scripts are stored as bytes, so there's no asm.
+    if is_coinbase(raw_transaction):
+        vin = [{'coinbase': raw_transaction.vin[0].script.hex(), 'sequence': raw_transaction.vin[0].sequence}]
+    else:
+        vin = [{'txid': the_input.prevout_hash,
+                'vout': the_input.prevout_n,
+                'scriptSig': {'hex': the_input.script.hex()},
+                'sequence': the_input.sequence} for the_input in raw_transaction.vin]
+    vout = []
+    for n, the_output in enumerate(raw_transaction.vout):
+        script_pubkey = {'hex': the_output.script.hex()}
+        if the_output.addresses:
+            script_pubkey['addresses'] = the_output.addresses
+        vout.append({'value': the_output.value, 'n': n, 'scriptPubKey': script_pubkey})
+    return {'txid': raw_transaction.txid,
+            'size': raw_transaction.size,
+            'version': raw_transaction.version,
+            'locktime': raw_transaction.locktime,
+            'vin': vin,
+            'vout': vout}
+
+
+def verbose_block(raw_block, block_header, uniques):
+    # Same (the_block, raw_transactions) pair fetch_block() builds out of verbose JSON. The height, next hash and
+    # difficulty aren't in the raw block, so they come from getblockheader.
+    if raw_block.hash != block_header['hash']:
+        raise RawFormatError(f"Block hashed to {raw_block.hash}, expected {block_header['hash']}")
+    the_block = {'hash': raw_block.hash,
+                 'height': block_header['height'],
+                 'version': raw_block.version,
+                 'merkleroot': raw_block.merkleroot,
+                 'time': raw_block.time,
+                 'bits': f"{raw_block.bits:08x}",
+                 'nonce': raw_block.nonce,
+                 'size': raw_block.size,
+                 'difficulty': block_header['difficulty'],
+                 'tx': [raw_transaction.txid for raw_transaction in raw_block.transactions]}
+    if raw_block.prevhash != NULL_HASH:
+        the_block['previousblockhash'] = raw_block.prevhash
+    if 'nextblockhash' in block_header:
+        the_block['nextblockhash'] = block_header['nextblockhash']
+    raw_transactions = {raw_transaction.txid: verbose_transaction(raw_transaction)
+                        for raw_transaction in raw_block.transactions if raw_transaction.txid not in uniques['tx']}
+    return the_block, raw_transactions
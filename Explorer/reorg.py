@@ -0,0 +1,62 @@
+from sqlalchemy import text, tuple_
+from sqlalchemy.sql import desc
+from caches import stored_heights
+from helpers import JSONRPCException
+
+# Everything ingest writes per block, besides blocks itself and address_summary.
+BLOCK_TABLES = ('addresses', 'coinbasetxin', 'txin', 'txout', 'txs')
+
+
+def find_fork(db, cryptocurrency, tip_height, tip_hash):
+    # Height of the highest stored block that's still on the daemon's best chain, so tip_height when nothing
+    # reorged. Walks back a few blocks per request; anything deeper than undo_depth can't be rolled back anyway.
+    from models import Blocks
+    if cryptocurrency.batch([('getblockhash', tip_height)])[0] == tip_hash:
+        return tip_height
+    height = tip_height
+    while height >= 0:
+        stored_blocks = db.session.query(Blocks.height, Blocks.hash).filter(
+            Blocks.height.between(max(height - 9, 0), height)).order_by(desc(Blocks.height)).all()
+        daemon_hashes = cryptocurrency.batch([('getblockhash', stored_block.height) for stored_block in stored_blocks])
+        for stored_block, daemon_hash in zip(stored_blocks, daemon_hashes):
+            # A height past the daemon's (shorter) chain comes back as an error, which isn't a match either.
+            if not isinstance(daemon_hash, JSONRPCException) and daemon_hash == stored_block.hash:
+                return stored_block.height
+        height -= 10
+    return -1
+
+
+def roll_back(db, address_cache, fork_height):
+    # Takes every block above fork_height back off using their block_undo records, inside the session's
+    # transaction. address_summary changes are left in address_cache for the caller's commit_boundary().
+    # Returns the fork block (the new tip), or None when a block in the way has no undo record.
+    from models import Blocks, BlockUndo, TxOut
+    tip_height = db.session.query(Blocks.height).order_by(desc(Blocks.height)).limit(1).scalar()
+    undo_records = db.session.query(BlockUndo).filter(BlockUndo.block_height > fork_height).order_by(
+        desc(BlockUndo.block_height)).all()
+    if [undo_record.block_height for undo_record in undo_records] != list(range(tip_height, fork_height, -1)):
+        return None
+    previous_summaries = {}
+    spent_outputs = set()
+    # Newest first, so an address touched by several of these blocks ends up as it was before the oldest one.
+    for undo_record in undo_records:
+        previous_summaries.update(undo_record.address_summary)
+        spent_outputs.update((txid, n) for txid, n in undo_record.spent_outputs)
+    address_cache.restore(previous_summaries)
+    # Outputs created by the orphaned blocks are deleted below, the older ones they spent become unspent again.
+    spent_outputs = list(spent_outputs)
+    for start in range(0, len(spent_outputs), 5000):
+        chunk = spent_outputs[start:start + 5000]
+        heights = [height for height in stored_heights(db, {txid for txid, _ in chunk}) if height <= fork_height]
+        if heights:
+            db.session.query(TxOut).filter(TxOut.block_height.in_(heights),
+                                           tuple_(TxOut.txid, TxOut.n).in_(chunk)).update(
+                {'spent': False, 'linked_txid': None, 'linked_txid_n': None}, synchronize_session=False)
+    for table in BLOCK_TABLES:
+        db.session.execute(text(f"DELETE FROM {table} WHERE block_height > :fork_height"),
+                           {'fork_height': fork_height})
+    db.session.query(Blocks).filter(Blocks.height > fork_height).delete(synchronize_session=False)
+    db.session.query(BlockUndo).filter(BlockUndo.block_height > fork_height).delete(synchronize_session=False)
+    fork_block = db.session.query(Blocks).filter(Blocks.height == fork_height).one()
+    fork_block.nexthash = 'PLACEHOLDER'
+    return fork_block
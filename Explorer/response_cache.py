@@ -0,0 +1,123 @@
+import threading
+import time
+from functools import wraps
+import redis
+from flask import current_app, g, make_response, request
+from config import redis_url, undo_depth
+
+# Every worker's hit and miss counts, added up in Redis so /metrics shows them all whichever worker it hits
+COUNTS_KEY = 'cce:response_cache_counts'
+COUNTS_FLUSH_SECONDS = 10
+# How long a final entry lasts. Long enough that it's only ever rebuilt for having been asked for again.
+FINAL_TIMEOUT = 30 * 86400
+
+
+class ResponseCache(object):
+    # The caching policy for app.py's views, on top of its flask_caching Cache:
+    # - Keys are the path and whichever query arguments the view reads, so ?page=2 is an entry of its own and
+    #   anything else in the query string isn't.
+    # - Views that follow the chain have the tip's height and hash in their keys as well. When cronjob.py announces
+    #   a new tip (see chain_tip.py) each of them misses once, and the old entries are left to expire.
+    # - A view that calls final() with a height at least undo_depth below the tip is stored without the tip in its
+    #   key and lasts FINAL_TIMEOUT, since cronjob.py can't roll back that far. Flush Redis after resyncing from
+    #   scratch.
+    # - Views that only depend on the daemon (mempool, peers) just expire.
+    # Like flask_caching's own decorators, a cache that can't be reached gets logged and the view runs uncached.
+    def __init__(self, cache, chain_tip, url=redis_url):
+        self.cache = cache
+        self.chain_tip = chain_tip
+        self.client = None
+        if url is not None:
+            self.client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self.lock = threading.Lock()
+        # (endpoint, 'hit' or 'miss') -> requests since the last flush to COUNTS_KEY
+        self.counts = {}
+        self.flushed_at = time.monotonic()
+
+    def cached(self, timeout, follows_chain=True, query_args=()):
+        def decorator(view):
+            @wraps(view)
+            def cached_view(*args, **kwargs):
+                query = '&'.join(f"{name}={request.args[name]}" for name in query_args if name in request.args)
+                final_key = f"view:{request.path}?{query}"
+                key = final_key
+                if follows_chain:
+                    tip = self.chain_tip.get()
+                    key = f"view:{tip.height}:{tip.hash}:{request.path}?{query}"
+                try:
+                    # One round trip for both
+                    entries = self.cache.get_many(final_key, key)
+                except Exception:
+                    current_app.logger.exception("Couldn't read the response cache")
+                    return view(*args, **kwargs)
+                for entry in entries:
+                    if entry is not None:
+                        self.count(request.endpoint, 'hit')
+                        return current_app.response_class(entry[0], status=entry[1], headers=entry[2])
+                self.count(request.endpoint, 'miss')
+                g.final_height = None
+                response = make_response(view(*args, **kwargs))
+                # Only answers to this particular request (a range, or "not modified")
+                if response.status_code in (206, 304):
+                    return response
+                # send_from_directory's responses stream the file unless told otherwise
+                response.direct_passthrough = False
+                entry = (response.get_data(), response.status_code, list(response.headers.items()))
+                try:
+                    if (follows_chain and g.final_height is not None and response.status_code == 200
+                            and tip.height - g.final_height >= undo_depth):
+                        self.cache.set(final_key, entry, timeout=FINAL_TIMEOUT)
+                    else:
+                        self.cache.set(key, entry, timeout=timeout)
+                except Exception:
+                    current_app.logger.exception("Couldn't write to the response cache")
+                return response
+            return cached_view
+        return decorator
+
+    @staticmethod
+    def final(height):
+        # For a view to say its page won't change again once the block at this height is deep enough
+        g.final_height = height
+
+    def count(self, endpoint, result):
+        with self.lock:
+            self.counts[(endpoint, result)] = self.counts.get((endpoint, result), 0) + 1
+            due = self.client is not None and time.monotonic() - self.flushed_at >= COUNTS_FLUSH_SECONDS
+            if due:
+                counts, self.counts, self.flushed_at = self.counts, {}, time.monotonic()
+        if due:
+            self.flush(counts)
+
+    def flush(self, counts):
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for (endpoint, result), requests in counts.items():
+                pipeline.hincrby(COUNTS_KEY, f"{endpoint}:{result}", requests)
+            pipeline.execute()
+        except redis.RedisError:
+            # Kept for the next flush instead
+            with self.lock:
+                for count_key, requests in counts.items():
+                    self.counts[count_key] = self.counts.get(count_key, 0) + requests
+
+    def render(self):
+        # Prometheus text for /metrics: what every worker has flushed so far, and this one's since then
+        totals = {}
+        if self.client is not None:
+            try:
+                for field, requests in self.client.hgetall(COUNTS_KEY).items():
+                    endpoint, result = field.decode().rsplit(':', 1)
+                    totals[(endpoint, result)] = int(requests)
+            except redis.RedisError:
+                pass
+        with self.lock:
+            for count_key, requests in self.counts.items():
+                totals[count_key] = totals.get(count_key, 0) + requests
+        lines = ["# HELP explorer_response_cache_requests_total Requests for cached views, by whether the cache had "
+                 "them",
+                 "# TYPE explorer_response_cache_requests_total counter"]
+        for (endpoint, result), requests in sorted(totals.items()):
+            lines.append(f'explorer_response_cache_requests_total{{endpoint="{endpoint}",result="{result}"}} '
+                         f'{requests}')
+        return '\n'.join(lines) + '\n'
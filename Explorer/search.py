@@ -0,0 +1,150 @@
+import string
+from config import search_results_limit
+from helpers import hash_prefix_range
+from models import db, address_summaries, AddressIds, Blocks, TXs
+from raw_block import BASE58_ALPHABET, BECH32_ALPHABET, BECH32M_CONSTANT, bech32_polymod, double_sha256
+
+# Typed in front of a search to say what it's for
+TYPED_PREFIXES = {'address': ('address:', 'a:', 'add:'),
+                  'block': ('block:', 'b:', 'bhash:'),
+                  'tx': ('transaction:', 't:', 'tx:', 'thash:')}
+# What each shape classify() finds could turn out to be
+SHAPE_KINDS = {'height': {'block'},
+               'hash': {'block', 'tx'},
+               'address': {'address'}}
+# Anything shorter that isn't a whole height, hash or address matches too much to be worth listing
+SHORTEST_PREFIX = 6
+
+
+class SearchResults(object):
+    def __init__(self):
+        self.addresses = []
+        self.blocks = []
+        self.txs = []
+        self.by_height = False
+
+    def __len__(self):
+        return len(self.addresses) + len(self.blocks) + len(self.txs)
+
+    def only_match(self):
+        # (endpoint, arguments) for the page to send a single match straight to
+        if self.addresses:
+            return 'address', {'the_address': self.addresses[0].address}
+        elif self.blocks:
+            the_block = self.blocks[0]
+            return 'block', {'block_hash_or_height': the_block.height if self.by_height else the_block.hash}
+        return 'tx', {'transaction': self.txs[0].txid}
+
+
+def split_typed_prefix(the_search):
+    for kind, prefixes in TYPED_PREFIXES.items():
+        for prefix in prefixes:
+            if the_search.startswith(prefix):
+                return {kind}, the_search[len(prefix):]
+    return set(TYPED_PREFIXES), the_search
+
+
+def is_hex(the_string):
+    return all(character in string.hexdigits for character in the_string)
+
+
+def is_base58_address(the_string, uniques):
+    # A version byte this coin uses, a 20 byte hash and a good checksum
+    if not 25 <= len(the_string) <= 35 or not all(character in BASE58_ALPHABET for character in the_string):
+        return False
+    number = 0
+    for character in the_string:
+        number = number * 58 + BASE58_ALPHABET.index(character)
+    leading_zeroes = len(the_string) - len(the_string.lstrip('1'))
+    data = bytes(leading_zeroes) + number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    if len(data) != 25 or double_sha256(data[:21])[:4] != data[21:]:
+        return False
+    # Coins without address_prefixes (raw_block.py can't read their blocks) take any version
+    prefixes = uniques.get('address_prefixes')
+    return prefixes is None or data[:1] in prefixes.values()
+
+
+def is_segwit_address(the_string, uniques):
+    # BIP173's checksum, or BIP350's for witness versions past 0. Either case is valid, but all one or the other.
+    hrp = uniques.get('bech32_hrp')
+    if hrp is None or the_string not in (the_string.lower(), the_string.upper()) or not 14 <= len(the_string) <= 90:
+        return False
+    the_string = the_string.lower()
+    if not the_string.startswith(hrp + '1'):
+        return False
+    data_part = the_string[len(hrp) + 1:]
+    if not all(character in BECH32_ALPHABET for character in data_part):
+        return False
+    expanded_hrp = [ord(character) >> 5 for character in hrp] + [0] + [ord(character) & 31 for character in hrp]
+    polymod = bech32_polymod(expanded_hrp + [BECH32_ALPHABET.index(character) for character in data_part])
+    return polymod in (1, BECH32M_CONSTANT)
+
+
+def classify(term, uniques):
+    # What the search could be in full, each as it's stored. Each one is a single lookup on a unique index.
+    shapes = {}
+    if term.isdigit() and len(term) <= 10:
+        shapes['height'] = int(term)
+    if len(term) == 64 and is_hex(term):
+        shapes['hash'] = term.lower()
+    if is_base58_address(term, uniques):
+        shapes['address'] = term
+    elif is_segwit_address(term, uniques):
+        shapes['address'] = term.lower()
+    return shapes
+
+
+def exact_matches(results, kinds, shapes):
+    if 'height' in shapes:
+        results.blocks = db.session.query(Blocks).filter(Blocks.height == shapes['height']).limit(1).all()
+        results.by_height = bool(results.blocks)
+    if 'hash' in shapes:
+        # Pasted txids are the usual search, so transactions get asked first
+        if 'tx' in kinds and not results:
+            results.txs = db.session.query(TXs).filter(TXs.txid == shapes['hash']).limit(1).all()
+        if 'block' in kinds and not results:
+            results.blocks = db.session.query(Blocks).filter(Blocks.hash == shapes['hash']).limit(1).all()
+    if 'address' in shapes and not results:
+        results.addresses = address_summaries().filter(AddressIds.address == shapes['address']).limit(1).all()
+
+
+def address_prefix_query(prefix):
+    return address_summaries().filter(AddressIds.address.like(f"{prefix}%")).order_by(
+        AddressIds.address.collate('C')).limit(search_results_limit)
+
+
+def hash_prefix_query(model, column, prefix):
+    lowest, highest = hash_prefix_range(prefix)
+    return db.session.query(model).filter(column.between(lowest, highest)).order_by(column).limit(search_results_limit)
+
+
+def prefix_matches(results, kinds, shapes, term):
+    # Prefixes only, since LIKE 'x%' is a range of ix_address_ids_address_c where '%x%' reads every address there
+    # is, and a hash prefix is a range of the hash column's own index. Each is read in that index's order, so the
+    # LIMIT stops it early however many addresses or hashes share the prefix (benchmarks/query_plans.py checks).
+    # Whatever was already looked up whole isn't looked for again.
+    if 'address' in kinds and 'address' not in shapes:
+        # One query per spelling, since an OR of two ranges would have to be sorted as a whole
+        for prefix in sorted({term, term.lower()}):
+            results.addresses += address_prefix_query(prefix).all()
+        results.addresses = sorted(results.addresses, key=lambda summary: summary.address)[:search_results_limit]
+    if 'hash' not in shapes and len(term) < 64 and is_hex(term):
+        if 'block' in kinds:
+            results.blocks = hash_prefix_query(Blocks, Blocks.hash, term.lower()).all()
+        if 'tx' in kinds:
+            results.txs = hash_prefix_query(TXs, TXs.txid, term.lower()).all()
+
+
+def search(the_search, uniques):
+    # Exact lookups first, then prefixes if none of them found anything. None if the search is too short to
+    # be anything at all.
+    kinds, term = split_typed_prefix(the_search)
+    shapes = {shape: value for shape, value in classify(term, uniques).items() if SHAPE_KINDS[shape] & kinds}
+    results = SearchResults()
+    exact_matches(results, kinds, shapes)
+    if results:
+        return results
+    if len(term) < SHORTEST_PREFIX:
+        return results if shapes else None
+    prefix_matches(results, kinds, shapes, term)
+    return results
@@ -0,0 +1,62 @@
+import pytest
+from flask import Flask
+from sqlalchemy import event
+from benchmarks.stub_rpc import StubRPCError, StubRPCServer
+from helpers import JSONRPC
+from models import db, Blocks
+
+
+def block_hash(height, branch=0):
+    # Hex like the daemon's, with the branch in front so two chains share nothing past where they split.
+    return f"{branch:02x}{height:062x}"
+
+
+def add_c_collation(dbapi_connection, connection_record):
+    # PostgreSQL's "C" collation is plain byte order, which is what address_ids' search index asks for.
+    dbapi_connection.create_collation('C', lambda left, right: (left > right) - (left < right))
+
+
+@pytest.fixture
+def sqlite_app():
+    # Just the tables the test asks for, in an in-memory SQLite instead of PostgreSQL. Only good for code that
+    # stays within what both understand.
+    the_app = Flask('tests')
+    the_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(the_app)
+    with the_app.app_context():
+        event.listen(db.engine, 'connect', add_c_collation)
+        yield the_app
+        db.session.remove()
+
+
+@pytest.fixture
+def stored_blocks(sqlite_app):
+    # Stores a block per hash, at heights counting up from 0, with nothing past the hash and height filled in.
+    Blocks.__table__.create(db.engine)
+
+    def store(hashes):
+        for height, the_hash in enumerate(hashes):
+            db.session.add(Blocks(height=height, hash=the_hash, version=1, prevhash=block_hash(0), nexthash=None,
+                                  merkleroot=block_hash(0), time=0, bits='1d00ffff', nonce=0, size=0,
+                                  difficulty=1, cumulative_difficulty=height + 1, outstanding=0, value_out=0,
+                                  transactions=1, transaction_fees=0))
+        db.session.commit()
+    return store
+
+
+@pytest.fixture
+def daemon_chain():
+    # The daemon's best chain as a list of block hashes, which the test can change under a running stub daemon.
+    chain = [block_hash(height) for height in range(6)]
+
+    def getblockhash(height):
+        if not 0 <= height < len(chain):
+            raise StubRPCError(-8, 'Block height out of range')
+        return chain[height]
+
+    stub_server = StubRPCServer({'getblockcount': lambda: len(chain) - 1,
+                                 'getblockhash': getblockhash}).start()
+    stub_server.chain = chain
+    stub_server.rpc = JSONRPC(stub_server.url, 'user', 'password')
+    yield stub_server
+    stub_server.stop()
@@ -0,0 +1,209 @@
+from types import SimpleNamespace
+import pytest
+import requests
+from flask import Flask
+import cronjob
+from benchmarks.stub_rpc import StubRPCServer
+from config import follow_poll_seconds, follow_wait_seconds
+from helpers import JSONRPC
+from models import db, Blocks
+from tests.conftest import block_hash
+
+# Nothing listens here, so every call fails straight away.
+DOWN_URL = 'http://127.0.0.1:1'
+
+
+class StubIngestState(object):
+    # What catch_up() reads and changes on cronjob.IngestState, without the running totals that need PostgreSQL.
+    def __init__(self, tip_height, tip_hash):
+        self.tip_height = tip_height
+        self.tip_hash = tip_hash
+        self.writer = None
+        self.address_cache = None
+
+    def rolled_back(self, fork_block):
+        self.tip_height = fork_block.height
+        self.tip_hash = fork_block.hash
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(cronjob, 'time', SimpleNamespace(sleep=slept.append))
+    return slept
+
+
+@pytest.fixture
+def ingest(monkeypatch, stored_blocks, daemon_chain):
+    # catch_up() with the stored chain in SQLite and the daemon's from daemon_chain. lets_boogie() and roll_back()
+    # only do what catch_up() needs from them: move the stored chain along with the daemon's.
+    monkeypatch.setattr(cronjob, 'cronjob', Flask('cronjob'), raising=False)
+    monkeypatch.setattr(cronjob, 'commit_boundary', lambda *args: None)
+    calls = SimpleNamespace(lets_boogie=[], roll_back=[], chain_moves=[])
+
+    def lets_boogie(the_blocks, uniques, cryptocurrency, ingest_state, chain_tip):
+        calls.lets_boogie.append(the_blocks)
+        for block_height in the_blocks:
+            if calls.chain_moves and calls.chain_moves[0][0] == block_height:
+                # The daemon reorged while this block was on its way, so it doesn't follow on from the tip.
+                _, fork_height, new_hashes = calls.chain_moves.pop(0)
+                daemon_chain.chain[fork_height + 1:] = new_hashes
+                return False
+            the_hash = daemon_chain.chain[block_height]
+            db.session.add(Blocks(height=block_height, hash=the_hash, version=1, prevhash=ingest_state.tip_hash,
+                                  nexthash=None, merkleroot=block_hash(0), time=0, bits='1d00ffff', nonce=0,
+                                  size=0, difficulty=1, cumulative_difficulty=block_height + 1, outstanding=0,
+                                  value_out=0, transactions=1, transaction_fees=0))
+            db.session.commit()
+            ingest_state.tip_height = block_height
+            ingest_state.tip_hash = the_hash
+        return True
+
+    def roll_back(the_db, address_cache, fork_height):
+        calls.roll_back.append(fork_height)
+        db.session.query(Blocks).filter(Blocks.height > fork_height).delete(synchronize_session=False)
+        return db.session.query(Blocks).filter(Blocks.height == fork_height).one()
+
+    monkeypatch.setattr(cronjob, 'lets_boogie', lets_boogie)
+    monkeypatch.setattr(cronjob, 'roll_back', roll_back)
+    return calls
+
+
+def stored_hashes():
+    return [stored_block.hash for stored_block in db.session.query(Blocks).order_by(Blocks.height)]
+
+
+def test_catch_up_stops_at_the_daemons_tip(ingest, stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain)
+    ingest_state = StubIngestState(5, daemon_chain.chain[5])
+    cronjob.catch_up({}, daemon_chain.rpc, ingest_state)
+    assert ingest.lets_boogie == []
+    assert ingest.roll_back == []
+
+
+def test_catch_up_ingests_up_to_the_daemons_tip(ingest, stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain[:4])
+    ingest_state = StubIngestState(3, daemon_chain.chain[3])
+    cronjob.catch_up({}, daemon_chain.rpc, ingest_state)
+    assert ingest.lets_boogie == [range(4, 6)]
+    assert ingest.roll_back == []
+    assert (ingest_state.tip_height, ingest_state.tip_hash) == (5, daemon_chain.chain[5])
+    # The old tip was stored before the block after it existed.
+    assert db.session.get(Blocks, daemon_chain.chain[3]).nexthash == daemon_chain.chain[4]
+
+
+def test_catch_up_rolls_back_a_reorg_before_ingesting(ingest, stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain[4:] = [block_hash(height, branch=1) for height in range(4, 8)]
+    ingest_state = StubIngestState(5, block_hash(5))
+    cronjob.catch_up({}, daemon_chain.rpc, ingest_state)
+    assert ingest.roll_back == [3]
+    assert ingest.lets_boogie == [range(4, 8)]
+    assert stored_hashes() == daemon_chain.chain
+
+
+def test_catch_up_goes_around_again_when_the_chain_moves_during_ingest(ingest, stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain.extend([block_hash(6), block_hash(7)])
+    ingest.chain_moves.append((7, 6, [block_hash(height, branch=1) for height in range(7, 10)]))
+    ingest_state = StubIngestState(5, block_hash(5))
+    cronjob.catch_up({}, daemon_chain.rpc, ingest_state)
+    # Block 6 made it in before the reorg at 7, so nothing needs rolling back.
+    assert ingest.lets_boogie == [range(6, 8), range(7, 10)]
+    assert ingest.roll_back == []
+    assert stored_hashes() == daemon_chain.chain
+    assert (ingest_state.tip_height, ingest_state.tip_hash) == (9, block_hash(9, branch=1))
+
+
+def test_catch_up_rolls_back_when_the_chain_moves_below_what_it_ingested(ingest, stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain.extend([block_hash(6), block_hash(7)])
+    ingest.chain_moves.append((7, 3, [block_hash(height, branch=1) for height in range(4, 9)]))
+    ingest_state = StubIngestState(5, block_hash(5))
+    cronjob.catch_up({}, daemon_chain.rpc, ingest_state)
+    assert ingest.lets_boogie == [range(6, 8), range(4, 9)]
+    assert ingest.roll_back == [3]
+    assert stored_hashes() == daemon_chain.chain
+
+
+def test_catch_up_exits_when_the_reorg_is_deeper_than_the_stored_blocks(ingest, stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain[:] = [block_hash(height, branch=1) for height in range(7)]
+    ingest_state = StubIngestState(5, block_hash(5))
+    with pytest.raises(SystemExit):
+        cronjob.catch_up({}, daemon_chain.rpc, ingest_state)
+    assert ingest.lets_boogie == []
+    assert stored_hashes() == [block_hash(height) for height in range(6)]
+
+
+def test_catch_up_waits_for_the_next_poll_when_the_daemon_is_down(ingest, stored_blocks):
+    stored_blocks([block_hash(height) for height in range(6)])
+    ingest_state = StubIngestState(5, block_hash(5))
+    cronjob.catch_up({}, JSONRPC(DOWN_URL, 'user', 'password', session=requests.Session()), ingest_state)
+    assert ingest.lets_boogie == []
+    assert (ingest_state.tip_height, ingest_state.tip_hash) == (5, block_hash(5))
+
+
+@pytest.fixture
+def waiting_daemon():
+    daemon = SimpleNamespace(waits=[], tip_height=10)
+
+    def waitforblockheight(block_height, timeout=0):
+        daemon.waits.append((block_height, timeout))
+        # Past the timeout the daemon answers with its tip anyway, which is still below block_height.
+        tip_height = min(block_height, daemon.tip_height)
+        return {'hash': block_hash(tip_height), 'height': tip_height}
+
+    stub_server = StubRPCServer({'waitforblockheight': waitforblockheight}).start()
+    daemon.rpc = JSONRPC(stub_server.url, 'user', 'password')
+    yield daemon
+    stub_server.stop()
+
+
+def test_wait_for_block_returns_once_the_daemon_has_the_block(waiting_daemon, sleeps):
+    cronjob.wait_for_block(waiting_daemon.rpc, None, 10)
+    assert waiting_daemon.waits == [(10, follow_wait_seconds * 1000)]
+    assert sleeps == []
+
+
+def test_wait_for_block_returns_when_waitforblockheight_times_out(waiting_daemon, sleeps):
+    # No new block within follow_wait_seconds: the caller checks getblockcount and waits again, no extra sleep.
+    waiting_daemon.tip_height = 9
+    cronjob.wait_for_block(waiting_daemon.rpc, None, 10)
+    assert waiting_daemon.waits == [(10, follow_wait_seconds * 1000)]
+    assert sleeps == []
+
+
+def test_wait_for_block_polls_daemons_without_waitforblockheight(sleeps):
+    stub_server = StubRPCServer().start()
+    try:
+        cronjob.wait_for_block(JSONRPC(stub_server.url, 'user', 'password'), None, 10)
+    finally:
+        stub_server.stop()
+    assert sleeps == [follow_poll_seconds]
+
+
+def test_wait_for_block_polls_while_the_daemon_is_down(sleeps):
+    cronjob.wait_for_block(JSONRPC(DOWN_URL, 'user', 'password', session=requests.Session()), None, 10)
+    assert sleeps == [follow_poll_seconds]
+
+
+def test_wait_for_block_drains_every_hashblock_notification(sleeps):
+    class StubSocket(object):
+        def __init__(self, notifications):
+            self.notifications = notifications
+            self.timeouts = []
+
+        def poll(self, timeout):
+            self.timeouts.append(timeout)
+            return self.notifications > 0
+
+        def recv_multipart(self):
+            self.notifications -= 1
+            return [b'hashblock', bytes(32), b'\x00\x00\x00\x00']
+
+    hashblock_socket = StubSocket(3)
+    cronjob.wait_for_block(None, hashblock_socket, 10)
+    assert hashblock_socket.notifications == 0
+    assert hashblock_socket.timeouts[0] == follow_wait_seconds * 1000
+    assert sleeps == []
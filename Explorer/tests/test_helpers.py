@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+import pytest
+import helpers
+from helpers import CommitPolicy, format_satoshis
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    the_clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(helpers, 'time', SimpleNamespace(monotonic=lambda: the_clock.now))
+    return the_clock
+
+
+def test_commit_policy_commits_every_n_blocks(clock):
+    commit_policy = CommitPolicy(every_blocks=3, every_seconds=30, every_rows=1000)
+    assert [commit_policy.block_added(10) for _ in range(3)] == [False, False, True]
+    # Still due until it's told the commit happened
+    assert commit_policy.block_added(10)
+    commit_policy.committed()
+    assert [commit_policy.block_added(10) for _ in range(3)] == [False, False, True]
+
+
+def test_commit_policy_commits_once_enough_rows_are_buffered(clock):
+    commit_policy = CommitPolicy(every_blocks=100, every_seconds=30, every_rows=1000)
+    assert not commit_policy.block_added(999)
+    assert commit_policy.block_added(1000)
+    commit_policy.committed()
+    # Rows are what's buffered at the time, so one big block is enough on its own
+    assert commit_policy.block_added(5000)
+
+
+def test_commit_policy_commits_after_enough_time(clock):
+    commit_policy = CommitPolicy(every_blocks=100, every_seconds=30, every_rows=1000)
+    clock.now += 29
+    assert not commit_policy.block_added(0)
+    clock.now += 1
+    assert commit_policy.block_added(0)
+    commit_policy.committed()
+    # The clock starts again from the commit
+    clock.now += 29
+    assert not commit_policy.block_added(0)
+
+
+@pytest.mark.parametrize('satoshis, coins', [
+    (0, '0.00000000'),
+    (1, '0.00000001'),
+    (100000000, '1.00000000'),
+    (5000000000, '50.00000000'),
+    (2099999997690000, '20999999.97690000'),
+    (-1, '-0.00000001'),
+    (-150000000, '-1.50000000'),
+])
+def test_format_satoshis(satoshis, coins):
+    assert format_satoshis(satoshis) == coins
@@ -0,0 +1,73 @@
+import pytest
+import requests
+from benchmarks.stub_rpc import StubRPCServer
+from helpers import JSONRPC, JSONRPCException
+from tests.conftest import block_hash
+
+
+class ReorderingStubRPCServer(StubRPCServer):
+    # Answers each batch back to front, which JSON-RPC allows, and keeps what was in each one. The first
+    # `unanswered` calls of a batch get no answer at all.
+    def __init__(self, methods=None):
+        super().__init__(methods)
+        self.batches = []
+        self.unanswered = 0
+
+    def answer_batch(self, calls):
+        self.batches.append([each_call['method'] for each_call in calls])
+        return [self.answer(each_call) for each_call in reversed(calls[self.unanswered:])]
+
+
+@pytest.fixture
+def daemon(daemon_chain):
+    stub_server = ReorderingStubRPCServer(daemon_chain.methods).start()
+    stub_server.rpc = JSONRPC(stub_server.url, 'user', 'password')
+    yield stub_server
+    stub_server.stop()
+
+
+def test_batch_matches_answers_by_id_and_returns_errors_in_place(daemon):
+    results = daemon.rpc.batch([('getblockhash', 0), ('getblockhash', 99), ('getblockcount',), ('nosuchmethod',),
+                                ('getblockhash', 5)])
+    assert daemon.batches == [['getblockhash', 'getblockhash', 'getblockcount', 'nosuchmethod', 'getblockhash']]
+    assert results[0] == block_hash(0)
+    assert isinstance(results[1], JSONRPCException) and results[1].code == -8
+    assert results[2] == 5
+    assert isinstance(results[3], JSONRPCException) and results[3].code == -32601
+    assert results[4] == block_hash(5)
+
+
+def test_batch_in_chunks_keeps_the_order_across_chunks(daemon):
+    calls = [('getblockhash', height) for height in (0, 1, 2, 42, 3)]
+    results = daemon.rpc.batch_in_chunks(calls, chunk_size=2)
+    assert [len(each_batch) for each_batch in daemon.batches] == [2, 2, 1]
+    assert results[:3] == [block_hash(0), block_hash(1), block_hash(2)]
+    assert isinstance(results[3], JSONRPCException) and results[3].code == -8
+    assert results[4] == block_hash(3)
+
+
+def test_batch_marks_calls_the_daemon_left_unanswered(daemon):
+    daemon.unanswered = 1
+    results = daemon.rpc.batch([('getblockhash', 1), ('getblockhash', 2)])
+    assert isinstance(results[0], JSONRPCException) and results[0].code == -343
+    assert results[1] == block_hash(2)
+
+
+def test_batch_of_nothing_sends_nothing(daemon):
+    assert daemon.rpc.batch([]) == []
+    assert daemon.rpc.batch_in_chunks([]) == []
+    assert daemon.batches == []
+
+
+def test_batch_raises_when_the_daemon_is_down():
+    rpc = JSONRPC('http://127.0.0.1:1', 'user', 'password', session=requests.Session())
+    with pytest.raises(JSONRPCException) as raised:
+        rpc.batch([('getblockhash', 0)])
+    assert raised.value.code == -344
+
+
+def test_single_calls_raise_the_daemons_error(daemon):
+    assert daemon.rpc.getblockhash(1) == block_hash(1)
+    with pytest.raises(JSONRPCException) as raised:
+        daemon.rpc.getblockhash(99)
+    assert raised.value.code == -8
@@ -0,0 +1,95 @@
+import re
+from types import SimpleNamespace
+import pytest
+import metrics
+from metrics import IngestMetrics, NULL_TIMER, RATE_WINDOW_SECONDS
+
+# name{label="value"} number, the only kind of sample line in Prometheus' text format that render() writes
+SAMPLE_LINE = re.compile(r'^explorer_[a-z_]+(\{[a-z]+="[^"]*"\})? -?[0-9]+(\.[0-9]+)?$')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    the_clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(metrics, 'time', SimpleNamespace(monotonic=lambda: the_clock.now,
+                                                         perf_counter=lambda: the_clock.now,
+                                                         time=lambda: 1700000000.5))
+    return the_clock
+
+
+def samples(rendered):
+    lines = rendered.splitlines()
+    assert all(line.startswith('# ') or SAMPLE_LINE.match(line) for line in lines)
+    return dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+
+
+def test_render(clock, tmp_path):
+    ingest_metrics = IngestMetrics(enabled=True, path=tmp_path / 'ingest.prom')
+    with ingest_metrics.stage('decode'):
+        clock.now += 0.25
+    with ingest_metrics.stage('decode'):
+        clock.now += 1.25
+    with ingest_metrics.rpc('getblock+getblockheader'):
+        clock.now += 0.5
+    ingest_metrics.count('blocks', 3)
+    ingest_metrics.count('rows', 120)
+    ingest_metrics.tips(node_tip=10)
+    ingest_metrics.tips(db_tip=7)
+    rendered = ingest_metrics.render()
+    assert samples(rendered) == {'explorer_stage_seconds_total{stage="decode"}': '1.500000',
+                                 'explorer_stage_calls_total{stage="decode"}': '2',
+                                 'explorer_rpc_seconds_total{method="getblock+getblockheader"}': '0.500000',
+                                 'explorer_rpc_calls_total{method="getblock+getblockheader"}': '1',
+                                 'explorer_ingest_blocks_total': '3',
+                                 'explorer_ingest_rows_total': '120',
+                                 # The first write goes by the 2 seconds since the start
+                                 'explorer_ingest_blocks_per_second': '1.500',
+                                 'explorer_ingest_rows_per_second': '60.000',
+                                 'explorer_node_tip_height': '10',
+                                 'explorer_db_tip_height': '7',
+                                 'explorer_tip_lag_blocks': '3',
+                                 'explorer_metrics_written_timestamp_seconds': '1700000000'}
+    # Every family gets its HELP and TYPE, once
+    families = [line.split()[2] for line in rendered.splitlines() if line.startswith('# TYPE')]
+    assert len(families) == len(set(families)) == 12
+    assert {line.split()[2] for line in rendered.splitlines() if line.startswith('# HELP')} == set(families)
+
+
+def test_render_rates_wait_for_the_window(clock, tmp_path):
+    ingest_metrics = IngestMetrics(enabled=True, path=tmp_path / 'ingest.prom')
+    clock.now += 1
+    ingest_metrics.count('blocks', 10)
+    assert samples(ingest_metrics.render())['explorer_ingest_blocks_per_second'] == '10.000'
+    # Within the window the last rate stays, however many blocks came in since
+    clock.now += RATE_WINDOW_SECONDS / 2
+    ingest_metrics.count('blocks', 40)
+    assert samples(ingest_metrics.render())['explorer_ingest_blocks_per_second'] == '10.000'
+    # Then it's worked out over everything since the last time it was
+    clock.now += RATE_WINDOW_SECONDS / 2
+    samples_now = samples(ingest_metrics.render())
+    assert samples_now['explorer_ingest_blocks_per_second'] == f"{40 / RATE_WINDOW_SECONDS:.3f}"
+    # No tips, no tip gauges
+    assert 'explorer_tip_lag_blocks' not in samples_now
+
+
+def test_write_replaces_the_file(clock, tmp_path):
+    ingest_metrics = IngestMetrics(enabled=True, path=tmp_path / 'ingest.prom')
+    ingest_metrics.count('blocks')
+    ingest_metrics.write()
+    ingest_metrics.count('blocks')
+    ingest_metrics.write()
+    assert [path.name for path in tmp_path.iterdir()] == ['ingest.prom']
+    assert samples((tmp_path / 'ingest.prom').read_text())['explorer_ingest_blocks_total'] == '2'
+
+
+def test_disabled_does_nothing(clock, tmp_path):
+    ingest_metrics = IngestMetrics(enabled=False, path=tmp_path / 'ingest.prom')
+    assert ingest_metrics.stage('decode') is NULL_TIMER
+    with ingest_metrics.rpc('getblock'):
+        clock.now += 1
+    ingest_metrics.count('blocks', 5)
+    ingest_metrics.tips(node_tip=10, db_tip=7)
+    ingest_metrics.write()
+    assert list(tmp_path.iterdir()) == []
+    assert (ingest_metrics.timings, ingest_metrics.counters) == ({}, {'blocks': 0, 'rows': 0})
+    assert (ingest_metrics.node_tip, ingest_metrics.db_tip) == (None, None)
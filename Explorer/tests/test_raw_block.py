@@ -0,0 +1,122 @@
+import json
+from decimal import Decimal
+from pathlib import Path
+import pytest
+from blockchain import Bitcoin, Litecoin
+from raw_block import (ByteReader, RIPEMD160_AVAILABLE, coins_to_satoshis, deserialize_block, read_transaction,
+                       script_asm, verbose_block, verbose_transaction)
+
+# Per coin, block_<height>.json holds a raw block next to what `getblock <hash> 2` says about it, and
+# transactions.json holds raw transactions next to their `getrawtransaction <txid> 1`. The JSON is in the form
+# with 'addresses' lists the explorer reads, and leaves out what raw_block.py has no way to know (confirmations,
+# chainwork, mediantime, nextblockhash).
+#
+# The mainnet blocks past genesis are cut down to a few of their transactions, so the header (and with it the
+# hash) is the real one but the size isn't. Bitcoin's transactions.json pays a bare multisig and a witness
+# version 2 program, which none of the blocks do, from a mainnet redeem script and taproot output.
+FIXTURES = Path(__file__).parent / 'fixtures'
+COIN_UNIQUES = {'bitcoin': Bitcoin.unique, 'litecoin': Litecoin.unique}
+# What verbose_block() gets from getblockheader
+HEADER_KEYS = ('hash', 'height', 'difficulty', 'nextblockhash')
+BLOCK_KEYS = ('hash', 'height', 'version', 'merkleroot', 'time', 'nonce', 'difficulty', 'previousblockhash',
+              'nextblockhash')
+
+pytestmark = pytest.mark.skipif(not RIPEMD160_AVAILABLE, reason="hashlib has no ripemd160 for addresses")
+
+
+def load(path):
+    # Amounts as Decimal, like JSONRPC parses them
+    return json.loads(path.read_text(), parse_float=Decimal)
+
+
+def block_fixtures():
+    return [pytest.param(coin, load(path), id=f"{coin}-{path.stem}")
+            for coin in COIN_UNIQUES for path in sorted((FIXTURES / coin).glob('block_*.json'))]
+
+
+def transaction_fixtures():
+    params = []
+    for coin in COIN_UNIQUES:
+        raw_txs = [raw_tx for path in sorted((FIXTURES / coin).glob('block_*.json'))
+                   for raw_tx in load(path)['getblock']['tx']]
+        if (FIXTURES / coin / 'transactions.json').exists():
+            raw_txs += load(FIXTURES / coin / 'transactions.json')
+        params += [pytest.param(coin, raw_tx, id=f"{coin}-{raw_tx['txid'][:16]}") for raw_tx in raw_txs]
+    return params
+
+
+def as_fetched(raw_tx):
+    # The daemon's verbose transaction cut down to what verbose_transaction() gives, with values in satoshis
+    # like fetch_block() leaves them.
+    vin = []
+    for the_input in raw_tx['vin']:
+        if 'coinbase' in the_input:
+            vin.append({'coinbase': the_input['coinbase'], 'sequence': the_input['sequence']})
+        else:
+            vin.append({'txid': the_input['txid'],
+                        'vout': the_input['vout'],
+                        'scriptSig': {'hex': the_input['scriptSig']['hex']},
+                        'sequence': the_input['sequence']})
+    vout = []
+    for the_output in raw_tx['vout']:
+        script_pubkey = {'hex': the_output['scriptPubKey']['hex']}
+        if 'addresses' in the_output['scriptPubKey']:
+            script_pubkey['addresses'] = the_output['scriptPubKey']['addresses']
+        vout.append({'value': coins_to_satoshis(the_output['value']), 'n': the_output['n'],
+                     'scriptPubKey': script_pubkey})
+    return {'txid': raw_tx['txid'],
+            'size': raw_tx['size'],
+            'version': raw_tx['version'],
+            'locktime': raw_tx['locktime'],
+            'vin': vin,
+            'vout': vout}
+
+
+@pytest.mark.parametrize('coin, fixture', block_fixtures())
+def test_verbose_block_matches_getblock(coin, fixture):
+    uniques = COIN_UNIQUES[coin]
+    getblock = fixture['getblock']
+    block_header = {key: getblock[key] for key in HEADER_KEYS if key in getblock}
+    the_block, raw_transactions = verbose_block(deserialize_block(bytes.fromhex(fixture['raw']), uniques),
+                                                block_header, uniques)
+    expected_block = {key: getblock[key] for key in BLOCK_KEYS if key in getblock}
+    expected_block.update(bits=getblock['bits'], tx=[raw_tx['txid'] for raw_tx in getblock['tx']])
+    if len(getblock['tx']) == getblock['nTx']:
+        expected_block['size'] = getblock['size']
+    if getblock['height'] == 0:
+        assert the_block['hash'] == uniques['genesis']['hash']
+    assert {key: the_block[key] for key in expected_block} == expected_block
+    assert set(the_block) - set(expected_block) <= {'size'}
+    assert raw_transactions == {raw_tx['txid']: as_fetched(raw_tx) for raw_tx in getblock['tx']}
+
+
+@pytest.mark.parametrize('coin, raw_tx', transaction_fixtures())
+def test_verbose_transaction_matches_getrawtransaction(coin, raw_tx):
+    reader = ByteReader(bytes.fromhex(raw_tx['hex']))
+    assert verbose_transaction(read_transaction(reader, COIN_UNIQUES[coin])) == as_fetched(raw_tx)
+    assert reader.position == len(reader.data)
+
+
+@pytest.mark.parametrize('coin, raw_tx', transaction_fixtures())
+def test_script_asm_matches_daemon_asm(coin, raw_tx):
+    # The daemon decodes sighash types in scriptSigs but not in scriptPubKeys
+    for the_input in raw_tx['vin']:
+        if 'scriptSig' in the_input:
+            script = bytes.fromhex(the_input['scriptSig']['hex'])
+            assert script_asm(script, decode_sighash=True) == the_input['scriptSig']['asm']
+    for the_output in raw_tx['vout']:
+        assert script_asm(bytes.fromhex(the_output['scriptPubKey']['hex'])) == the_output['scriptPubKey']['asm']
+
+
+@pytest.mark.parametrize('value, satoshis', [
+    (Decimal('0'), 0),
+    (Decimal('0E-8'), 0),
+    (Decimal('0.00000001'), 1),
+    (Decimal('50.00000000'), 5000000000),
+    (Decimal('20999999.9769'), 2099999997690000),
+    # Written out by str(), the way a small Decimal comes out
+    ('1E-8', 1),
+    ('12.5', 1250000000),
+])
+def test_coins_to_satoshis(value, satoshis):
+    assert coins_to_satoshis(value) == satoshis
@@ -0,0 +1,91 @@
+import json
+import pytest
+from caches import AddressCache
+from models import db, AddressIds, AddressSummary
+from reorg import find_fork
+from tests.conftest import block_hash
+
+
+@pytest.mark.parametrize('fork_height', [5, 3, 0])
+def test_find_fork_finds_the_last_block_both_chains_share(stored_blocks, daemon_chain, fork_height):
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain[fork_height + 1:] = [block_hash(height, branch=1) for height in range(fork_height + 1, 8)]
+    assert find_fork(db, daemon_chain.rpc, 5, block_hash(5)) == fork_height
+
+
+def test_find_fork_walks_back_past_the_first_request(stored_blocks, daemon_chain):
+    # Ten stored blocks get checked per request, this fork is in the third.
+    daemon_chain.chain[:] = [block_hash(height) for height in range(30)]
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain[8:] = [block_hash(height, branch=1) for height in range(8, 31)]
+    assert find_fork(db, daemon_chain.rpc, 29, block_hash(29)) == 7
+
+
+def test_find_fork_when_the_daemons_chain_is_shorter(stored_blocks, daemon_chain):
+    # Heights past the daemon's tip come back as errors, which don't match anything.
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain[3:] = [block_hash(3, branch=1)]
+    assert find_fork(db, daemon_chain.rpc, 5, block_hash(5)) == 2
+
+
+def test_find_fork_without_a_shared_block(stored_blocks, daemon_chain):
+    stored_blocks(daemon_chain.chain)
+    daemon_chain.chain[:] = [block_hash(height, branch=1) for height in range(6)]
+    assert find_fork(db, daemon_chain.rpc, 5, block_hash(5)) == -1
+
+
+@pytest.fixture
+def address_summaries(sqlite_app):
+    AddressIds.__table__.create(db.engine)
+    AddressSummary.__table__.create(db.engine)
+
+    def store(summaries):
+        for address_id, (the_address, entry) in enumerate(summaries.items(), start=1):
+            db.session.add(AddressIds(id=address_id, address=the_address))
+            db.session.add(AddressSummary(address_id=address_id, balance=entry[0], transactions_in=entry[1],
+                                          received=entry[2], transactions_out=entry[3], sent=entry[4]))
+        db.session.commit()
+    return store
+
+
+def stored_summaries():
+    return {summary.address: [summary.balance, summary.transactions_in, summary.received,
+                              summary.transactions_out, summary.sent]
+            for summary in db.session.query(AddressIds.address, AddressSummary.balance,
+                                            AddressSummary.transactions_in, AddressSummary.received,
+                                            AddressSummary.transactions_out, AddressSummary.sent).join(
+                AddressSummary, AddressSummary.address_id == AddressIds.id)}
+
+
+def test_restore_puts_back_the_balances_an_undo_journal_recorded(address_summaries):
+    address_summaries({'spender': [5000, 1, 5000, 0, 0], 'receiver': [700, 2, 700, 0, 0]})
+    address_cache = AddressCache(db)
+    address_cache.load(['spender', 'receiver', 'newcomer'])
+    address_cache.start_undo()
+    address_cache.spend('spender', 5000)
+    address_cache.receive('receiver', 3000)
+    address_cache.receive('newcomer', 1900)
+    address_cache.receive('receiver', 100)
+    # Stored the way BulkWriter.block_undo() writes it, and read back the way roll_back() gets it.
+    undo = json.loads(json.dumps(address_cache.take_undo(), default=str))
+    assert undo == {'spender': [5000, 1, 5000, 0, 0], 'receiver': [700, 2, 700, 0, 0], 'newcomer': None}
+    # The block made it to the database before it got reorged out.
+    db.session.add(AddressIds(id=3, address='newcomer'))
+    db.session.add(AddressSummary(address_id=3, balance=1900, transactions_in=1, received=1900,
+                                  transactions_out=0, sent=0))
+    db.session.commit()
+
+    address_cache.restore(undo)
+    assert dict(address_cache.entries) == {'spender': [5000, 1, 5000, 0, 0], 'receiver': [700, 2, 700, 0, 0]}
+    assert address_cache.dirty == {'spender', 'receiver'}
+    # An address the block brought in loses its row straight away, the others go back with the next flush().
+    assert 'newcomer' not in stored_summaries()
+    assert address_cache.known('spender') and not address_cache.known('newcomer')
+
+
+def test_restore_skips_entries_without_an_address(address_summaries):
+    address_summaries({'someone': [1, 1, 1, 0, 0]})
+    address_cache = AddressCache(db)
+    address_cache.restore({'nulldata': [0, 3, 0, 0, 0], 'someone': [0, 0, 0, 0, 0]})
+    assert dict(address_cache.entries) == {'someone': [0, 0, 0, 0, 0]}
+    assert address_cache.dirty == {'someone'}
@@ -0,0 +1,123 @@
+import pytest
+from blockchain import Bitcoin, Defcoin, Litecoin
+from helpers import hash_prefix_range
+from search import classify, is_base58_address, is_segwit_address, search
+from tests.conftest import block_hash
+
+GENESIS_HASH = Bitcoin.unique['genesis']['hash']
+
+
+@pytest.mark.parametrize('the_address, uniques', [
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', Bitcoin.unique),
+    ('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy', Bitcoin.unique),
+    ('Ler4HNAEfwYhBmGXcFP2Po1NpRUEiK8km2', Litecoin.unique),
+    ('MTigBXDpqJTK12Lhmd8P8UPqDGe97zVgNW', Litecoin.unique),
+])
+def test_is_base58_address(the_address, uniques):
+    assert is_base58_address(the_address, uniques)
+
+
+@pytest.mark.parametrize('the_address, uniques', [
+    # Bad checksum
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb', Bitcoin.unique),
+    # Another coin's version byte
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', Litecoin.unique),
+    ('Ler4HNAEfwYhBmGXcFP2Po1NpRUEiK8km2', Bitcoin.unique),
+    # 0, O, I and l aren't base58
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfN0', Bitcoin.unique),
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7', Bitcoin.unique),
+])
+def test_is_not_base58_address(the_address, uniques):
+    assert not is_base58_address(the_address, uniques)
+
+
+def test_is_base58_address_takes_any_version_without_address_prefixes():
+    uniques = {key: value for key, value in Bitcoin.unique.items() if key != 'address_prefixes'}
+    assert is_base58_address('Ler4HNAEfwYhBmGXcFP2Po1NpRUEiK8km2', uniques)
+
+
+@pytest.mark.parametrize('the_address, uniques', [
+    # BIP173's segwit v0 example, in either case
+    ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', Bitcoin.unique),
+    ('BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4', Bitcoin.unique),
+    # Taproot, with BIP350's bech32m checksum
+    ('bc1pjpnplaxrvwfxcgtrjlrm9x55fvkcdaxtky3t27mfq8dlx6kzq7tqsvc97m', Bitcoin.unique),
+    ('ltc1q3nhtez2yezaj470kw9xkpjygvqv3qvhn5sp469', Litecoin.unique),
+])
+def test_is_segwit_address(the_address, uniques):
+    assert is_segwit_address(the_address, uniques)
+
+
+@pytest.mark.parametrize('the_address, uniques', [
+    # Mixed case
+    ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8F3t4', Bitcoin.unique),
+    # Bad checksum
+    ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5', Bitcoin.unique),
+    # Another coin's human readable part
+    ('ltc1q3nhtez2yezaj470kw9xkpjygvqv3qvhn5sp469', Bitcoin.unique),
+    # 'b' isn't in the bech32 alphabet
+    ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3tb', Bitcoin.unique),
+    # A coin without segwit
+    ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', Defcoin.unique),
+])
+def test_is_not_segwit_address(the_address, uniques):
+    assert not is_segwit_address(the_address, uniques)
+
+
+@pytest.mark.parametrize('term, shapes', [
+    ('0', {'height': 0}),
+    ('629999', {'height': 629999}),
+    ('4294967295', {'height': 4294967295}),
+    # Too long for a height, and too short for a hash
+    ('12345678901', {}),
+    (GENESIS_HASH, {'hash': GENESIS_HASH}),
+    (GENESIS_HASH.upper(), {'hash': GENESIS_HASH}),
+    # Every hex digit a decimal one still makes a hash, but not a height
+    ('1' * 64, {'hash': '1' * 64}),
+    (GENESIS_HASH[:63], {}),
+    (GENESIS_HASH[:63] + 'g', {}),
+    ('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', {'address': '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'}),
+    # Bech32 addresses are stored lowercase
+    ('BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4', {'address': 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'}),
+    ('bc1pjpnplaxrvwfxcgtrjlrm9x55fvkcdaxtky3t27mfq8dlx6kzq7tqsvc97m',
+     {'address': 'bc1pjpnplaxrvwfxcgtrjlrm9x55fvkcdaxtky3t27mfq8dlx6kzq7tqsvc97m'}),
+    ('1A1zP1eP', {}),
+])
+def test_classify(term, shapes):
+    assert classify(term, Bitcoin.unique) == shapes
+
+
+@pytest.mark.parametrize('prefix', ['0', 'abc', GENESIS_HASH[:14], GENESIS_HASH[:63]])
+def test_hash_prefix_range(prefix):
+    lowest, highest = hash_prefix_range(prefix)
+    assert len(lowest) == len(highest) == 64
+    assert lowest.startswith(prefix) and highest.startswith(prefix)
+    assert set(lowest[len(prefix):]) <= {'0'} and set(highest[len(prefix):]) <= {'f'}
+    # Odd lengths too, since the hash column is compared as bytes
+    assert bytes.fromhex(lowest) < bytes.fromhex(highest)
+
+
+def test_hash_prefix_range_covers_exactly_the_hashes_with_the_prefix():
+    lowest, highest = map(bytes.fromhex, hash_prefix_range('abc'))
+    for the_hash, has_prefix in [('abc' + '0' * 61, True), ('abc' + 'f' * 61, True), ('abc7' + '1' * 60, True),
+                                 ('abbf' + 'f' * 60, False), ('abd' + '0' * 61, False), ('0abc' + '0' * 60, False)]:
+        assert (lowest <= bytes.fromhex(the_hash) <= highest) == has_prefix
+
+
+def test_search_finds_blocks_by_an_odd_length_hash_prefix(stored_blocks):
+    hashes = ['abcdef1' + '0' * 57, 'abcdef1' + 'f' * 57, 'abcdef2' + '0' * 57, 'abcdef0' + 'f' * 57,
+              block_hash(4)]
+    stored_blocks(hashes)
+    results = search('b:ABCDEF1', Bitcoin.unique)
+    assert [the_block.hash for the_block in results.blocks] == hashes[:2]
+    assert results.txs == [] and results.addresses == []
+
+
+def test_search_finds_a_block_by_height(stored_blocks):
+    stored_blocks([block_hash(height) for height in range(3)])
+    results = search('b:2', Bitcoin.unique)
+    assert [the_block.hash for the_block in results.blocks] == [block_hash(2)]
+    assert results.only_match() == ('block', {'block_hash_or_height': 2})
+    # Too short to look for as a prefix once the height isn't there
+    assert search('b:7', Bitcoin.unique).blocks == []
+    assert search('b:abc', Bitcoin.unique) is None